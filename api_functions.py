@@ -7,54 +7,49 @@ import re
 import os
 import yaml
 import pymongo
+import bson
+from bson.raw_bson import RawBSONDocument
+from bson.codec_options import CodecOptions
 import numpy as np
 from datetime import datetime
+import time
+import functools
+from collections import namedtuple
+import snapshots
+import term_calendar
+import metrics
+from index_manager import offering_keys, OFFERING_KEY
 
-# Establish the DB Name 
-DB_NAME = "reviews-db-v1"
+# Establish the DB Name (DB_NAME can select another, e.g. the benchmark database of a load test)
+DB_NAME = os.environ.get('DB_NAME', "reviews-db-v1")
 
 # This is the set of that will be queried by the API
 # The order is important, collections are searched in this order
 COLLECTION_NAMES = ['reviews'] #,'JRCOE', 'COAS', 'ARC', 'BUS', 'FARTS', 'GEO', 'INTS', 'JRNL', 'NRG']
 AGG_COLLECTION_NAMES = ["aggregated_"+ name for name in COLLECTION_NAMES]
 
+# Collection holding the active data version, which data_loader.py changes after every load
+DATA_VERSION_COLLECTION = 'data_version'
+# How long (seconds) current_data_version trusts the last version it read before asking mongo again
+DATA_VERSION_TTL = float(os.environ.get('DATA_VERSION_TTL', 30))
+
 # This is the period that will be considered "current" by the API. 
 # These are term codes, where the first 4 digits corresponds to year, last 2 digits to semester (10:fall, 20:spring, 30:summer), 
 # e.g. 201710 is Fall 2017
 CURRENT_SEMESTERS = [201920, 201810, 201820, 201830, 201710, 201720, 201730, 201610 ]
 
-# Import the mappings to find the semester for each course
-# Read in the question mappings values from the mappings.yaml
-# Get file location for mappings.yaml and reading data
-__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-file_path = __location__+"/mappings.yaml"
-
-with open(file_path) as f:
-    # use safe_load instead load
-    mappings = yaml.safe_load(f)
-    SEMESTER_MAPPINGS = mappings['Term_code_dict']
+# The term code -> semester label mappings (e.g. '201710' -> 'Fall 2017'), see term_calendar.py
+SEMESTER_MAPPINGS = term_calendar.SEMESTER_MAPPINGS
 
 # Sort by term code
 def sort_by_term_code(semester_int_list):
     """
     Input a list of term codes, it will sort the term code list and return the same list sorted in order of term.
     """
-    year_list = [int(str(i)[0:4]) for i in semester_int_list]
-    year_list.sort(reverse=True)
-    final_order = []
-    for year in year_list:
-        # Find the semesters of the year
-        sems = [sem for sem in semester_int_list if str(sem)[0:4] == str(year)]
-        for ending in ['10', '30', '20']:
-            for sem in sems:
-                if str(sem)[-2:] == ending and sem not in final_order:
-                    final_order.append(sem)
-    if set(final_order)!=set(semester_int_list):
-        raise Exception('Sorting term codes didnt work in the api generator')
-    return final_order# return the most recent sem as a term code
+    return term_calendar.sort_terms(semester_int_list) # return the most recent sem as a term code
 
 # Get the collection of interest from the db, based on a filter and potentially a known collection
-def query_df_from_mongo(db,coll_filter, collections = AGG_COLLECTION_NAMES):
+def query_df_from_mongo(db,coll_filter, collections = AGG_COLLECTION_NAMES, projection = None):
     """
     This function will use a coll_filter, AKA a cursor, to query the collections in COLLECTION_NAMES and will then return 
     the db and the coll_name where the filter was found.
@@ -62,28 +57,171 @@ def query_df_from_mongo(db,coll_filter, collections = AGG_COLLECTION_NAMES):
     db - a connection to the mongodb, or more concretely a mongo_driver() object
     coll_filter - a valid filter of the form required by mongodb
     collections (optional) - a list of collections to search through for the cursor/filter
+    projection (optional) - a list of the fields needed by the caller. Only these fields are fetched, and they are the columns of the result
 
     Returns:
     db - a pd DataFrame containing the results of the query
     coll_name - the collection name (str) where the coll_filter was found
     """
+    projection, fields = query_fields(projection)
+    # Serve the query from memory when db is a ServingEngine (see serving_engine.py) holding these collections
+    if hasattr(db, 'query_df') and db.holds(collections):
+        with metrics.stage('memory'):
+            df, coll_name = db.query_df(coll_filter, collections, projection)
+        metrics.count_query(coll_name, len(df))
+        return df, coll_name
     for coll_name in collections:
         coll = db.get_db_collection(DB_NAME, coll_name)
         # Use the database query to pull needed data
-        cursor = coll.find(coll_filter)
-        # For whatever reason, generating a dataframe clears the cursor, so get population here
-        population = coll.count_documents(coll_filter)
+        with metrics.stage('mongo'):
+            docs, nbytes = find_documents(coll, coll_filter, fields)
+        metrics.count_query(coll_name, len(docs), nbytes)
         # This assumes that there will be no same uuid's across the different collections, e.g. the same uuid in GCOE and JRCOE
-        if population > 0:
-            df = pd.DataFrame(list(cursor))
-            break
+        if len(docs) > 0:
+            with metrics.stage('frame'):
+                return pd.DataFrame(docs, columns=projection), coll_name
 
     # Add an error catching if the len(df) == 0
-    if population==0:
-        print('The below filter was not found within any of the mongo collection.')
-        pprint.pprint(coll_filter)
-        raise Exception('The filter was not found in the mongo collection.')
-    return df, coll_name
+    raise_not_found(coll_filter)
+
+# Codec options returning the documents of a query undecoded, so their size can be counted before they are decoded
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+def find_documents(coll, coll_filter, fields):
+    """
+    Returns the list of the documents of coll matching coll_filter (with only the fields, if not None) and their total
+    size in bytes. The documents are fetched undecoded and decoded together, in one call. The size is None for collections
+    that are not pymongo collections (e.g. mongomock's in tests), which are queried normally.
+    """
+    if not isinstance(coll, pymongo.collection.Collection):
+        return list(coll.find(coll_filter, fields)), None
+    data = b''.join([doc.raw for doc in coll.with_options(codec_options=RAW_CODEC_OPTIONS).find(coll_filter, fields)])
+    return bson.decode_all(data), len(data)
+
+def query_fields(projection):
+    # Returns the projection as a list (or None) and the fields document of the mongo query fetching it, without _id
+    if projection is None:
+        return None, None
+    projection = list(projection)
+    return projection, dict({field: 1 for field in projection}, _id=0)
+
+def raise_not_found(coll_filter):
+    print('The below filter was not found within any of the mongo collection.')
+    pprint.pprint(coll_filter)
+    raise Exception('The filter was not found in the mongo collection.')
+
+# The figure apis are written as generators that yield the queries they need (QueryRequests, or lists of QueryRequests that
+# don't depend on each other) and are sent back the results of query_df_from_mongo, a (df, coll_name) tuple or a list of
+# them. figure_api turns such a generator into the plain function (db, id, ...) -> response, which answers the queries
+# itself; async_server.py drives the same generators with a non-blocking mongo client instead
+QueryRequest = namedtuple('QueryRequest', ['coll_filter', 'collections', 'projection'])
+
+def query(coll_filter, collections = AGG_COLLECTION_NAMES, projection = None):
+    # Returns the QueryRequest of query_df_from_mongo(db, coll_filter, collections, projection)
+    return QueryRequest(coll_filter, collections, projection)
+
+def run_figure(db, steps):
+    """
+    Runs a figure generator (see QueryRequest), answering each of its queries with query_df_from_mongo.
+    Returns: the response returned by the generator
+    """
+    results = None
+    while True:
+        try:
+            request = steps.send(results)
+        except StopIteration as stop:
+            return stop.value
+        if isinstance(request, list):
+            results = [query_df_from_mongo(db, *req) for req in request]
+        else:
+            results = query_df_from_mongo(db, *request)
+
+def figure_api(build):
+    """
+    Decorator turning the figure generator function build into the figure api function, which runs it with run_figure.
+    The generator function stays available as the .build attribute of the api function.
+    """
+    @functools.wraps(build)
+    def api_function(db, *args, **kwargs):
+        return run_figure(db, build(db, *args, **kwargs))
+    api_function.build = build
+    return api_function
+
+def fetch(request):
+    # Figure generator that only makes one query, returning its result
+    return (yield request)
+
+def gather_figures(all_steps):
+    """
+    Figure generator running several figure generators side by side: the queries they wait on at the same time are yielded
+    together, so they can be made concurrently.
+    Returns: the list of the responses of the generators
+    """
+    responses = [None]*len(all_steps)
+    sends = {i: None for i in range(len(all_steps))}
+    while len(sends) > 0:
+        requests = {}
+        for i, results in sends.items():
+            try:
+                requests[i] = all_steps[i].send(results)
+            except StopIteration as stop:
+                responses[i] = stop.value
+        if len(requests) == 0:
+            break
+        results = yield list(requests.values())
+        sends = dict(zip(requests, results))
+    return responses
+
+def get_data_version(db):
+    """
+    Returns the version (str) of the data currently loaded in the collections, or None if no load has recorded one.
+    The version changes whenever data_loader.py swaps in or updates the collections.
+    """
+    doc = db.get_db_collection(DB_NAME, DATA_VERSION_COLLECTION).find_one({'_id': 'active'})
+    if doc is None:
+        return None
+    return doc['version']
+
+# The last version read by current_data_version, and when it was read
+data_version_state = {'version': None, 'checked': None}
+
+def current_data_version(db, max_age=DATA_VERSION_TTL):
+    """
+    Returns the active data version like get_data_version, but only reads it from mongo if the last read is older than
+    max_age seconds, so it can be called on every request.
+    """
+    now = time.time()
+    if data_version_state['checked'] is None or now - data_version_state['checked'] > max_age:
+        data_version_state['version'] = get_data_version(db)
+        data_version_state['checked'] = now
+    return data_version_state['version']
+
+# Suffix of the names of the snapshots saved by the servers. They are kept apart from the loader's snapshots, which are
+# keyed on what they were aggregated from (see data_loader.aggregate_ocr_collection)
+SERVED_SNAPSHOT_SUFFIX = '.served'
+
+def load_collection_frame(db, coll_name):
+    """
+    Returns a pd DataFrame of every document (without _id) in the collection coll_name. It is read from a local snapshot
+    matching the active data version (see get_data_version) when there is one: the loader's snapshot of the collection, or
+    the one saved by an earlier server start. Otherwise it is downloaded from mongo and saved as the server's snapshot for
+    the next start.
+    """
+    version = get_data_version(db)
+    for name in [coll_name, coll_name + SERVED_SNAPSHOT_SUFFIX]:
+        df = snapshots.load_snapshot(name, data_version=version)
+        if df is not None:
+            return df
+    df = pd.DataFrame(list(db.get_db_collection(DB_NAME, coll_name).find({}, {'_id': 0})))
+    if version is not None:
+        snapshots.save_snapshot(df, coll_name + SERVED_SNAPSHOT_SUFFIX, data_version=version)
+    return df
+
+def load_aggregated_frame(db, collections = AGG_COLLECTION_NAMES):
+    """
+    Returns a pd DataFrame of every document in the aggregated collections (see load_collection_frame).
+    """
+    return pd.concat([load_collection_frame(db, coll_name) for coll_name in collections], ignore_index=True, sort=False)
 
 def drop_duplicate_courses(df):
     # Get the list of the most popular Course Titles of this course, and trim any entries that arent the most popular course name
@@ -96,9 +234,26 @@ def drop_duplicate_courses(df):
     return
 
 
+# Filters for the documents of a course or an instructor in the current semesters
+def course_filter(uuid):
+    return {'$and':[
+            {"course_uuid":uuid},
+            {"Term Code": {'$in': CURRENT_SEMESTERS}}]}
+
+def instructor_filter(instructor_id):
+    return {'$and':[
+            {"Instructor ID":instructor_id},
+            {"Term Code": {'$in': CURRENT_SEMESTERS}}]}
+
 ###### APIs for Searchby course ########
 
-def CourseFig1Table(db, uuid):
+# Fields used by each figure from the aggregated (or, for _RAW_, the unmodified) collection. These are passed to
+# query_df_from_mongo as projections, so only these fields are fetched
+COURSE_FIG1_FIELDS = ['Instructor ID', 'Term Code', 'Avg Instructor Rating In Section', 'Course Title', 'Subject Code', 'Course Number']
+COURSE_FIG1_INSTRUCTOR_FIELDS = ['Instructor ID', 'course_uuid', 'Term Code', 'Avg Instructor Rating In Section', 'Instructor First Name', 'Instructor Last Name']
+
+@figure_api
+def CourseFig1Table(db, uuid, df=None, coll_name=None):
     '''
     This function will take one validated course-based uuid in the aggregated database and will
     build a json response to present the values needed for figure 1. Briefly, this api response 
@@ -108,35 +263,18 @@ def CourseFig1Table(db, uuid):
     api schema defined in api_schema.py
     Inputs: db - a connection to the mongodb, i.e. db = mongo_driver()
             valid_uuid - a validated uuid from the 'uuid' field in the dataframe
+            df, coll_name (optional) - the result of the course query, if it was already made (see CourseAllFigures)
     Returns: a valid json needed to generate the figure
     '''
     # Construct the json containing necessary data for figure 1 on course page
     ret_json = {"result": {"instructors": []}}
 
-    # filter that we use on the collection
-    coll_filter = {'$and':[
-            {"course_uuid":uuid},
-            {"Term Code": {'$in': CURRENT_SEMESTERS}}]}
-
-    df, coll_name = query_df_from_mongo(db, coll_filter)
+    if df is None:
+        df, coll_name = yield query(course_filter(uuid), projection=COURSE_FIG1_FIELDS)
     drop_duplicate_courses(df)
 
-    # The following is a very crappy way to get a list of unique indices that are in the order of the semesters
-    #######
-    # Define the instructor list
-    instructor_list = list(df.drop_duplicates('Instructor ID', inplace=False)['Instructor ID'])
-    term_code_list = list(df.drop_duplicates(['Instructor ID','Term Code'], inplace=False)['Term Code'])
-
-    # Sort the term code list using prebuilt function
-    term_code_list = sort_by_term_code(term_code_list)
-
-    # Create the dict for this sorted term code list
-    dict_term_list = {k: v for v, k in enumerate(term_code_list)}
-
-    # Add the column as a mapping to the df
-    df['sorter'] = df['Term Code']
-
-    df['sorter'].replace(dict_term_list, inplace=True)
+    # Get the instructors in the order of the semesters they taught the course, most recent first
+    df['sorter'] = -term_calendar.term_ordinal(df['Term Code'])
     df.sort_values('sorter', inplace=True)
     instructor_list = list(df.drop_duplicates('Instructor ID', inplace=False)['Instructor ID'])
 
@@ -145,7 +283,7 @@ def CourseFig1Table(db, uuid):
     {"Instructor ID":{'$in':instructor_list}},
     {"Term Code": {'$in': CURRENT_SEMESTERS}}]}
 
-    df_main, coll_name = query_df_from_mongo(db, coll_filter, collections = [coll_name])
+    df_main, coll_name = yield query(coll_filter, collections = [coll_name], projection=COURSE_FIG1_INSTRUCTOR_FIELDS)
 
     for inst_id in instructor_list:
         # need to average all ratings across all classes taught by each instructor
@@ -154,17 +292,8 @@ def CourseFig1Table(db, uuid):
 
         avg = df_inst['Avg Instructor Rating In Section'].mean()
 
-        # Define a list of the term codes this instructor has taught
-        term_code_list = df_inst[df_inst['course_uuid']==uuid]['Term Code']
-        term_code_list = sort_by_term_code(term_code_list)
-        term_code_list = [SEMESTER_MAPPINGS[str(i)] for i in term_code_list]
-        terms_taught = ''
-        for j in term_code_list:
-            terms_taught += j
-            if j != term_code_list[-1]:
-                terms_taught+=', '
-            else:
-                break
+        # The semesters this instructor has taught the course, e.g. 'Spring 2018, Fall 2017'
+        terms_taught = term_calendar.terms_string(df_inst[df_inst['course_uuid']==uuid]['Term Code'])
 
         inst = {
             "name": str(df_inst["Instructor First Name"].unique()[0] + ' ' + df_inst['Instructor Last Name'].unique()[0]),
@@ -182,13 +311,19 @@ def CourseFig1Table(db, uuid):
                 
     return ret_json
 
-def CourseFig2Chart(db, valid_uuid):
+COURSE_FIG2_FIELDS = ['Term Code', 'Instructor ID', 'Subject Code', 'Course Number', 'Course Title', 'Avg Course Rating', 'Avg Department Rating',
+                      'SD Department Rating', 'Course Rank in Department in Semester', 'Instructor First Name', 'Instructor Last Name',
+                      'Avg Instructor Rating In Section', 'Instructor Enrollment']
+
+@figure_api
+def CourseFig2Chart(db, valid_uuid, uuid_df=None, coll_name=None):
     '''
     This function will build the json for the response to build the relative department rating figure 
     (2nd from top on the left side). The json has structure given in schema.json, for this rating.
 
     Inputs: db - a connection to the mongodb, i.e. db=mongo_driver()
             valid_uuid - a validated uuid from the 'uuid' field in the dataframe
+            uuid_df, coll_name (optional) - the result of the course query, if it was already made (see CourseAllFigures)
     Returns: a valid json needed to generate the figure
     '''
     ##### Initial setup stuff
@@ -197,19 +332,15 @@ def CourseFig2Chart(db, valid_uuid):
         return {'name':str(last_name)+' '+str(first_name), 'instructor mean in course':float(mean_in_course), 
                 'semester':str(semester_taught), 'enrollment':int(enrollment)}
 
-    # Define a cursor with which to query mongo
-    cursor = {'$and':[
-    {"course_uuid":valid_uuid},
-    {"Term Code": {'$in': CURRENT_SEMESTERS}}]}
-
-    uuid_df, coll_name = query_df_from_mongo(db, cursor)
+    if uuid_df is None:
+        uuid_df, coll_name = yield query(course_filter(valid_uuid), projection=COURSE_FIG2_FIELDS)
     drop_duplicate_courses(uuid_df)
 
     # Make sure that the df is unique wrt Term Code and instructor
     uuid_df.drop_duplicates(subset=['Term Code', 'Instructor ID'], inplace=True)
 
     # Start by finding the most recent appearance of the course
-    sem = sort_by_term_code(list(uuid_df['Term Code']))[0]
+    sem = term_calendar.sort_terms(uuid_df['Term Code'])[0]
 
     # Drop any from uuid that arent from the most recent semester
     uuid_df = uuid_df[(uuid_df['Term Code']==sem)]
@@ -226,12 +357,11 @@ def CourseFig2Chart(db, valid_uuid):
     ## Get the instructor details
     # Build a dictionary based on the instructors that have taught the course  
     # Fill out the instructors list with entries from the uuid_df
-    instructors = []
-    for i in uuid_df.index:
-        # Add a new list entry to instructors for each instructor in the df
-        instructors.append(instructor(uuid_df.at()[i,'Instructor First Name'], uuid_df.at()[i,'Instructor Last Name'], 
-            uuid_df.at()[i,'Avg Instructor Rating In Section'], SEMESTER_MAPPINGS[str(uuid_df.at()[i,'Term Code'])],
-            uuid_df.at()[i, 'Instructor Enrollment']))
+    # All of the rows are from the most recent semester
+    sem_label = term_calendar.term_label(sem)
+    instructors = [instructor(first_name, last_name, mean_in_course, sem_label, enrollment)
+                   for first_name, last_name, mean_in_course, enrollment in zip(uuid_df['Instructor First Name'],
+                   uuid_df['Instructor Last Name'], uuid_df['Avg Instructor Rating In Section'], uuid_df['Instructor Enrollment'])]
     # Reverse Instructors
     instructors = list(reversed(instructors))
     # Get the course ranking for the department from the uuid
@@ -240,7 +370,7 @@ def CourseFig2Chart(db, valid_uuid):
             {"Term Code":sem}]}
 
     # Find all courses with given subject in ag_df
-    subj_df, coll_name = query_df_from_mongo(db, subj_filter, collections = [coll_name])
+    subj_df, coll_name = yield query(subj_filter, collections = [coll_name], projection=['Course Number'])
 
     # Sort out the repeat courses such that we only get a single entry for course rating
     # Get the number of unique courses in a given department
@@ -248,7 +378,7 @@ def CourseFig2Chart(db, valid_uuid):
     
     # Build the json response
     response = {'result':{'course name':str(cname),
-            'most recent sem': SEMESTER_MAPPINGS[str(sem)],
+            'most recent sem': sem_label,
             'course number': int(cnum),
             'course ranking': int(crank), 
                           'dept':{'dept name': str(subj), 'courses in dept': int(num_courses) , 'dept mean': float(dept_mean), 'dept sd':float(dept_sd)}, 
@@ -256,148 +386,122 @@ def CourseFig2Chart(db, valid_uuid):
                           'instructors':instructors}}
     return response
 
-def CourseFig3Timeseries(db, valid_uuid):
+COURSE_FIG3_FIELDS = ['Course Number', 'Course Title', 'Term Code', 'Subject Code', 'Avg Course Rating', 'Avg Department Rating', 'Instructor ID',
+                      'Instructor First Name', 'Instructor Last Name', 'Avg Instructor Rating In Section']
+
+@figure_api
+def CourseFig3Timeseries(db, valid_uuid, df=None, coll_name=None):
 
     """
     This function will search for all courses that have occurred in the given timespan. It will then
     return the average course rating over time and the average department rating over this time scale (from pre-computed values),
     along with a list of instructors who have taught on this timescale and their ratings over their semesters taught
+    df, coll_name (optional) are the result of the course query, if it was already made (see CourseAllFigures)
     
     """
     response = {'result':{'course over time':{}, 'dept over time':{}, 'instructors':[]}}
 
-    # filter that we use on the collection
-    coll_filter = {'$and':[
-            {"course_uuid":valid_uuid},
-            {"Term Code": {'$in': CURRENT_SEMESTERS}}]}
-
-    df, coll_name = query_df_from_mongo(db, coll_filter)
+    if df is None:
+        df, coll_name = yield query(course_filter(valid_uuid), projection=COURSE_FIG3_FIELDS)
     drop_duplicate_courses(df)
 
     # Fill the course number and name in the response
     response['result']['course number']=int(df['Course Number'].unique()[0])
     response['result']['course over time'] = {'ratings':[],'course name':df['Course Title'].unique()[0]}
 
-    # Fill in the semesters that the course was found, in order of term
-    term_codes = list(df['Term Code'].unique())
-
-    term_codes = sort_by_term_code(term_codes)
-    term_codes.reverse() # Reverse so that when they're appended in order
+    # Fill in the semesters that the course was found, in order of term (oldest first)
+    term_codes = term_calendar.sort_terms(df['Term Code'], recent_first=False)
 
-    terms = [SEMESTER_MAPPINGS[str(term)] for term in term_codes]
+    terms = term_calendar.term_label(term_codes).tolist()
     response['result']['course over time']['semesters'] = terms
     response['result']['dept over time'] = {'dept name': df['Subject Code'].unique()[0],'ratings':[],'semesters': terms}
 
-    # Add in the course rating and dept ratings
-    for tcode in term_codes:
-        response['result']['course over time']['ratings'].append(list(df[(df['Term Code']==tcode)]['Avg Course Rating'])[0])
-        response['result']['dept over time']['ratings'].append(list(df[(df['Term Code']==tcode)]['Avg Department Rating'])[0])
+    # Add in the course rating and dept ratings, from the first row of each term
+    term_df = df.drop_duplicates('Term Code').set_index('Term Code').loc[term_codes]
+    response['result']['course over time']['ratings'] = term_df['Avg Course Rating'].tolist()
+    response['result']['dept over time']['ratings'] = term_df['Avg Department Rating'].tolist()
 
-    # # Add in the instructors
-    for i in df['Instructor ID'].unique():
-        sub_df = df[(df['Instructor ID']==i)]
+    # # Add in the instructors, with the first row of each of their terms in the order they appear
+    instr_df = df.drop_duplicates(['Instructor ID', 'Term Code'])
+    instr_df = instr_df.assign(semester=term_calendar.term_label(instr_df['Term Code']))
+    for i, sub_df in instr_df.groupby('Instructor ID', sort=False):
         instr_obj = {}
-        instr_obj['name'] = sub_df['Instructor First Name'].unique()[0] + ' ' + sub_df['Instructor Last Name'].unique()[0]
-        instr_obj['semesters']=[]
-        instr_obj['ratings'] = []
-        for j in sub_df['Term Code'].unique():
-            instr_obj['semesters'].append(SEMESTER_MAPPINGS[str(j)])
-            instr_obj['ratings'].append(list(sub_df[(sub_df['Term Code']==j)]['Avg Instructor Rating In Section'])[0])
+        instr_obj['name'] = sub_df['Instructor First Name'].iloc[0] + ' ' + sub_df['Instructor Last Name'].iloc[0]
+        instr_obj['semesters'] = sub_df['semester'].tolist()
+        instr_obj['ratings'] = sub_df['Avg Instructor Rating In Section'].tolist()
         response['result']['instructors'].append(instr_obj)
-    return response # Added this bit to get rid of int64s, which are not JSON serializable
+    return response
+
+COURSE_FIG4_FIELDS = ['Term Code', 'Instructor ID', 'Subject Code', 'Course Number', 'Course Title']
+COURSE_FIG4_RAW_FIELDS = ['Term Code', 'Instructor ID', 'Section Title', 'Instructor First Name', 'Instructor Last Name', 'Question', 'Mean', 'Responses']
 
-def CourseFig4TableBar(db, valid_uuid):
+@figure_api
+def CourseFig4TableBar(db, valid_uuid, df=None, coll_name=None):
 
     """
     This function will perform the following steps:
     1. take a db connection and a uuid and then find the uuid in the aggregated db collection
     2. Get lists of the course number, subject code, instructors, and term codes for the course appearances in the time period of interest
-    3. Search in the non-aggregated db for the same course number, subject code, and instructors
-    4. Aggregate the entries by professor and question number, if the professor doesnt have an entry giving them a '0' rating
+    3. Look up the same course offerings (course, instructor and term) in the non-aggregated db by their offering keys
+    4. Aggregate the entries by professor and question number in one pivot table, if the professor doesnt have an entry giving them a '0' rating
     5. Convert the dataframe into a json and serve
+    df, coll_name (optional) are the result of the course query of step 1, if it was already made (see CourseAllFigures)
     
     """
         # Construct the json containing necessary data for figure 1 on course page
     response = {"result": {"instructors": [], 'questions':[]}}
 
-    # filter that we use on the collection
-    coll_filter = {'$and':[
-            {"course_uuid":valid_uuid},
-            {"Term Code": {'$in': CURRENT_SEMESTERS}}]}
-
-    df, coll_name = query_df_from_mongo(db, coll_filter)
+    if df is None:
+        df, coll_name = yield query(course_filter(valid_uuid), projection=COURSE_FIG4_FIELDS)
     drop_duplicate_courses(df)
 
     # Now we need to drop the duplicates and only take columns of interest
     df = df.drop_duplicates(['Term Code', 'Instructor ID'])[['Term Code','Instructor ID','Subject Code', 'Course Number', 'Course Title']]
     df = df.rename(columns = {'Instructor ID':'Instructor ID', 'Course Title':'Section Title'})
 
-    # Build a cursor to search the full db collection for these conditions
-    # Build it based on each row in the df
-    full_db_filter = {'$or':[]}
-    for i in range(len(df)):
-        # Create the row filter
-        row_filter = {'$and':[]}
-        for col in list(df.columns):
-            if col in ['Instructor ID','Term Code','Course Number']:
-                row_filter['$and'].append({col : int(df.iloc[i][col])}) # Encode the query as utf-8
-            else:
-                row_filter['$and'].append({col : str(df.iloc[i][col])}) # Encode the query as utf-8
-
-        # Add row filter to full db filter
-        full_db_filter['$or'].append(row_filter)
+    # Look up the raw documents of each (course, instructor, term) offering by its key
+    keys = offering_keys(df.assign(course_uuid=valid_uuid)).tolist()
+    raw_df, coll_name = yield query({OFFERING_KEY: {'$in': keys}}, collections=COLLECTION_NAMES, projection=COURSE_FIG4_RAW_FIELDS)
 
-    # Use the filter to query the non-aggregated db
-    full_db_coll_name = coll_name[11:] # This takes 'aggregated_GCOE' => GCOE
-
-    # Use the database query to pull needed data
-    df, coll_name = query_df_from_mongo(db, full_db_filter, collections=COLLECTION_NAMES)
+    # Only keep the sections under the title of the offering
+    offerings = pd.MultiIndex.from_frame(df[['Term Code', 'Instructor ID', 'Section Title']])
+    df = raw_df[pd.MultiIndex.from_frame(raw_df[['Term Code', 'Instructor ID', 'Section Title']]).isin(offerings)].copy()
 
     # Get the list of unique instructors
-    instr_ids= list(df['Instructor ID'].unique())
-    instrs = []
-    for i in instr_ids:
-        instrs.append(df[(df['Instructor ID']==i)].iloc[0]['Instructor First Name'] + ' ' + df[(df['Instructor ID'] == i)].iloc[0]['Instructor Last Name'])
-    response['result']['instructors'] = instrs
+    instr_df = df.drop_duplicates('Instructor ID')
+    instr_ids = instr_df['Instructor ID'].tolist()
+    response['result']['instructors'] = (instr_df['Instructor First Name'] + ' ' + instr_df['Instructor Last Name']).tolist()
 
-    # Get the list of unique question
+    # Response weighted mean of each question (rows) for each instructor (columns), 0 if the instructor has no responses to it
     questions = list(df['Question'].unique())
-    tot_responses = 0
-    tot_weighted_mean_responses = 0
-    for q in questions:
-        q_ratings = []
-        sub_df = df[(df['Question']==q)]
-        for iD in instr_ids:
-            sub_sub_df = sub_df[(sub_df['Instructor ID']==iD)]
-            if len(sub_sub_df)==0:
-                q_ratings.append(0)
-            else:
-                weighted_means = sub_sub_df['Mean']*sub_sub_df['Responses']
-                wms = weighted_means.sum()
-                rs = sub_sub_df['Responses'].sum()
-                tot_weighted_mean_responses+=wms
-                tot_responses+=rs
-                q_ratings.append(round(wms/rs, 4))
-                # Ya Yeet
-            del sub_sub_df
+    df['Weighted Mean'] = df['Mean']*df['Responses']
+    table = df.pivot_table(index='Question', columns='Instructor ID', values=['Weighted Mean', 'Responses'], aggfunc='sum')
+    table = table.reindex(index=questions, columns=pd.MultiIndex.from_product([['Weighted Mean', 'Responses'], instr_ids]))
+    ratings = (table['Weighted Mean']/table['Responses']).round(4).astype(object).where(table['Responses'].notnull(), 0)
+    for q, q_ratings in zip(questions, ratings.values.tolist()):
         response['result']['questions'].append({'question':q, 'ratings':q_ratings})
-    response['result']['avg_rating'] = tot_weighted_mean_responses/tot_responses
+    response['result']['avg_rating'] = df['Weighted Mean'].sum()/df['Responses'].sum()
 
     return response
 
 ###### APIs for Searchby instructor ########
 
-def InstructorChipAPI(db, instructor_id):
+INSTRUCTOR_CHIP_FIELDS = ['Term Code', 'Subject Code', 'Instructor First Name', 'Instructor Last Name']
+
+@figure_api
+def InstructorChipAPI(db, instructor_id, df=None):
     """
     This function takes a db connection and instructor_id and returns a dict containing the number of years that the 
     instructor has taught at OU, the most recent semester taught, and a list of departments that the instructor has taught within.
+    df (optional) is the result of the query for all of the instructor's documents, if it was already made (see InstructorAllFigures)
     """
-    coll_filter = {"Instructor ID":instructor_id}
-    df, _ = query_df_from_mongo(db,coll_filter)
+    if df is None:
+        coll_filter = {"Instructor ID":instructor_id}
+        df, _ = yield query(coll_filter, projection=INSTRUCTOR_CHIP_FIELDS)
 
     # Get the oldest term code and convert it to a term
     term_codes = list(df['Term Code'].unique())
-    oldest_term = SEMESTER_MAPPINGS[str(sort_by_term_code(term_codes)[-1])]
+    oldest_term = term_calendar.term_label(term_calendar.sort_terms(term_codes)[-1])
 
     # Get the number of years teaching as a function of oldest term
     this_year = datetime.today().year
@@ -413,34 +517,27 @@ def InstructorChipAPI(db, instructor_id):
     result = {'result':{'name': instr_name, 'most_recent_semester': oldest_term, 'num_years':diff, 'depts_taught':subject_list}}
     return result
 
+INSTRUCTOR_FIG1_FIELDS = ['course_uuid', 'Term Code', 'Instructor First Name', 'Instructor Last Name']
+INSTRUCTOR_FIG1_COURSE_FIELDS = ['course_uuid', 'Instructor ID', 'Term Code', 'Avg Instructor Rating In Section', 'Course Title', 'Course Number', 'Subject Code']
+
 #Feel free to rename this, just keeping it explicit so its easy to find
-def InstructorFig1Table(db, instructor_id):
+@figure_api
+def InstructorFig1Table(db, instructor_id, df=None, coll_name=None):
     """
     This will take in the name of an instructor, and return a dictionary containing all
     of the courses taught by this instructor.
     The courses will be returned with the dept name, course number, course name, specific course rating, and term
+    df, coll_name (optional) are the result of the instructor query, if it was already made (see InstructorAllFigures)
     """
     # Construct the json containing necessary data for figure 1 on course page
     ret_json = {"result": {"courses": []}}
 
-    # filter that we use on the collection
-    coll_filter = {'$and':[
-            {"Instructor ID":instructor_id},
-            {"Term Code": {'$in': CURRENT_SEMESTERS}}]}
-
-    df, coll_name = query_df_from_mongo(db, coll_filter)
+    if df is None:
+        df, coll_name = yield query(instructor_filter(instructor_id), projection=INSTRUCTOR_FIG1_FIELDS)
     course_list = list(df.drop_duplicates('course_uuid', inplace=False)['course_uuid'])
 
-    # Get a list of unique courses that are in the order of the semesters
-    # Sort the term code list using prebuilt function
-    term_code_list = sort_by_term_code(list(df.drop_duplicates(['course_uuid','Term Code'], inplace=False)['Term Code']))
-
-    # Create the dict for this sorted term code list
-    dict_term_list = {k: v for v, k in enumerate(term_code_list)}
-
-    # Add the column as a mapping to the df
-    df['sorter'] = df['Term Code']
-    df['sorter'].replace(dict_term_list, inplace=True)
+    # Get a list of unique courses that are in the order of the semesters, most recent first
+    df['sorter'] = -term_calendar.term_ordinal(df['Term Code'])
     df.sort_values('sorter', inplace=True)
     course_list = list(df.drop_duplicates('course_uuid', inplace=False)['course_uuid'])
 
@@ -449,24 +546,15 @@ def InstructorFig1Table(db, instructor_id):
     {"course_uuid":{'$in':course_list}},
     {"Term Code": {'$in': CURRENT_SEMESTERS}}]}
 
-    df_main, coll_name = query_df_from_mongo(db, coll_filter, collections = [coll_name])
+    df_main, coll_name = yield query(coll_filter, collections = [coll_name], projection=INSTRUCTOR_FIG1_COURSE_FIELDS)
 
     for crs in course_list:
         df_crs = df_main[(df_main['course_uuid']==crs)] # Made df_crs once and then slice it for each instructor
 
         avg = df_crs['Avg Instructor Rating In Section'].mean()
 
-        # Define a list of the term codes this instructor has taught
-        term_code_list = df_crs[df_crs['Instructor ID']==instructor_id]['Term Code']
-        term_code_list = sort_by_term_code(term_code_list)
-        term_code_list = [SEMESTER_MAPPINGS[str(i)] for i in term_code_list]
-        terms_taught = ''
-        for j in term_code_list:
-            terms_taught += j
-            if j != term_code_list[-1]:
-                terms_taught+=', '
-            else:
-                break
+        # The semesters this instructor has taught the course, e.g. 'Spring 2018, Fall 2017'
+        terms_taught = term_calendar.terms_string(df_crs[df_crs['Instructor ID']==instructor_id]['Term Code'])
         inst = {
             "course name": df_crs['Course Title'].unique()[0],
             'course number': int(df_crs['Course Number'].unique()[0]),
@@ -482,13 +570,18 @@ def InstructorFig1Table(db, instructor_id):
                 
     return ret_json
 
-def InstructorFig2Timeseries(db, instructor_id):
+INSTRUCTOR_FIG2_FIELDS = ['Term Code', 'Instructor First Name', 'Instructor Last Name', 'Avg Instructor Rating In Section', 'Course Title', 'Subject Code']
+INSTRUCTOR_FIG2_DEPT_FIELDS = ['Subject Code', 'Term Code', 'Avg Instructor Rating In Section']
+
+@figure_api
+def InstructorFig2Timeseries(db, instructor_id, df=None, coll_name=None):
     """
     This will take in the name of an instructor, and return a dictionary containing the following:
     Instructor Name - First and Last name
     Instructor over time - Semesters taught, and their respective avg ratings
     Dept over time - dept name, same semesters as above, dept avg rating for these semesters
     Courses - name of course, semesters taught, and respective avg ratings
+    df, coll_name (optional) are the result of the instructor query, if it was already made (see InstructorAllFigures)
     """
     # Construct the json containing necessary data for figure 2 on instructor page
     ret_json = {'result':
@@ -504,107 +597,49 @@ def InstructorFig2Timeseries(db, instructor_id):
                     }
                 }
 
-    # filter that we use on the collection
-    coll_filter = {'$and':[
-            {"Instructor ID":instructor_id},
-            {"Term Code": {'$in': CURRENT_SEMESTERS}}]}
-
-    df, coll_name = query_df_from_mongo(db, coll_filter)
-
-    # get a dict containing all current semesters that have been taught by this dude as keys, values are gonna be total rating
-    semesters_taught = {}
+    if df is None:
+        df, coll_name = yield query(instructor_filter(instructor_id), projection=INSTRUCTOR_FIG2_FIELDS)
 
-    # this is gonna have current semesters taught as keys, and value is gonna be the amount of courses taught in that semester
-    # I know this is mem-inefficient, will optimize later after demo
-    semester_totals = {}
+    # The instructor name comes from the first document of the query
+    ret_json["result"]["instructor name"] = df["Instructor First Name"].iloc[0] + " " + df["Instructor Last Name"].iloc[0]
 
-    # used to keep track of which courses have already been added to the return json
-    courses = []
-
-    # used to keep track of which departments this professor has taught in
-    departments = []
-
-    # Sort the df by term code
-    sorted_list_terms = sort_by_term_code(set(list(df['Term Code'])))
-
-    # Create the dict for this sorted term code list
-    dict_term_list = {k: v for v, k in enumerate(sorted_list_terms)}
-
-    # Add the column as a mapping to the df
-    df['sorter'] = df['Term Code']
-    instructor_list_ind = df['sorter'].replace(dict_term_list, inplace=True)
+    # Sort the df by term code (oldest first), and label the semesters
+    df['sorter'] = -term_calendar.term_ordinal(df['Term Code'])
     df.sort_values(by=['sorter'], ascending=False,inplace=True)
-
-    for index, row in df.iterrows():
-        # set instructor name on first iteration
-        if index == 0:
-            ret_json["result"]["instructor name"] = row["Instructor First Name"] + " " + row["Instructor Last Name"]
-
-        # instructor over time block
-        if SEMESTER_MAPPINGS[str(row["Term Code"])] not in semesters_taught:
-            semesters_taught[SEMESTER_MAPPINGS[str(row["Term Code"])]] = row["Avg Instructor Rating In Section"]
-            semester_totals[SEMESTER_MAPPINGS[str(row["Term Code"])]] = 1
-        else:
-            semesters_taught[SEMESTER_MAPPINGS[str(row["Term Code"])]] += row["Avg Instructor Rating In Section"]
-            semester_totals[SEMESTER_MAPPINGS[str(row["Term Code"])]] += 1
-
-        # courses block
-        if row["Course Title"] not in courses:
-            courses.append(row["Course Title"])
-            ret_json["result"]["courses"].append({"name": row["Course Title"], 
-                                                    "semesters": [SEMESTER_MAPPINGS[str(row["Term Code"])]],
-                                                    "ratings": [row["Avg Instructor Rating In Section"]]})
-        else:
-            for i in range(0, len(ret_json["result"]["courses"])):
-                if ret_json["result"]["courses"][i]["name"] == row["Course Title"]:
-                    ret_json["result"]["courses"][i]["semesters"].append(SEMESTER_MAPPINGS[str(row["Term Code"])])
-                    ret_json["result"]["courses"][i]["ratings"].append(row["Avg Instructor Rating In Section"])
-
-        if row["Subject Code"] not in departments:
-            departments.append(row["Subject Code"])
-
-
-    # Now we use this complex averaging algorithm to get semesterly average ratings, add to ret_json
-    for key, value in semesters_taught.items():
-        semesters_taught[key] = value / semester_totals[key]
-        ret_json["result"]["instructor over time"]["semesters"].append(key)
-        ret_json["result"]["instructor over time"]["ratings"].append(semesters_taught[key])
-
-    # Now we need a new data frame for the entire department
+    df['semester'] = term_calendar.term_label(df['Term Code'])
+
+    # Instructor over time block: the average rating of each semester taught, oldest first
+    instructor_by_term = df.groupby('Term Code', sort=False)["Avg Instructor Rating In Section"].mean()
+    semesters = term_calendar.term_label(instructor_by_term.index).tolist()
+    ret_json["result"]["instructor over time"]["semesters"] = semesters
+    ret_json["result"]["instructor over time"]["ratings"] = instructor_by_term.tolist()
+
+    # Courses block: every semester and rating of each course (by title), in the order the courses were first taught
+    for title, course_df in df.groupby("Course Title", sort=False):
+        ret_json["result"]["courses"].append({"name": title,
+                                              "semesters": course_df['semester'].tolist(),
+                                              "ratings": course_df["Avg Instructor Rating In Section"].tolist()})
+
+    # Now we need the department (of the first course taught) in the semesters the instructor taught
+    dept_name = df["Subject Code"].iloc[0]
+    taught_terms = [term for term in instructor_by_term.index.tolist() if term in CURRENT_SEMESTERS]
     coll_filter = {'$and':[
-            {"Subject Code": departments[0]},
-            {"Term Code": {'$in': CURRENT_SEMESTERS}}]}
+            {"Subject Code": dept_name},
+            {"Term Code": {'$in': taught_terms}}]}
 
-    df, coll_name = query_df_from_mongo(db, coll_filter)
-
-    # construct dictionaries where keys are current semesters in which professor taught, and value is total rating for all courses/course count
-    dept = {}
-    count = {}
-    for key in semesters_taught.keys():
-        dept[key] = 0
-        count[key] = 0
-
-    for index, row in sorted(df.iterrows(), reverse=True):
-        # set dept name on first iteration
-        if index == 0:
-            ret_json["result"]["dept over time"]["dept name"] = row["Subject Code"]
-
-        # ratings block
-        if SEMESTER_MAPPINGS[str(row["Term Code"])] in dept.keys():
-            dept[SEMESTER_MAPPINGS[str(row["Term Code"])]] += row["Avg Instructor Rating In Section"]
-            count[SEMESTER_MAPPINGS[str(row["Term Code"])]] += 1
-
-    # average dept semesterly ratings and add to ret_json
-    for key, value in dept.items():
-        if count[key]!=0:
-            dept[key] = value / count[key]
-        else:
-            dept[key] = 0
-        ret_json["result"]["dept over time"]["semesters"].append(key)
-        ret_json["result"]["dept over time"]["ratings"].append(dept[key])
+    dept_df, coll_name = yield query(coll_filter, projection=INSTRUCTOR_FIG2_DEPT_FIELDS)
+    dept_by_term = dept_df.groupby('Term Code')["Avg Instructor Rating In Section"].mean()
+
+    # average dept semesterly ratings (0 for semesters without any) and add to ret_json
+    ret_json["result"]["dept over time"]["dept name"] = dept_name
+    ret_json["result"]["dept over time"]["semesters"] = list(semesters)
+    ret_json["result"]["dept over time"]["ratings"] = [dept_by_term.get(term, 0) for term in instructor_by_term.index]
 
     return ret_json
 
+INSTRUCTOR_FIG3_RAW_FIELDS = ['Subject Code', 'Course Number', 'Section Title', 'Question', 'Mean', 'Responses', 'Instructor First Name', 'Instructor Last Name']
+
+@figure_api
 def InstructorFig3TableBar(db, instructor_id):
     # Construct the json dictionary containing the necessary information for figure 3
     ret_json = {'result':{
@@ -619,7 +654,7 @@ def InstructorFig3TableBar(db, instructor_id):
             {"Instructor ID":instructor_id},
             {"Term Code": {'$in': CURRENT_SEMESTERS}}]}
 
-    df, coll_name = query_df_from_mongo(db, coll_filter, collections=COLLECTION_NAMES)
+    df, coll_name = yield query(coll_filter, collections=COLLECTION_NAMES, projection=INSTRUCTOR_FIG3_RAW_FIELDS)
 
     # total rating and count to be used for avg_rating
     total_rating = 0
@@ -663,10 +698,48 @@ def InstructorFig3TableBar(db, instructor_id):
 
     return ret_json
 
+###### Composite APIs ########
+
+# Fields of the shared queries of the composite APIs: every field used by the figures built from them
+COURSE_ALL_FIELDS = list(dict.fromkeys(COURSE_FIG1_FIELDS + COURSE_FIG2_FIELDS + COURSE_FIG3_FIELDS + COURSE_FIG4_FIELDS))
+INSTRUCTOR_ALL_FIELDS = list(dict.fromkeys(INSTRUCTOR_CHIP_FIELDS + INSTRUCTOR_FIG1_FIELDS + INSTRUCTOR_FIG2_FIELDS))
+
+@figure_api
+def CourseAllFigures(db, uuid):
+    """
+    This function will build the responses of all of the course figures (figure1 - figure4) for one course. The course
+    documents are queried once and shared by the figures, instead of once per figure.
+    Returns: {'result': {'figure1': ..., 'figure2': ..., 'figure3': ..., 'figure4': ...}}, with the 'result' of each figure api
+    """
+    df, coll_name = yield query(course_filter(uuid), projection=COURSE_ALL_FIELDS)
+    # Each figure modifies its frame, so each gets its own copy. The figures run side by side, so their own queries are made together
+    figures = {'figure1': CourseFig1Table, 'figure2': CourseFig2Chart, 'figure3': CourseFig3Timeseries, 'figure4': CourseFig4TableBar}
+    responses = yield from gather_figures([func.build(db, uuid, df.copy(), coll_name) for func in figures.values()])
+    return {'result': {name: response['result'] for name, response in zip(figures, responses)}}
+
+@figure_api
+def InstructorAllFigures(db, instructor_id):
+    """
+    This function will build the responses of all of the instructor figures (chip, figure1 - figure3) for one instructor.
+    The instructor's documents are queried once; the chip uses all of them and figures 1 and 2 the ones from the current semesters.
+    Returns: {'result': {'chip': ..., 'figure1': ..., 'figure2': ..., 'figure3': ...}}, with the 'result' of each figure api
+    """
+    # Figure 3 uses the unmodified collection, so it runs alongside the shared query
+    (df, coll_name), figure3 = yield from gather_figures([fetch(query({"Instructor ID":instructor_id}, projection=INSTRUCTOR_ALL_FIELDS)),
+                                                          InstructorFig3TableBar.build(db, instructor_id)])
+    current_df = df[df['Term Code'].isin(CURRENT_SEMESTERS)].reset_index(drop=True)
+    if len(current_df) == 0:
+        print('The instructor '+str(instructor_id)+' has no documents in the current semesters.')
+        raise Exception('The filter was not found in the mongo collection.')
+    chip, figure1, figure2 = yield from gather_figures([InstructorChipAPI.build(db, instructor_id, df.copy()),
+                                                        InstructorFig1Table.build(db, instructor_id, current_df.copy(), coll_name),
+                                                        InstructorFig2Timeseries.build(db, instructor_id, current_df.copy(), coll_name)])
+    return {'result': {'chip': chip['result'], 'figure1': figure1['result'], 'figure2': figure2['result'], 'figure3': figure3['result']}}
+
 ######################
 
 # Define the function to pull all of the courses or instructors as a dict of labels and values
-def SearchAutocomplete(db, search_type='course'):
+def SearchAutocomplete(db, search_type='course', ag_df=None):
     """
     This function will return a dict object of courses or instructors, depending upon the search type. Each object in dict will
     have a label (Professor name, first then last, if instructor, otherwise long course string) and a value (instructor id if 
@@ -675,10 +748,14 @@ def SearchAutocomplete(db, search_type='course'):
     Input:
     db - a connection to the mongoDB
     search_type - a string, either 'course' or 'instructor'
+    ag_df (optional) - the aggregated data as a pd DataFrame (see load_aggregated_frame), used instead of querying mongo
 
     """
     # Create a map to map search type inputs to keys in the dataframe
     search_type_to_key = {'course':'course_uuid', 'instructor':'Instructor ID'}
+    # and the fields used for the labels of each search type
+    search_type_to_fields = {'course':['course_uuid', 'Subject Code', 'Course Number', 'Course Title'],
+                             'instructor':['Instructor ID', 'Instructor First Name', 'Instructor Last Name']}
 
     # Make sure the search_type is valid
     try:
@@ -689,28 +766,27 @@ def SearchAutocomplete(db, search_type='course'):
     # filter that we use on the collection
     coll_filter = {"Term Code": {'$in': CURRENT_SEMESTERS}}
     
-    df = pd.DataFrame()
-    for coll_name in AGG_COLLECTION_NAMES:
-        coll = db.get_db_collection(DB_NAME, coll_name)
-        # Use the database query to pull needed data
-        cursor = coll.find(coll_filter)
-        # For whatever reason, generating a dataframe clears the cursor, so get population here
-        population = coll.count_documents(coll_filter)
-        # This assumes that there will be no same uuid's across the different collections, e.g. the same uuid in GCOE and JRCOE
-        if population > 0:
-            df_coll = pd.DataFrame(list(cursor))
-            df_coll.drop_duplicates(search_key, inplace=True)
-            df = pd.concat([df, df_coll], ignore_index=True, sort=True)
+    if ag_df is not None:
+        df = ag_df[ag_df['Term Code'].isin(CURRENT_SEMESTERS)].copy()
+    else:
+        df = pd.DataFrame()
+        for coll_name in AGG_COLLECTION_NAMES:
+            coll = db.get_db_collection(DB_NAME, coll_name)
+            # Use the database query to pull needed data
+            df_coll = pd.DataFrame(list(coll.find(coll_filter, dict({field: 1 for field in search_type_to_fields[search_type]}, _id=0))))
+            # This assumes that there will be no same uuid's across the different collections, e.g. the same uuid in GCOE and JRCOE
+            if len(df_coll) > 0:
+                df_coll.drop_duplicates(search_key, inplace=True)
+                df = pd.concat([df, df_coll], ignore_index=True, sort=True)
     df.drop_duplicates(search_key, inplace=True)
 
     # Now, we just need to convert the dataframe to a dictionary with needed form for search autocomplete
     if search_type == 'course':
         # Create the label column
-        df['label'] = df['Subject Code'].str.strip()+df['Course Number'].astype(str)+': '+df['Course Title']
-        return_list = [{'label':row['label'], 'value':row[search_key]} for index, row in df.iterrows()]
+        labels = df['Subject Code'].str.strip()+df['Course Number'].astype(str)+': '+df['Course Title']
     else:
-        df['label'] = df['Instructor First Name']+' '+ df['Instructor Last Name']
-        return_list = [{'label':row['label'], 'value':row[search_key]} for index, row in df.iterrows()]
+        labels = df['Instructor First Name']+' '+ df['Instructor Last Name']
+    return_list = [{'label':label, 'value':value} for label, value in zip(labels.tolist(), df[search_key].tolist())]
     return return_list
 
 if __name__ == '__main__':
@@ -0,0 +1,198 @@
+'''
+This script contains the asyncio version of server.py, serving the same endpoints from one event loop with a non-blocking
+mongo client (motor), so a worker waiting on mongo keeps serving other requests. Run it with an ASGI server, e.g.
+
+    hypercorn -b 0.0.0.0:5050 async_server:app
+
+The figure apis of api_functions.py are generators that yield their queries (see api_functions.QueryRequest). Here each
+step of a figure generator, i.e. its pandas work, runs in a bounded thread pool, while its queries are awaited on the event
+loop; the queries a figure yields together (e.g. those of the figures of the composite 'all' endpoints) are made concurrently.
+Figures served by a pushdown pipeline (see pushdown.py), the data version reads and the search index rebuilds are blocking,
+so they run in the thread pool as well.
+
+The search lists, response cache and data version are the ones of server.py, which is imported for them.
+'''
+
+# global/pypi
+import os
+import bson
+import asyncio
+import functools
+import contextvars
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from quart import Quart, jsonify, request, Response
+
+# local
+import server
+import api_functions as api
+import metrics
+from mongo import mongo_driver, async_mongo_driver
+from payloads import payload_response
+from search_index import search, DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT
+
+# Number of threads running the pandas work of the figures (and the other blocking calls)
+ASYNC_WORKERS = int(os.environ.get('ASYNC_WORKERS', os.cpu_count() or 1))
+
+base_api_route = server.base_api_route
+executor = ThreadPoolExecutor(max_workers=ASYNC_WORKERS)
+
+app = Quart(__name__)
+
+# The motor connection, opened on the event loop of the server when it starts. It stays None when the storage backend
+# isn't mongo (e.g. STORAGE_BACKEND=sqlite), in which case the queries are made by the blocking driver in the thread pool
+async_db = None
+
+@app.before_serving
+async def connect():
+    global async_db
+    storage_db = server.db.db if hasattr(server.db, 'holds') else server.db
+    if isinstance(storage_db, mongo_driver):
+        async_db = async_mongo_driver()
+
+@app.after_request
+async def allow_any_origin(response):
+    # Same as flask_cors' CORS(app) in server.py
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+async def run_blocking(func, *args):
+    # Runs func(*args) in the thread pool, in the context of the caller, so its stages are timed in the request's metrics
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(executor, functools.partial(context.run, func, *args))
+
+async def query_df_async(coll_filter, collections = api.AGG_COLLECTION_NAMES, projection = None):
+    """
+    Same as api_functions.query_df_from_mongo, with the documents fetched by motor. Collections held in memory by a
+    ServingEngine (SERVING_ENGINE=memory), and those of a storage backend other than mongo, are queried by
+    api_functions.query_df_from_mongo in the thread pool.
+    """
+    if async_db is None or (hasattr(server.db, 'query_df') and server.db.holds(collections)):
+        return await run_blocking(api.query_df_from_mongo, server.db, coll_filter, collections, projection)
+    projection, fields = api.query_fields(projection)
+    for coll_name in collections:
+        # The documents are fetched undecoded (see api_functions.find_documents), and decoded in the thread pool
+        coll = async_db.get_db_collection(api.DB_NAME, coll_name).with_options(codec_options=api.RAW_CODEC_OPTIONS)
+        with metrics.stage('mongo'):
+            raw_docs = await coll.find(coll_filter, fields).to_list(None)
+        data = b''.join([doc.raw for doc in raw_docs])
+        metrics.count_query(coll_name, len(raw_docs), len(data))
+        if len(raw_docs) > 0:
+            return await run_blocking(decode_df, data, projection), coll_name
+    api.raise_not_found(coll_filter)
+
+def decode_df(data, projection):
+    # Returns the DataFrame of the concatenated BSON documents data
+    with metrics.stage('frame'):
+        return pd.DataFrame(bson.decode_all(data), columns=projection)
+
+def step_figure(steps, results):
+    # Sends results to a figure generator. StopIteration can't be raised through a future, so (done, value) is returned
+    try:
+        with metrics.stage('pandas'):
+            return False, steps.send(results)
+    except StopIteration as stop:
+        return True, stop.value
+
+async def run_figure_async(steps):
+    """
+    Async version of api_functions.run_figure: each step of the figure generator runs in the thread pool, and the queries
+    it yields are awaited, all of them at once if it yields a list.
+    Returns: the response returned by the generator
+    """
+    results = None
+    while True:
+        done, request = await run_blocking(step_figure, steps, results)
+        if done:
+            return request
+        if isinstance(request, list):
+            results = list(await asyncio.gather(*[query_df_async(*req) for req in request]))
+        else:
+            results = await query_df_async(*request)
+
+async def cached_json_response(endpoint, key, func):
+    """
+    Same as server.cached_json_response, running the figure generator of func with run_figure_async.
+    """
+    version = await run_blocking(api.current_data_version, server.db)
+    server.response_cache.set_version(version)
+    cache_key = (endpoint, key, version)
+    body = server.response_cache.get(cache_key)
+    if body is None:
+        if hasattr(func, 'build'):
+            response = await run_figure_async(func.build(server.db, key))
+        else:
+            response = await run_blocking(server.figure_response, func, key)
+        body = await run_blocking(server.serialize_response, response)
+        server.response_cache.put(cache_key, body)
+    return Response(body, mimetype='application/json')
+
+@app.before_request
+async def start_request_timer():
+    metrics.start_request(metrics.endpoint_label(request.url_rule.rule if request.url_rule else None, request.view_args, server.METRIC_LABEL_VALUES))
+
+@app.after_request
+async def add_server_timing(response):
+    timer = metrics.current_request.get()
+    if timer is not None:
+        timer.failed = response.status_code >= 500
+        if metrics.SERVER_TIMING:
+            response.headers['Server-Timing'] = timer.server_timing()
+    return response
+
+# The request is recorded on teardown, which also runs when after_request is skipped because a view raised
+@app.teardown_request
+async def finish_request_timer(exception=None):
+    metrics.finish_request(failed=exception is not None)
+
+@app.route('/')
+async def hello_world():
+    return 'Ping <a href="/api/v0/">/api/v0/</a> for api'
+
+@app.route(base_api_route, methods=['GET'])
+async def root_api():
+    return jsonify({'message': 'You have reached api root endpoint. Please see the Github page for information on the endings to hit: https://github.com/stev-ou/stev-api'})
+
+@app.route(base_api_route+'<string:search_type>/all')
+async def course_autocomplete_api(search_type):
+    payloads = (await run_blocking(server.current_search_state))['payloads']
+    if search_type in payloads:
+        return payload_response(payloads[search_type], request, Response)
+    else:
+        return jsonify({})
+
+@app.route(base_api_route+'<string:search_type>/search')
+async def search_api(search_type):
+    indexes = (await run_blocking(server.current_search_state))['indexes']
+    if search_type not in indexes:
+        return jsonify({})
+    limit = min(max(request.args.get('limit', DEFAULT_SEARCH_LIMIT, type=int), 0), MAX_SEARCH_LIMIT)
+    prefix_index, trigram_index = indexes[search_type]
+    fuzzy = request.args.get('fuzzy', '1') != '0'
+    # A search takes a few milliseconds, so it runs on the event loop
+    return jsonify({'result':search(prefix_index, trigram_index, request.args.get('q', ''), limit, fuzzy)})
+
+@app.route(base_api_route+'courses/<string:course_uuid>/<string:api_suffix>', methods=['GET'])
+async def course_figure_apis(course_uuid, api_suffix):
+    func = server.course_suffix_function_map[api_suffix]
+    return await cached_json_response('courses/'+api_suffix, course_uuid, func)
+
+@app.route(base_api_route+'instructors/<int:instructor_id>/<string:api_suffix>', methods=['GET'])
+async def instructor_figure_apis(instructor_id, api_suffix):
+    func = server.instr_suffix_function_map[api_suffix]
+    return await cached_json_response('instructors/'+api_suffix, instructor_id, func)
+
+@app.route(base_api_route+'metrics', methods=['GET'])
+async def metrics_api():
+    return Response(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route(base_api_route+'cache/stats', methods=['GET'])
+async def cache_stats_api():
+    return jsonify({'result': server.response_cache.stats()})
+
+if __name__ == '__main__':
+    print("Updating database...")
+    server.update_database(force_update=False)
+    print("Done.")
+    print("Starting async server listening on port 5050...")
+    app.run(host='0.0.0.0', port=5050)
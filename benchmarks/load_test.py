@@ -0,0 +1,299 @@
+'''
+This script load tests the api server (server.py) with a realistic mix of requests: course and instructor figures, and
+autocomplete lists and searches, for ids and names drawn from the /all autocomplete lists (the SearchAutocomplete output).
+A few courses and instructors get most of the traffic, as on the site: the i-th most popular id is requested with a weight
+of 1/(i+1)**POPULARITY_EXPONENT.
+
+For each concurrency setting, that many client threads send requests back to back for --duration seconds (after a
+--warmup), and the throughput and p50/p95/p99 latencies are reported, overall and per kind of request. The server is either
+    in-process (the default): server.app, called through Flask test clients, over synthetic data loaded into mongomock
+    --url: a server that is already running, e.g. `make run`
+    --gunicorn-workers: gunicorn, started with each number of workers in turn, over synthetic data loaded into the mongod at
+        --uri (a local one; its benchmark database is dropped and reloaded)
+Each setting is appended to a results file, one json object per line, e.g.
+
+    python benchmarks/load_test.py --rows 20000 --concurrency 1 4 16
+    python benchmarks/load_test.py --gunicorn-workers 1 2 4 --concurrency 4 16 64 --rows 1000000
+'''
+
+# global/pypi
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import threading
+import subprocess
+import http.client
+import numpy as np
+from datetime import datetime
+from collections import OrderedDict
+from urllib.parse import urlsplit, quote
+
+# local
+from run_benchmarks import REPO_DIR, BENCHMARK_DB_NAME, use_benchmark_databases, load_synthetic_data, connect, git_commit
+import mongo
+
+RESULTS_FILE = os.path.join(REPO_DIR, 'benchmarks', 'load_results.jsonl')
+
+# base route of the api
+BASE_ROUTE = '/api/v0/'
+
+# Share of the requests of each kind
+REQUEST_MIX = OrderedDict([('course', 0.45), ('instructor', 0.4), ('autocomplete', 0.15)])
+
+# Figure endpoints of the courses and instructors (see the suffix maps of server.py)
+COURSE_SUFFIXES = ['figure1', 'figure2', 'figure3', 'figure4', 'all']
+INSTRUCTOR_SUFFIXES = ['chip', 'figure1', 'figure2', 'figure3', 'all']
+
+# Skew of the popularity of the courses and instructors
+POPULARITY_EXPONENT = 1.0
+
+# Seconds to wait for a gunicorn server to start answering
+STARTUP_TIMEOUT = 300
+
+class RequestMix():
+    '''
+    Draws the paths of the load test requests, from the entries of the course and instructor autocomplete lists.
+    '''
+    def __init__(self, courses, instructors, seed=0):
+        self.rng = random.Random(seed)
+        self.courses = self.by_popularity(courses)
+        self.instructors = self.by_popularity(instructors)
+        self.kinds = list(REQUEST_MIX)
+        self.kind_weights = list(REQUEST_MIX.values())
+
+    def by_popularity(self, entries):
+        # Returns the entries in a random order of popularity, and their cumulative request weights
+        entries = list(entries)
+        self.rng.shuffle(entries)
+        weights = np.cumsum(1/np.arange(1, len(entries) + 1)**POPULARITY_EXPONENT)
+        return entries, list(weights)
+
+    def draw(self, rng):
+        '''
+        Returns the (kind, path) of a request, drawn with the random generator rng (each client thread has its own).
+        '''
+        kind = rng.choices(self.kinds, self.kind_weights)[0]
+        if kind == 'course':
+            entry = rng.choices(self.courses[0], cum_weights=self.courses[1])[0]
+            return kind, BASE_ROUTE + 'courses/' + quote(str(entry['value'])) + '/' + rng.choice(COURSE_SUFFIXES)
+        if kind == 'instructor':
+            entry = rng.choices(self.instructors[0], cum_weights=self.instructors[1])[0]
+            return kind, BASE_ROUTE + 'instructors/' + str(entry['value']) + '/' + rng.choice(INSTRUCTOR_SUFFIXES)
+        # An autocomplete list, or a search for the first few letters of a name
+        search_type, entries = rng.choice([('courses', self.courses), ('instructors', self.instructors)])
+        if rng.random() < 0.5:
+            return kind, BASE_ROUTE + search_type + '/all'
+        label = rng.choices(entries[0], cum_weights=entries[1])[0]['label']
+        return kind, BASE_ROUTE + search_type + '/search?q=' + quote(label[:rng.randint(2, 8)])
+
+class InProcessClient():
+    # Sends requests to server.app through a Flask test client
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        response.get_data()
+        return response.status_code
+
+    def close(self):
+        pass
+
+class HTTPClient():
+    # Sends requests to the server at url over a keep-alive connection
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+
+    def get(self, path):
+        try:
+            self.connection.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+            response = self.connection.getresponse()
+            response.read()
+            return response.status
+        except (http.client.HTTPException, OSError):
+            # Reconnect on the next request
+            self.connection.close()
+            return None
+
+    def close(self):
+        self.connection.close()
+
+def percentiles(latencies):
+    # Returns the p50, p95 and p99 of latencies (seconds), in ms
+    if len(latencies) == 0:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])*1000
+    return {'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+
+def run_load(make_client, mix, concurrency, duration, warmup=0.0, seed=0):
+    '''
+    Sends requests drawn from mix from concurrency client threads, back to back, for warmup + duration seconds.
+    Inputs:
+    make_client - function returning a new client (with get(path) -> status code and close())
+    mix - the RequestMix
+    concurrency - the number of client threads
+    duration, warmup - seconds of recorded and of unrecorded requests
+    Returns:
+    result - a dict of the requests, errors, throughput (requests per second) and latency percentiles, overall and by kind
+    '''
+    start = time.perf_counter()
+    record_from = start + warmup
+    stop = record_from + duration
+    samples = [[] for _ in range(concurrency)]
+
+    def client_loop(i):
+        rng = random.Random(seed*1000 + i)
+        client = make_client()
+        try:
+            while True:
+                kind, path = mix.draw(rng)
+                sent = time.perf_counter()
+                if sent >= stop:
+                    break
+                status = client.get(path)
+                received = time.perf_counter()
+                if sent >= record_from:
+                    samples[i].append((kind, received - sent, status == 200))
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=client_loop, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = max(time.perf_counter(), stop) - record_from
+
+    samples = [sample for client_samples in samples for sample in client_samples]
+    result = OrderedDict([('requests', len(samples)), ('errors', sum(1 for sample in samples if not sample[2])),
+                          ('throughput', len(samples)/elapsed)])
+    result.update(percentiles([latency for kind, latency, ok in samples if ok]))
+    result['kinds'] = OrderedDict((kind, dict(percentiles([latency for sample_kind, latency, ok in samples if ok and sample_kind == kind]),
+                                              requests=sum(1 for sample in samples if sample[0] == kind)))
+                                  for kind in REQUEST_MIX)
+    return result
+
+def fetch_mix(get_json, seed=0):
+    # Builds the RequestMix from the autocomplete lists of the server, get_json(path) returning a parsed response
+    return RequestMix(get_json(BASE_ROUTE + 'courses/all')['result'], get_json(BASE_ROUTE + 'instructors/all')['result'], seed)
+
+def free_port():
+    # Returns a free local port for a gunicorn server
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_gunicorn(workers, port, uri, threads=1):
+    '''
+    Starts gunicorn serving server:app with workers processes on port, over the benchmark database of the mongod at uri, and
+    waits until it answers.
+    Returns: the gunicorn process
+    '''
+    env = dict(os.environ, MONGO_URI=uri, DB_NAME=BENCHMARK_DB_NAME)
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', str(workers), '--threads', str(threads),
+                                '-b', '127.0.0.1:' + str(port), 'server:app'], cwd=REPO_DIR, env=env)
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise Exception('gunicorn exited with code ' + str(process.returncode))
+        client = HTTPClient('http://127.0.0.1:' + str(port))
+        status = client.get(BASE_ROUTE)
+        client.close()
+        if status == 200:
+            return process
+        time.sleep(0.5)
+    process.terminate()
+    raise Exception('gunicorn did not start answering within ' + str(STARTUP_TIMEOUT) + ' seconds')
+
+def http_get_json(url):
+    # Returns a function getting the parsed json response of a path from the server at url
+    def get_json(path):
+        parts = urlsplit(url)
+        connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            if response.status != 200:
+                raise Exception('GET ' + path + ' answered ' + str(response.status))
+            return json.loads(response.read())
+        finally:
+            connection.close()
+    return get_json
+
+def report(setting, result):
+    # Prints the throughput and latencies of a setting
+    def format_ms(value):
+        return '{:.1f}'.format(value) if value is not None else 'n/a'
+    print('{:<28}{:>9} req{:>7} err{:>9.1f} req/s   p50 {:>7} ms   p95 {:>7} ms   p99 {:>7} ms'.format(
+        setting, result['requests'], result['errors'], result['throughput'],
+        format_ms(result['p50_ms']), format_ms(result['p95_ms']), format_ms(result['p99_ms'])))
+    for kind, kind_result in result['kinds'].items():
+        print('    {:<24}{:>9} req   p50 {:>7} ms   p99 {:>7} ms'.format(kind, kind_result['requests'],
+                                                                       format_ms(kind_result['p50_ms']), format_ms(kind_result['p99_ms'])))
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the api server with a realistic mix of requests.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help='numbers of client threads')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of recorded requests per setting')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds of requests before recording, per setting')
+    parser.add_argument('--url', help='url of a running server to load test, e.g. http://localhost:5050')
+    parser.add_argument('--gunicorn-workers', type=int, nargs='+', help='load test gunicorn with each of these numbers of workers')
+    parser.add_argument('--gunicorn-threads', type=int, default=1, help='threads per gunicorn worker')
+    parser.add_argument('--uri', default='mongodb://localhost:27017', help='uri of the mongod the gunicorn servers query')
+    parser.add_argument('--rows', type=int, default=20000, help='number of synthetic OCR documents to load (not with --url)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results', default=RESULTS_FILE, help='file the settings are appended to')
+    args = parser.parse_args()
+
+    record = OrderedDict([('time', datetime.utcnow().isoformat(timespec='seconds')), ('commit', git_commit()),
+                          ('rows', None if args.url else args.rows), ('seed', args.seed), ('duration', args.duration),
+                          ('python', platform.python_version())])
+    settings = []
+    if args.url:
+        mix = fetch_mix(http_get_json(args.url), args.seed)
+        for concurrency in args.concurrency:
+            settings.append(({'target': args.url, 'workers': None, 'concurrency': concurrency},
+                             run_load(lambda: HTTPClient(args.url), mix, concurrency, args.duration, args.warmup, args.seed)))
+            report('url c=' + str(concurrency), settings[-1][1])
+    elif args.gunicorn_workers:
+        use_benchmark_databases()
+        load_synthetic_data(connect('mongod', args.uri), args.rows, args.seed)
+        for workers in args.gunicorn_workers:
+            port = free_port()
+            url = 'http://127.0.0.1:' + str(port)
+            process = start_gunicorn(workers, port, args.uri, args.gunicorn_threads)
+            try:
+                mix = fetch_mix(http_get_json(url), args.seed)
+                for concurrency in args.concurrency:
+                    settings.append(({'target': 'gunicorn', 'workers': workers, 'threads': args.gunicorn_threads, 'concurrency': concurrency},
+                                     run_load(lambda: HTTPClient(url), mix, concurrency, args.duration, args.warmup, args.seed)))
+                    report('gunicorn w=' + str(workers) + ' c=' + str(concurrency), settings[-1][1])
+            finally:
+                process.terminate()
+                process.wait()
+    else:
+        # server.py connects when it is imported, so its mongo_driver is pointed at the loaded mongomock client first
+        use_benchmark_databases()
+        client = connect('mongomock', None)
+        load_synthetic_data(client, args.rows, args.seed)
+        mongo.MongoClient = lambda *args, **kwargs: client
+        import server
+        test_client = server.app.test_client()
+        mix = fetch_mix(lambda path: test_client.get(path).get_json(), args.seed)
+        for concurrency in args.concurrency:
+            settings.append(({'target': 'in-process', 'workers': 1, 'concurrency': concurrency},
+                             run_load(lambda: InProcessClient(server.app), mix, concurrency, args.duration, args.warmup, args.seed)))
+            report('in-process c=' + str(concurrency), settings[-1][1])
+
+    with open(args.results, 'a') as f:
+        for setting, result in settings:
+            f.write(json.dumps(OrderedDict(list(record.items()) + list(setting.items()) + list(result.items()))) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+'''
+This script benchmarks the loader (data_loader.update_database), the aggregation (data_aggregation.aggregate_data) and every
+figure api of api_functions.py on synthetic OCR data (see synthetic_ocr.py), loaded into a local stand-in for the Atlas
+cluster: mongomock (the default; practical up to about 100k rows), a local mongod, or a SQLite file (see storage.py). The
+data goes into databases of their own (BENCHMARK_DB_NAME and BENCHMARK_OCR_DB_NAME), which are dropped before every run.
+
+Each run is appended to a results file, one json object per line, and compared with the last recorded run of the same
+backend, rows and seed, so regressions show up as the percent change of each timing. Run it from the repository root, e.g.
+
+    python benchmarks/run_benchmarks.py --rows 10000 100000
+    python benchmarks/run_benchmarks.py --backend mongod --uri mongodb://localhost:27017 --rows 1000000 10000000
+'''
+
+# global/pypi
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import traceback
+import subprocess
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from collections import OrderedDict
+
+# The loads write their snapshots and id cache to a temporary directory instead of the repository's
+WORK_DIR = tempfile.mkdtemp(prefix='stev-benchmarks-')
+os.environ['SNAPSHOT_DIR'] = os.path.join(WORK_DIR, 'snapshots')
+os.environ['ID_CACHE_FILE'] = os.path.join(WORK_DIR, 'id_cache.json')
+
+# local
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import mongo
+import storage
+import data_loader
+import data_aggregation
+import api_functions as api
+from bulk_upload import bulk_insert
+from synthetic_ocr import generate_ocr_frame
+
+# Databases the benchmarks load into, in place of data_loader.DB_NAME and data_loader.OCR_DB_NAME
+BENCHMARK_DB_NAME = 'stev-benchmark-reviews'
+BENCHMARK_OCR_DB_NAME = 'stev-benchmark-ocr'
+
+RESULTS_FILE = os.path.join(REPO_DIR, 'benchmarks', 'results.jsonl')
+
+# Timings that got slower than this (relative to the last run) are flagged
+REGRESSION_THRESHOLD = 0.2
+
+# The figure apis, called with a course_uuid or an Instructor ID
+COURSE_FIGURES = [api.CourseFig1Table, api.CourseFig2Chart, api.CourseFig3Timeseries, api.CourseFig4TableBar, api.CourseAllFigures]
+INSTRUCTOR_FIGURES = [api.InstructorChipAPI, api.InstructorFig1Table, api.InstructorFig2Timeseries, api.InstructorFig3TableBar,
+                      api.InstructorAllFigures]
+
+def connect(backend, uri):
+    '''
+    Returns the mongo client of the backend: a mongomock client, or a pymongo client of the mongod at uri. The sqlite backend
+    (see storage.py) is a sqlite_driver of a file in WORK_DIR instead.
+    '''
+    if backend == 'sqlite':
+        return storage.sqlite_driver(os.path.join(WORK_DIR, 'benchmark.sqlite'))
+    if backend == 'mongomock':
+        import mongomock
+        return mongomock.MongoClient()
+    from pymongo import MongoClient
+    return MongoClient(uri)
+
+def timed(timings, name, func, *args, **kwargs):
+    # Runs func, recording its duration (seconds) in timings[name]
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[name] = time.perf_counter() - start
+    return result
+
+def time_figures(db, funcs, ids):
+    '''
+    Calls each of the figure apis funcs on each of ids. The traceback of the first error of each function is printed.
+    Returns: a dict of function name -> {'median_ms', 'p95_ms', 'errors'}
+    '''
+    results = OrderedDict()
+    for func in funcs:
+        durations = []
+        errors = 0
+        for figure_id in ids:
+            start = time.perf_counter()
+            try:
+                func(db, figure_id)
+            except Exception:
+                # e.g. an instructor without documents in the current semesters, but it may as well be a bug in the figure
+                if errors == 0:
+                    print('ERROR: ' + func.__name__ + ' failed for ' + str(figure_id) + ':')
+                    traceback.print_exc()
+                errors += 1
+                continue
+            durations.append(time.perf_counter() - start)
+        results[func.__name__] = {'median_ms': float(np.median(durations))*1000 if durations else None,
+                                  'p95_ms': float(np.percentile(durations, 95))*1000 if durations else None,
+                                  'errors': errors}
+    return results
+
+def use_benchmark_databases():
+    # Points the loader and the api at the benchmark databases
+    data_loader.DB_NAME = api.DB_NAME = BENCHMARK_DB_NAME
+    data_loader.OCR_DB_NAME = BENCHMARK_OCR_DB_NAME
+
+def load_synthetic_data(client, n_rows, seed=0, timings=None):
+    '''
+    Drops the benchmark databases, then fills them with n_rows synthetic OCR documents and their loaded (conditioned and
+    aggregated) collections, as update_database would on the production cluster.
+    Inputs:
+    client - the mongo client (or sqlite_driver) to load with
+    n_rows, seed - the size and seed of the synthetic data (see synthetic_ocr.py)
+    timings - optional dict, the durations (seconds) of the generate, insert_ocr and update_database steps are added to it
+    Returns:
+    conn - a mongo_driver of client (or the sqlite_driver)
+    '''
+    timings = timings if timings is not None else OrderedDict()
+    for db_name in [BENCHMARK_DB_NAME, BENCHMARK_OCR_DB_NAME]:
+        client.drop_database(db_name)
+    conn = client if isinstance(client, storage.sqlite_driver) else mongo.mongo_driver(client)
+
+    df = timed(timings, 'generate', generate_ocr_frame, n_rows, seed)
+    ocr_collection = conn.get_db_collection(BENCHMARK_OCR_DB_NAME, data_loader.ocr_collections[0])
+    timed(timings, 'insert_ocr', bulk_insert, ocr_collection, df)
+    del df
+    timed(timings, 'update_database', data_loader.update_database, force_update=True, conn=conn)
+    return conn
+
+def run_benchmark(client, n_rows, seed=0, samples=20):
+    '''
+    Loads n_rows synthetic OCR documents with the mongo client, then times the loader, the aggregation and the figure apis.
+    Returns: a dict with the 'timings' (seconds) of the load stages and the 'figures' timings (see time_figures)
+    '''
+    timings = OrderedDict()
+    conn = load_synthetic_data(client, n_rows, seed, timings)
+    ocr_collection = conn.get_db_collection(BENCHMARK_OCR_DB_NAME, data_loader.ocr_collections[0])
+    timed(timings, 'read_ocr_collection', data_loader.read_ocr_collection, ocr_collection)
+    # The conditioned frame that update_database saved as a snapshot, to time aggregate_data on its own
+    conditioned = data_loader.condition_ocr_collection(conn, data_loader.ocr_collections[0], {}, data_loader.ocr_source_version(ocr_collection))
+    timed(timings, 'aggregate_data', data_aggregation.aggregate_data, conditioned.copy())
+    del conditioned
+
+    courses = timed(timings, 'SearchAutocomplete_course', api.SearchAutocomplete, conn, 'course')
+    instructors = timed(timings, 'SearchAutocomplete_instructor', api.SearchAutocomplete, conn, 'instructor')
+    rng = random.Random(seed)
+    course_ids = rng.sample([entry['value'] for entry in courses], min(samples, len(courses)))
+    instructor_ids = rng.sample([entry['value'] for entry in instructors], min(samples, len(instructors)))
+    figures = time_figures(conn, COURSE_FIGURES, course_ids)
+    figures.update(time_figures(conn, INSTRUCTOR_FIGURES, instructor_ids))
+    return {'timings': timings, 'figures': figures}
+
+def git_commit():
+    # Returns the short hash of the checked out commit, or None outside of a git repository
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def load_results(path=RESULTS_FILE):
+    # Returns the list of the recorded runs
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def previous_run(results, record):
+    # Returns the last recorded run with the same backend, rows and seed as record, or None
+    for previous in reversed(results):
+        if all(previous.get(key) == record[key] for key in ['backend', 'rows', 'seed']):
+            return previous
+    return None
+
+def report(record, previous):
+    '''
+    Prints the timings of a run, with their change since the previous run of the same configuration.
+    '''
+    rows = [(name, seconds*1000, previous['timings'].get(name)*1000 if previous and name in previous['timings'] else None)
+            for name, seconds in record['timings'].items()]
+    rows += [(name + ' (median)', figure['median_ms'],
+              previous['figures'].get(name, {}).get('median_ms') if previous else None) for name, figure in record['figures'].items()]
+    print('\n' + str(record['rows']) + ' rows on ' + record['backend'] + (' (compared with ' + str(previous['commit']) + ' ' + previous['time'] + ')' if previous else ''))
+    for name, ms, previous_ms in rows:
+        line = '  {:<40}{:>12}'.format(name, '{:.1f} ms'.format(ms) if ms is not None else 'n/a')
+        if ms is not None and previous_ms:
+            change = ms/previous_ms - 1
+            line += '  {:+.0%}'.format(change) + ('  REGRESSION' if change > REGRESSION_THRESHOLD else '')
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the loader, the aggregation and the figure apis on synthetic data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000], help='numbers of OCR documents to benchmark with')
+    parser.add_argument('--backend', choices=['mongomock', 'mongod', 'sqlite'], default='mongomock')
+    parser.add_argument('--uri', default='mongodb://localhost:27017', help='uri of the mongod backend')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--samples', type=int, default=20, help='number of courses and of instructors each figure is timed on')
+    parser.add_argument('--results', default=RESULTS_FILE, help='file the runs are appended to')
+    args = parser.parse_args()
+
+    use_benchmark_databases()
+    client = connect(args.backend, args.uri)
+    results = load_results(args.results)
+    for n_rows in args.rows:
+        run = run_benchmark(client, n_rows, args.seed, args.samples)
+        record = OrderedDict([('time', datetime.utcnow().isoformat(timespec='seconds')), ('commit', git_commit()),
+                              ('backend', args.backend), ('rows', n_rows), ('seed', args.seed), ('samples', args.samples),
+                              ('python', platform.python_version()), ('pandas', pd.__version__), ('numpy', np.__version__)])
+        record.update(run)
+        report(record, previous_run(results, record))
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        results.append(record)
+
+if __name__ == '__main__':
+    main()
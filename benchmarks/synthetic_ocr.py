@@ -0,0 +1,127 @@
+'''
+This script contains a seeded generator of synthetic scraped OCR review data, with the fields and types of the documents of
+the ocr_db_v1.reviews collection that data_loader.py reads. Every section (one course, taught by one instructor in one term)
+has one document per evaluation question, with its number of responses, mean and standard deviation.
+
+The catalog grows with the number of rows, so a large dataset has more courses and instructors rather than many more
+sections of the same few courses: about SECTIONS_PER_COURSE sections per course and SECTIONS_PER_INSTRUCTOR per instructor.
+The same n_rows and seed always generate the same frame.
+'''
+
+# global/pypi
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# local
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import term_calendar
+
+# The terms of the generated sections: 2014 through Spring 2019, so the api's CURRENT_SEMESTERS have data
+TERM_CODES = [int(code) for code in term_calendar.TERM_CODES if 201410 <= code <= 201920]
+
+# Colleges and their subjects
+COLLEGES = {'GCoE': ['AME', 'CS', 'ECE', 'ENGR', 'CEES', 'ISE'],
+            'CoAaS': ['MATH', 'CHEM', 'PHYS', 'BIOL', 'HIST', 'ENGL', 'PSY'],
+            'MFPCoB': ['ACCT', 'FIN', 'MKT', 'MGT'],
+            'GCoJaMC': ['JMC'],
+            'CoE': ['EDUC', 'EIPT']}
+SUBJECTS = [subject for subjects in COLLEGES.values() for subject in subjects]
+SUBJECT_COLLEGES = [college for college, subjects in COLLEGES.items() for subject in subjects]
+
+# The evaluation questions, asked in every section
+QUESTIONS = ['The instructor was well prepared for class.',
+             'The instructor explained the material clearly.',
+             'The instructor was available outside of class.',
+             'The instructor treated students with respect.',
+             'The instructor provided useful feedback on my work.',
+             'The course objectives were clearly stated.',
+             'The assignments helped me learn the material.',
+             'The exams reflected the material covered in the course.',
+             'The course was well organized.',
+             'I learned a great deal in this course.',
+             'Overall, the instructor was effective.',
+             'Overall, this was a good course.']
+
+FIRST_NAMES = ['JOHN', 'MARY', 'CHUNG-HAO', 'ANA', 'LI', 'SAM', 'PRIYA', 'DAVID', 'FATIMA', 'JOSE', 'EMILY', 'WEI', 'OMAR',
+               'SARAH', 'KENJI', 'RACHEL', 'MIGUEL', 'GRACE', 'IVAN', 'NOOR']
+LAST_NAME_SYLLABLES = ['SMI', 'LEE', 'DO', 'WONG', 'DAV', 'KHAN', 'MC', 'NGU', 'GAR', 'PAT', 'EL', 'SON', 'BER', 'KIM',
+                       'ROS', 'TAN', 'WAL', 'KER', 'MAR', 'TIN']
+TITLE_PREFIXES = ['Introduction To', 'Principles Of', 'Advanced', 'Topics In', 'Applied', 'Seminar In']
+TITLE_TOPICS = ['Statics', 'Dynamics', 'Thermodynamics', 'Calculus', 'Chemistry', 'Physics', 'Biology', 'History', 'Writing',
+                'Accounting', 'Finance', 'Marketing', 'Management', 'Design', 'Systems', 'Analysis', 'Methods', 'Theory']
+
+# Average number of sections taught per course and per instructor
+SECTIONS_PER_COURSE = 40
+SECTIONS_PER_INSTRUCTOR = 25
+
+def last_name(i):
+    # Builds the i-th (title cased by the loader) last name from three syllables
+    n = len(LAST_NAME_SYLLABLES)
+    return LAST_NAME_SYLLABLES[i % n] + LAST_NAME_SYLLABLES[(i // n) % n] + LAST_NAME_SYLLABLES[(i // (n*n)) % n]
+
+def generate_ocr_frame(n_rows, seed=0):
+    '''
+    Generates n_rows synthetic scraped OCR documents.
+    Inputs:
+    n_rows - the number of documents (rows) to generate
+    seed - the seed of the random generator
+    Returns:
+    df - a pd DataFrame with one row per document and the columns of the ocr_db_v1.reviews documents
+    '''
+    rng = np.random.RandomState(seed)
+    n_questions = len(QUESTIONS)
+    n_sections = -(-n_rows // n_questions)
+    n_courses = max(n_sections // SECTIONS_PER_COURSE, len(SUBJECTS))
+    n_instructors = max(n_sections // SECTIONS_PER_INSTRUCTOR, len(COLLEGES))
+
+    # The catalog: each course is in one subject, and each instructor teaches in one college
+    course_subjects = np.arange(n_courses) % len(SUBJECTS)
+    course_numbers = 1000 + np.arange(n_courses) // len(SUBJECTS)
+    course_titles = [TITLE_PREFIXES[i % len(TITLE_PREFIXES)] + ' ' + TITLE_TOPICS[(i // len(TITLE_PREFIXES)) % len(TITLE_TOPICS)]
+                     for i in range(n_courses)]
+    # The section titles of the lectures, then of the labs, of each course. The loader drops the 4 character suffix
+    section_titles = np.array([title + ' LEC' for title in course_titles] + [title + ' LAB' for title in course_titles], dtype=object)
+    instructor_first = np.array([FIRST_NAMES[i % len(FIRST_NAMES)] for i in range(n_instructors)], dtype=object)
+    instructor_last = np.array([last_name(i // len(FIRST_NAMES)) for i in range(n_instructors)], dtype=object)
+    college_names = list(COLLEGES)
+    college_codes = np.array([college_names.index(college) for college in SUBJECT_COLLEGES])
+    instructor_colleges = np.arange(n_instructors) % len(COLLEGES)
+    college_instructors = [np.flatnonzero(instructor_colleges == college) for college in range(len(COLLEGES))]
+
+    # The sections: a course, an instructor of its college, a term, a lecture or lab title, and a class size
+    courses = rng.randint(0, n_courses, n_sections)
+    colleges = college_codes[course_subjects[courses]]
+    instructors = np.empty(n_sections, dtype=np.int64)
+    for college, members in enumerate(college_instructors):
+        in_college = colleges == college
+        instructors[in_college] = members[rng.randint(0, len(members), in_college.sum())]
+    terms = np.array(TERM_CODES)[rng.randint(0, len(TERM_CODES), n_sections)]
+    titles = courses + n_courses*(rng.uniform(size=n_sections) < 0.15)
+    section_numbers = rng.randint(1, 10, n_sections)
+    class_sizes = rng.randint(5, 120, n_sections)
+    # Each section and instructor has its own level, which its questions vary around
+    section_means = np.clip(rng.normal(4.0, 0.45, n_sections) + rng.normal(0, 0.3, n_instructors)[instructors], 1, 5)
+
+    # One row per (section, question)
+    rows = np.repeat(np.arange(n_sections), n_questions)[:n_rows]
+    questions = np.tile(np.arange(n_questions), n_sections)[:n_rows]
+    responses = rng.binomial(class_sizes[rows], 0.6)
+    means = np.round(np.clip(section_means[rows] + rng.normal(0, 0.25, n_rows), 1, 5), 2)
+    sds = np.round(rng.uniform(0.3, 1.5, n_rows), 2)
+
+    subjects = np.array(SUBJECTS, dtype=object)
+    return pd.DataFrame({'Term Code': terms[rows],
+                         'College Code': np.array(college_names, dtype=object)[colleges[rows]],
+                         'Subject Code': subjects[course_subjects[courses[rows]]],
+                         'Course Number': course_numbers[courses[rows]],
+                         'Section Number': section_numbers[rows],
+                         'Section Title': section_titles[titles[rows]],
+                         'Instructor First Name': instructor_first[instructors[rows]],
+                         'Instructor Last Name': instructor_last[instructors[rows]],
+                         'Question Number': questions + 1,
+                         'Question': np.array(QUESTIONS, dtype=object)[questions],
+                         'Individual Responses': responses,
+                         'Mean': means,
+                         'Standard Deviation': sds})
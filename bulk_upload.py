@@ -0,0 +1,117 @@
+'''
+This script contains the functions used to upload large dataframes into mongo collections. Documents are grouped into batches
+by their (estimated) encoded size rather than by a fixed number of splits, and the batches are written concurrently on a
+thread pool with unordered insert_many calls. Each batch is retried on its own if the connection drops (AutoReconnect).
+'''
+
+# global/pypi
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import bson
+from pymongo.errors import AutoReconnect, BulkWriteError
+from tqdm import tqdm
+
+# Target size of each insert_many batch, in bytes of BSON. Mongo caps a single message at 48MB
+MAX_BATCH_BYTES = int(os.environ.get('MAX_BATCH_BYTES', 4*1024*1024))
+# Mongo also caps the number of documents in a single write batch
+MAX_BATCH_DOCS = 100000
+# One in SIZE_SAMPLE_INTERVAL documents is encoded to estimate the size of the others (insert_many encodes them all again)
+SIZE_SAMPLE_INTERVAL = 100
+# Number of batches written concurrently
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+# Number of times a batch is retried after an AutoReconnect, and the initial backoff (seconds, doubled per retry)
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.5
+
+# Number of dataframe rows converted to records at a time, so the whole frame is never held as dicts
+RECORD_CHUNK_ROWS = 10000
+
+# Mongo error code for a duplicate key
+DUPLICATE_KEY_ERROR = 11000
+
+def iter_records(df, chunk_rows=RECORD_CHUNK_ROWS):
+    '''
+    Yields the rows of a dataframe as mongo documents (dicts), converting chunk_rows rows at a time.
+    '''
+    for start in range(0, len(df), chunk_rows):
+        for record in df.iloc[start:start+chunk_rows].to_dict('records'):
+            yield record
+
+def batch_records(records, max_batch_bytes=MAX_BATCH_BYTES, max_batch_docs=MAX_BATCH_DOCS, sample_interval=SIZE_SAMPLE_INTERVAL):
+    '''
+    Groups an iterable of documents into lists whose total BSON size stays under max_batch_bytes (a single document larger
+    than that gets a batch of its own). The rows of a dataframe have the same fields, so rather than encoding every document,
+    each one is taken to be as large as the largest of the documents sampled so far (one in sample_interval, starting with
+    the first). max_batch_bytes is well below mongo's 48MB message limit, which leaves room for documents that are larger
+    than the sampled ones.
+    '''
+    batch = []
+    batch_bytes = 0
+    size = 0
+    for i, record in enumerate(records):
+        if i % sample_interval == 0:
+            size = max(size, len(bson.BSON.encode(record)))
+        if batch and (batch_bytes + size > max_batch_bytes or len(batch) >= max_batch_docs):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(record)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+def insert_batch(collection, batch, max_retries=MAX_RETRIES, retry_backoff=RETRY_BACKOFF):
+    '''
+    Writes one batch of documents with an unordered insert_many, retrying with exponential backoff if the connection drops.
+    insert_many assigns each document its _id before sending it, so a retry of a batch that was partly written before the
+    connection dropped only runs into duplicate key errors for those documents, which are ignored.
+    :Returns:
+    - the number of documents in the batch
+    '''
+    for attempt in range(max_retries+1):
+        try:
+            collection.insert_many(batch, ordered=False)
+            return len(batch)
+        except AutoReconnect:
+            if attempt == max_retries:
+                raise
+            time.sleep(retry_backoff*2**attempt)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if attempt > 0 and errors and all(error.get('code') == DUPLICATE_KEY_ERROR for error in errors):
+                return len(batch)
+            raise
+    return len(batch)
+
+def bulk_insert(collection, df, max_batch_bytes=MAX_BATCH_BYTES, workers=UPLOAD_WORKERS, max_retries=MAX_RETRIES):
+    '''
+    Uploads every row of a dataframe to a mongo collection as a document.
+    :Inputs:
+    - collection: the pymongo collection to write to
+    - df: pandas dataframe to upload
+    - max_batch_bytes (optional): the target BSON size of each insert_many batch
+    - workers (optional): the number of batches written concurrently
+    - max_retries (optional): the number of times a batch is retried after an AutoReconnect
+    :Returns:
+    - n_inserted: the number of documents written
+    '''
+    start = time.time()
+    n_inserted = 0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(total=len(df), unit='rows') as progress:
+        for batch in batch_records(iter_records(df), max_batch_bytes=max_batch_bytes):
+            # Keep a bounded number of batches in flight so the records are produced only as fast as they are written
+            if len(pending) >= 2*workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    n_inserted += future.result()
+                    progress.update(future.result())
+            pending.add(executor.submit(insert_batch, collection, batch, max_retries))
+        for future in pending:
+            n_inserted += future.result()
+            progress.update(future.result())
+
+    elapsed = max(time.time() - start, 1e-9)
+    print('Uploaded ' + str(n_inserted) + ' documents to ' + collection.name + ' in ' + str(round(elapsed, 1)) + 's (' + str(int(n_inserted/elapsed)) + ' rows/sec).')
+    return n_inserted
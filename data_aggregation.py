@@ -28,8 +28,159 @@ def combine_standard_deviations(sd_list, mean_list,pop_list):
     sd = np.sqrt(deviance/(np.sum(pop_list)))
     return sd
 
-def aggregate_data(df):
+def group_codes(df, keys):
     """
+    Labels each row of df with a dense integer code for its group over the given key columns, i.e. the same grouping
+    that df.groupby(keys) would produce. Rows with a null value in any of the keys get a code of -1, mirroring the way
+    pandas drops those rows from its groups.
+    :Inputs:
+    - df: A pandas dataframe
+    - keys: list of column names to group by
+    :Returns:
+    - codes: numpy int64 array of group codes, aligned with the rows of df
+    """
+    codes = np.zeros(len(df), dtype=np.int64)
+    missing = np.zeros(len(df), dtype=bool)
+    for key in keys:
+        key_codes, uniques = pd.factorize(df[key])
+        missing |= key_codes < 0
+        # Re-factorize after each key so the combined codes stay dense and can't overflow
+        codes, _ = pd.factorize(codes*max(len(uniques), 1) + key_codes)
+    codes = codes.astype(np.int64)
+    codes[missing] = -1
+    return codes
+
+def grouped_sum(codes, values):
+    """
+    Sums values within each group of codes (see group_codes) and broadcasts the group totals back onto every row, like
+    groupby(...).transform('sum'). NaN values propagate to their group total, the same as np.sum/np.average do.
+    Rows with a code of -1 get NaN.
+    """
+    values = np.asarray(values, dtype=float)
+    valid = codes >= 0
+    totals = np.bincount(codes[valid], weights=values[valid], minlength=codes.max()+1 if len(codes) else 0)
+    out = np.full(len(codes), np.nan)
+    out[valid] = totals[codes[valid]]
+    return out
+
+def weighted_group_stats(codes, mean_list, sd_list, pop_list, sd_mean_list=None):
+    """
+    Vectorized equivalent of applying np.average(mean_list, weights=pop_list) and
+    combine_standard_deviations(sd_list, sd_mean_list, pop_list) to each group of codes. Both are built from grouped sums
+    of precomputed weighted products, so no python is run per group.
+    :Inputs:
+    - codes: group codes from group_codes
+    - mean_list, sd_list, pop_list: arrays of the means, standard deviations and populations of each row
+    - sd_mean_list (optional): the means used when pooling the standard deviations, defaults to mean_list
+    :Returns:
+    - (weighted_mean, pooled_sd): two numpy arrays aligned with codes
+    """
+    if sd_mean_list is None:
+        sd_mean_list = mean_list
+    mean_list = np.asarray(mean_list, dtype=float)
+    sd_list = np.asarray(sd_list, dtype=float)
+    sd_mean_list = np.asarray(sd_mean_list, dtype=float)
+    pop_list = np.asarray(pop_list, dtype=float)
+
+    pop_total = grouped_sum(codes, pop_list)
+    weighted_mean = grouped_sum(codes, mean_list*pop_list)/pop_total
+    # Pooled sd needs the population mean of the group before the deviance can be summed, so it takes a second pass
+    pop_mean = grouped_sum(codes, sd_mean_list*pop_list)/pop_total
+    deviance = grouped_sum(codes, pop_list*(sd_list**2) + pop_list*(sd_mean_list - pop_mean)**2)
+    pooled_sd = np.sqrt(deviance/pop_total)
+    return weighted_mean, pooled_sd
+
+def aggregate_data_vectorized(df):
+    """
+    Vectorized aggregation engine. Produces the same aggregated dataframe as aggregate_data_legacy, but every weighted
+    mean, pooled sd and enrollment is computed from grouped sums over the whole frame instead of per-group lambdas.
+    :Inputs:
+    - df: A pandas dataframe, slightly modified from db results (see conditioning in data_loader.py)
+    :Returns:
+    - ag_df: An aggregated version of the same dataframe
+    """
+    instr_keys = ['Term Code', 'course_uuid', 'Instructor ID']
+    course_keys = ['Term Code', 'course_uuid']
+    dept_keys = ['Term Code', 'College Code', 'Subject Code']
+
+    # Can't handle if Responses are 0; Convert 0 responses to 1
+    df['Responses'] = df['Responses'].where(df['Responses'] > 0, 1)
+    enrollment_dtype = df['Responses'].dtype
+
+    # Remove the repeat rows that will occur because we are taking 1-10 question responses down to 1
+    first_rows = ~df.duplicated(subset=instr_keys).values
+    ag_df = df[first_rows].copy()
+
+    # First Operation: Combine sections of the same course taught by the same instructor in the same semester
+    codes = group_codes(df, instr_keys)
+    instr_mean, instr_sd = weighted_group_stats(codes, df['Mean'].values, df['Standard Deviation'].values, df['Responses'].values)
+    ag_df['Avg Instructor Rating In Section'] = instr_mean[first_rows]
+    ag_df['SD Instructor Rating In Section'] = instr_sd[first_rows]
+    ag_df['Instructor Enrollment'] = grouped_sum(codes[first_rows], ag_df['Responses'].values).astype(enrollment_dtype)
+
+    # Second Operation: Combine Instructors in Courses to get the Average Course metrics
+    codes = group_codes(ag_df, course_keys)
+    course_mean, course_sd = weighted_group_stats(codes, ag_df['Avg Instructor Rating In Section'].values,
+                                                  ag_df['SD Instructor Rating In Section'].values, ag_df['Instructor Enrollment'].values)
+    ag_df['Avg Course Rating'] = course_mean
+    ag_df['SD Course Rating'] = course_sd
+    ag_df['Course Enrollment'] = grouped_sum(codes, ag_df['Instructor Enrollment'].values).astype(enrollment_dtype)
+    ag_df['Course Rank in Department in Semester'] = ag_df.groupby(dept_keys)['Avg Course Rating'].rank(method ='dense',na_option='top', ascending=False).astype(int)
+
+    # Third Operation: Combine Courses inside of a department to get average department metrics
+    # Note that the department sd is pooled around the instructor ratings, as it always has been in aggregate_data_legacy
+    codes = group_codes(ag_df, dept_keys)
+    dept_mean, dept_sd = weighted_group_stats(codes, ag_df['Avg Course Rating'].values, ag_df['SD Course Rating'].values,
+                                              ag_df['Course Enrollment'].values, sd_mean_list=ag_df['Avg Instructor Rating In Section'].values)
+    ag_df['Avg Department Rating'] = dept_mean
+    ag_df['SD Department Rating'] = dept_sd
+
+    # Rename the necessary columns
+    ag_df = ag_df.rename(columns = {'Section Title':'Course Title'})
+    # Drop unnecessary columns, mainly leftovers from df
+    ag_df = ag_df.drop(columns = ['Question', 'Question Number', 'Responses','Mean', 'Standard Deviation'], errors = 'ignore')
+    return ag_df
+
+def compare_aggregations(ag_df, reference_df, rtol=1e-9, atol=1e-9):
+    """
+    Checks that two aggregated dataframes hold the same rows and columns, with numeric columns equal to within the given
+    tolerances. Raises an Exception naming the columns that differ.
+    """
+    if list(ag_df.columns) != list(reference_df.columns):
+        raise Exception('Aggregated columns differ: '+str(list(ag_df.columns))+' vs '+str(list(reference_df.columns)))
+    if not ag_df.index.equals(reference_df.index):
+        raise Exception('Aggregated dataframes contain different rows.')
+    mismatched = []
+    for col in ag_df.columns:
+        a, b = ag_df[col], reference_df[col]
+        if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b):
+            same = np.allclose(a.values.astype(float), b.values.astype(float), rtol=rtol, atol=atol, equal_nan=True)
+        else:
+            same = ((a == b) | (a.isnull() & b.isnull())).all()
+        if not same:
+            mismatched.append(col)
+    if mismatched:
+        raise Exception('Aggregated columns do not match the reference implementation: '+', '.join(mismatched))
+    return
+
+def aggregate_data(df, validate=False):
+    """
+    Aggregates a pandas dataframe of student reviews data with the vectorized engine (aggregate_data_vectorized).
+    :Inputs:
+    - df: A pandas dataframe, slightly modified from db results (see conditioning in data_loader.py)
+    - validate (optional): if True, also run aggregate_data_legacy and raise an Exception if the results differ
+    :Returns:
+    - ag_df: An aggregated version of the same dataframe
+    """
+    ag_df = aggregate_data_vectorized(df)
+    if validate:
+        compare_aggregations(ag_df, aggregate_data_legacy(df.copy()))
+    return ag_df
+
+def aggregate_data_legacy(df):
+    """
+    Original (per-group lambda) implementation of aggregate_data. Kept as the reference implementation, so that the
+    vectorized engine can be checked against it with aggregate_data(df, validate=True).
     Aggregates a pandas dataframe of student reviews data. See the First, Second, and Third Operations below for more descriptions of functions.
     Note the similar form across operations.
     :Inputs:
@@ -1,58 +1,515 @@
 # global/PyPI
 import pandas as pd
+import numpy as np
 import json
 import os
 import hashlib
-from tqdm import tqdm
+from datetime import datetime
+import sys
+from array import array
+from itertools import islice
+from pymongo import DeleteMany, DeleteOne, ReplaceOne
 
 # local
-from mongo import mongo_driver as db_conn
+from storage import storage_driver as db_conn
 # aggregate_data.py contains the function to aggregate the data
-from data_aggregation import aggregate_data
+from data_aggregation import aggregate_data, group_codes
+# bulk_upload.py contains the batched, concurrent upload used for the large collections
+from bulk_upload import bulk_insert
+from index_manager import ensure_indexes, backfill_offering_keys, offering_keys, OFFERING_KEY
+# the collection holding the version of the data being served, which is changed after every load (see set_data_version)
+from api_functions import DATA_VERSION_COLLECTION
+# snapshots.py stores the conditioned and aggregated dataframes on local disk
+from snapshots import load_snapshot, save_snapshot, tag_snapshot, read_manifest, SNAPSHOT_DIR
 
 # Define the name of the database and the name of the collection. Insert each .csv record as a document within the collection
-DB_NAME = "reviews-db-v1" # practice
+DB_NAME = os.environ.get('DB_NAME', "reviews-db-v1") # practice
 OCR_DB_NAME = 'ocr_db_v1'
 ocr_collections = ['reviews']#, 'CoAaS', 'CoA&GS', 'CoCE-DoA', 'MFPCoB', 'MCoEaE', 'JRCoE', 'GCoE', 'WFCoFA', 'HC', 'CoIS', 'GCoJaMC', 'CoPaCS', 'UC', 'CfIaDL', 'EWP', 'R-AF']
 
-# Define the number of splits; Required to upload data in packets to avoid AutoReconnect Error from Mongo
-n_splits = 100
+# The fields of the scraped OCR documents that are used by the conditioning, the aggregation, and the api. Everything else is
+# left in the OCR db when reading it (see read_ocr_collection)
+OCR_COLUMNS = ['Term Code', 'College Code', 'Subject Code', 'Course Number', 'Section Title', 'Instructor First Name',
+               'Instructor Last Name', 'Question Number', 'Question', 'Individual Responses', 'Mean', 'Standard Deviation']
+# These OCR fields are buffered as float64 values; those in OCR_INT_COLUMNS are converted to int64 if they have no missing values
+OCR_NUMERIC_COLUMNS = ['Term Code', 'Question Number', 'Individual Responses', 'Mean', 'Standard Deviation']
+OCR_INT_COLUMNS = ['Term Code', 'Question Number', 'Individual Responses']
+
+# Number of OCR documents read from the cursor per batch, and an optional ceiling (in MB) on the memory used to read the
+# collection into a dataframe. Both can be set from the environment for small machines, e.g. OCR_MEMORY_LIMIT_MB=512
+OCR_BATCH_SIZE = int(os.environ.get('OCR_BATCH_SIZE', 5000))
+OCR_MEMORY_LIMIT_MB = int(os.environ.get('OCR_MEMORY_LIMIT_MB', 0)) or None
+# The batches are not made smaller than this when they are shrunk to stay under the memory limit
+OCR_MIN_BATCH_SIZE = 100
+
+class OCRMemoryLimitError(Exception):
+    '''
+    Raised by read_ocr_collection when the collection can't be read within its memory limit.
+    '''
+    pass
+
+def read_ocr_collection(collection, batch_size=OCR_BATCH_SIZE, memory_limit_mb=OCR_MEMORY_LIMIT_MB, columns=OCR_COLUMNS):
+    '''
+    Streams a scraped OCR collection into a pandas dataframe. The collection is read in cursor batches, projected down to the
+    needed columns, and each batch is appended to typed column buffers (compact float64 arrays for the numeric columns, lists
+    of shared string objects for the rest), so the full set of documents is never held in memory as dicts. The dataframe is
+    then built one column at a time, each buffer being released as its column is added.
+    :inputs:
+    collection: the pymongo collection to read
+    batch_size: the number of documents to read per batch. It is halved whenever the next batch of documents could take more
+        than half of the memory left under memory_limit_mb
+    memory_limit_mb: optional ceiling on the memory used by the column buffers, the documents of the batch being read and the
+        column being converted into the dataframe. An OCRMemoryLimitError is raised if the collection can't fit under it.
+    columns: the fields to read
+    :returns:
+    df: a pandas dataframe with one column for each of the columns found in the collection
+    '''
+    numeric = [col for col in columns if col in OCR_NUMERIC_COLUMNS]
+    buffers = {col: array('d') if col in numeric else [] for col in columns}
+    seen = set()
+    # Repeated strings (names, titles, questions) share one object instead of one per document
+    string_pool = {}
+    string_bytes = 0
+    n_rows = 0
+
+    def used_mb(n_rows):
+        # Each buffered value is 8 bytes, either a float64 or a pointer to a shared object. Building the dataframe copies one
+        # column at a time, so one more column is counted for it
+        return (8*n_rows*(len(columns) + 1) + string_bytes)/1e6
+
+    cursor = collection.find({}, dict({col: 1 for col in columns}, _id=0), batch_size=batch_size)
+    while True:
+        batch = list(islice(cursor, batch_size))
+        if len(batch) == 0:
+            break
+        for col in columns:
+            values = [doc.get(col) for doc in batch]
+            if col in numeric:
+                buffers[col].extend(float('nan') if v is None or v == '' else float(v) for v in values)
+            else:
+                for v in values:
+                    if isinstance(v, str):
+                        pooled = string_pool.get(v)
+                        if pooled is None:
+                            pooled = string_pool[v] = v
+                            string_bytes += sys.getsizeof(v)
+                        v = pooled
+                    buffers[col].append(v)
+        for doc in batch:
+            seen.update(doc.keys())
+        n_rows += len(batch)
+
+        if memory_limit_mb is not None:
+            if used_mb(n_rows) > memory_limit_mb:
+                raise OCRMemoryLimitError('Reading the OCR collection exceeded the memory limit of '+str(memory_limit_mb)+' MB after '+str(n_rows)+' documents.')
+            # The documents of a batch are held as dicts (with their own strings) until they are buffered, so the batches
+            # are made smaller as the buffers fill up the memory under the limit
+            doc_bytes = sys.getsizeof(batch[0]) + sum(sys.getsizeof(v) for v in batch[0].values())
+            while batch_size > OCR_MIN_BATCH_SIZE and doc_bytes*batch_size/1e6 > (memory_limit_mb - used_mb(n_rows))/2:
+                batch_size = max(OCR_MIN_BATCH_SIZE, batch_size//2)
+        del batch
+
+    df = pd.DataFrame(index=pd.RangeIndex(n_rows))
+    for col in columns:
+        if col not in seen:
+            continue
+        if col in numeric:
+            values = np.frombuffer(buffers[col], dtype=np.float64)
+            if col in OCR_INT_COLUMNS and not np.isnan(values).any():
+                values = values.astype(np.int64)
+            df[col] = values
+        else:
+            # infer_objects gives the column the dtype pandas would infer from the documents, e.g. int Course Numbers
+            df[col] = pd.Series(np.array(buffers[col], dtype=object), index=df.index, name=col).infer_objects()
+        buffers[col] = None
+    return df
+
+# Persistent cache of sha224_hash results, keyed by the hashed string, so each instructor and course key is only ever hashed once.
+# It is kept with the snapshots by default, since the source directory may be read-only (e.g. in the docker image)
+ID_CACHE_FILE = os.environ.get('ID_CACHE_FILE', os.path.join(SNAPSHOT_DIR, 'id_cache.json'))
+
+def sha224_hash(x):
+    '''
+    Hashes a string into the integer that the instructor and course IDs are derived from.
+    '''
+    return int(hashlib.sha224(x.encode('utf-8')).hexdigest()[:8], 16)
+
+def load_id_cache(path=None):
+    '''
+    Reads the key->hash cache written by save_id_cache (from ID_CACHE_FILE by default). Returns an empty cache if there
+    isn't one yet.
+    '''
+    path = path or ID_CACHE_FILE
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_id_cache(cache, path=None):
+    '''
+    Writes the key->hash cache used by hash_ids to path (ID_CACHE_FILE by default). The cache only saves time, so a failed
+    write is reported and the load goes on.
+    '''
+    path = path or ID_CACHE_FILE
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print('WARNING: The id cache could not be written to ' + path + ': ' + str(e))
+    return
+
+def hash_ids(keys, cache):
+    '''
+    Converts a series of string keys into IDs with sha224_hash, exactly as keys.apply(str).apply(sha224_hash).astype('int32').abs()
+    would. Each distinct key is hashed once (and only if it isn't already in cache), and the IDs are mapped back onto the rows
+    with the factorized codes.
+    :inputs:
+    keys: pandas series of the strings to hash. Missing values are hashed as the string 'nan'
+    cache: dict of key->sha224_hash(key); new keys are added to it
+    :returns:
+    ids: int32 pandas series of IDs, aligned with keys
+    '''
+    codes, uniques = pd.factorize(keys)
+    uniques = [str(key) for key in uniques] + [str(np.nan)] # the last entry is picked up by missing values, with code -1
+    hashes = np.empty(len(uniques), dtype=np.int64)
+    for i, key in enumerate(uniques):
+        value = cache.get(key)
+        if value is None:
+            value = cache[key] = sha224_hash(key)
+        hashes[i] = value
+    ids = np.abs(hashes.astype(np.int32))
+    return pd.Series(ids[codes], index=keys.index)
+
+def derive_ids(df, cache):
+    '''
+    Adds the 'Instructor ID' and 'course_uuid' columns to a conditioned OCR dataframe (see hash_ids). The IDs are the same
+    ones the site has always used, so existing URLs stay valid.
+    '''
+    df['Instructor ID'] = hash_ids(df['Instructor First Name']+df['Instructor Last Name'], cache)
+    course_ids = hash_ids(df['Subject Code']+df['Course Number'].astype(str)+df['Section Title'].str[:-4], cache)
+    # Convert each distinct course ID to a str once
+    codes, uniques = pd.factorize(course_ids)
+    df['course_uuid'] = np.array([str(uuid) for uuid in uniques], dtype=object)[codes]
+    return df
+
+# Collection in DB_NAME that holds a fingerprint of each (term, college, department) group of the last loaded data.
+# Used by incremental updates to find the groups that changed in the OCR db since the last load.
+LOAD_STATE_COLLECTION = 'load_state'
+# _id prefix of the documents in LOAD_STATE_COLLECTION recording that the offering keys of a raw collection were backfilled
+OFFERING_KEYS_MIGRATION = 'offering_keys_backfilled|'
+
+# Suffix of the shadow collections that staged loads write into before they are swapped in
+STAGING_SUFFIX = '__staging_'
+
+# Every aggregation in aggregate_data happens within these groups, so they are the unit of incremental re-aggregation
+DEPT_KEYS = ['Term Code', 'College Code', 'Subject Code']
+# These uniquely identify a document in the aggregated collection
+AGG_KEYS = ['Term Code', 'course_uuid', 'Instructor ID']
+
+def group_fingerprints(df):
+    '''
+    Computes a content fingerprint for each (term, college, department) group in a conditioned OCR dataframe. The fingerprint
+    is independent of row and column order, so it only changes when the scraped data of the group changes.
+    :inputs:
+    df: conditioned pandas dataframe of the OCR data
+    :returns:
+    fingerprints: pandas dataframe with the DEPT_KEYS columns and a 'fingerprint' (hex str) column, one row per group
+    '''
+    row_hashes = pd.util.hash_pandas_object(df[sorted(df.columns)], index=False).values
+    codes = group_codes(df, DEPT_KEYS)
+    order = np.lexsort((row_hashes, codes))
+    order = order[codes[order] >= 0]
+    sorted_codes = codes[order]
+    sorted_hashes = row_hashes[order]
+    # Split the sorted row hashes at the group boundaries and hash each group's chunk
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(order) else np.array([], dtype=int)
+    ends = np.r_[starts[1:], len(order)]
+    fingerprints = df.iloc[order[starts]][DEPT_KEYS].reset_index(drop=True)
+    fingerprints['fingerprint'] = [hashlib.sha1(sorted_hashes[start:end].tobytes()).hexdigest() for start, end in zip(starts, ends)]
+    return fingerprints
+
+def save_load_state(conn, ocr_coll, fingerprints):
+    '''
+    Replaces the stored group fingerprints of ocr_coll with the given fingerprints dataframe (see group_fingerprints).
+    '''
+    state = conn.get_db_collection(DB_NAME, LOAD_STATE_COLLECTION)
+    state.delete_many({'collection': ocr_coll})
+    records = fingerprints.assign(collection=ocr_coll).to_dict('records')
+    if len(records) > 0:
+        state.insert_many(records)
+    return
+
+def migrate_offering_keys(conn, ocr_coll):
+    '''
+    Backfills the offering keys of the raw ocr_coll documents loaded before the keys were stored (see
+    index_manager.backfill_offering_keys). This is done once: a marker document in LOAD_STATE_COLLECTION records it.
+    :returns:
+    updated: the number of documents that were updated, or None if the collection was already migrated
+    '''
+    state = conn.get_db_collection(DB_NAME, LOAD_STATE_COLLECTION)
+    marker = {'_id': OFFERING_KEYS_MIGRATION + ocr_coll}
+    if state.find_one(marker) is not None:
+        return None
+    updated = backfill_offering_keys(conn.get_db_collection(DB_NAME, ocr_coll))
+    # The marker has no 'collection' field, so it isn't read as a group fingerprint (see incremental_update)
+    state.replace_one(marker, dict(marker, migrated=datetime.utcnow()), upsert=True)
+    return updated
+
+def new_data_version():
+    '''
+    Returns a new, sortable data version string.
+    '''
+    return datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+
+def set_data_version(conn, version):
+    '''
+    Records version as the active data version in DB_NAME.
+    '''
+    conn.get_db_collection(DB_NAME, DATA_VERSION_COLLECTION).replace_one({'_id': 'active'},
+        {'_id': 'active', 'version': version, 'updated': datetime.utcnow()}, upsert=True)
+    return
+
+def copy_indexes(source, target):
+    '''
+    Creates the indexes of the source collection (if it exists) on the target collection.
+    '''
+    for name, info in source.index_information().items():
+        if name == '_id_':
+            continue
+        options = {key: info[key] for key in ['unique', 'sparse', 'partialFilterExpression'] if key in info}
+        target.create_index(info['key'], name=name, **options)
+    return
+
+def ocr_content_hash(collection):
+    '''
+    Returns a hash of the contents of a scraped OCR collection, computed by the database (mongo's dbHash command, or
+    content_hash of the sqlite storage backend), or None if the database can't compute one (e.g. mongomock, or a user
+    without the dbHash privilege).
+    '''
+    try:
+        if hasattr(collection, 'content_hash'):
+            return collection.content_hash()
+        return collection.database.command('dbHash', collections=[collection.name])['collections'].get(collection.name)
+    except Exception:
+        return None
+
+def ocr_source_version(collection, content_hash=None):
+    '''
+    Returns a cheap version string for a scraped OCR collection, built from its document count and its newest _id, so the
+    local snapshots can be reused until the scraper adds to the collection. Documents edited in place change neither, so
+    the content_hash of the collection (see ocr_content_hash) is added when there is one.
+    '''
+    newest = collection.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+    version = str(collection.estimated_document_count()) + '-' + str(newest['_id'] if newest is not None else None)
+    return version + '-' + content_hash if content_hash is not None else version
+
+def condition_ocr_collection(conn, ocr_coll, id_cache, source_version, reuse_snapshot=True):
+    '''
+    Returns the conditioned dataframe of the scraped collection ocr_coll, from its local snapshot if there is one for
+    source_version (and reuse_snapshot), otherwise by reading it from OCR_DB_NAME (and then saving the snapshot).
+    '''
+    df = load_snapshot(ocr_coll, source_version=source_version, mmap=False) if reuse_snapshot else None
+    if df is not None:
+        print('Loaded the conditioned collection -' + ocr_coll + '- from its local snapshot.')
+        if OFFERING_KEY not in df.columns:
+            df[OFFERING_KEY] = offering_keys(df)
+        return df
+
+    # Get the data out of the ocr_db
+    print('Converting the scraped collection -'+ocr_coll+ '- to pd dataframe.')
+    df = read_ocr_collection(conn.get_db_collection(OCR_DB_NAME, ocr_coll))
+
+    # Condition the df prior to aggregation
+    df = df.drop(['_id'],axis=1, errors = 'ignore').rename(columns ={'Individual Responses':'Responses'})
+    derive_ids(df, id_cache)
+    df['Question Number'] = df['Question Number'].astype(int)
+    df['Term Code'] = df['Term Code'].astype(int)
+    # Make sure the First and Last names are in camelcase; i.e. no CHUNG-HAO LEE
+    df['Instructor First Name'] = df['Instructor First Name'].apply(str.title)
+    df['Instructor Last Name'] = df['Instructor Last Name'].apply(str.title)
+    # Key each row by its (course, instructor, term) offering for the keyed lookups of the API
+    df[OFFERING_KEY] = offering_keys(df)
+
+    save_snapshot(df, ocr_coll, source_version=source_version)
+    return df
+
+def conditioned_hash(ocr_coll):
+    '''
+    Returns the content hash of the conditioned snapshot of ocr_coll (see condition_ocr_collection), or None.
+    '''
+    manifest = read_manifest(ocr_coll)
+    return manifest['content_hash'] if manifest is not None else None
+
+def aggregate_ocr_collection(df, ocr_coll, content_hash):
+    '''
+    Returns the aggregated form of the conditioned dataframe df, from its local snapshot if that was aggregated from data with
+    the content_hash of df (see conditioned_hash), otherwise by running aggregate_data (and then saving the snapshot).
+    '''
+    ag_df = load_snapshot('aggregated_' + ocr_coll, conditioned_hash=content_hash, mmap=False)
+    if ag_df is not None:
+        print('Loaded the aggregated collection -' + ocr_coll + '- from its local snapshot.')
+        return ag_df
+    print('Aggregating the -' + ocr_coll + '- collection.')
+    ag_df = aggregate_data(df)
+    save_snapshot(ag_df, 'aggregated_' + ocr_coll, conditioned_hash=content_hash)
+    return ag_df
+
+def staged_update(conn, ocr_coll, df, content_hash=None):
+    '''
+    Loads the conditioned OCR dataframe into versioned shadow copies of the ocr_coll and aggregated_ocr_coll collections,
+    builds their indexes, then swaps each of them in place of the live collection with renameCollection(dropTarget=True).
+    The live collections keep serving complete results for the whole load. Each rename is atomic, but the two renames
+    are not atomic together: between them, a figure reading both collections (CourseFig4TableBar, InstructorFig3TableBar)
+    can pair the new raw documents with the old aggregated ones, while the active data version still names the old load.
+    Such a response can only be cached under the old data version, which the servers drop once they read the new one
+    (see api_functions.DATA_VERSION_TTL).
+    :inputs:
+    conn: a mongo_driver connection
+    ocr_coll: name of the collection being loaded
+    df: conditioned pandas dataframe of the full OCR collection
+    content_hash: the conditioned_hash of df, used to reuse the aggregated snapshot
+    :returns:
+    version: the data version of the newly loaded collections
+    '''
+    version = new_data_version()
+    live_names = [ocr_coll, 'aggregated_' + ocr_coll]
+    shadows = {name: conn.get_db_collection(DB_NAME, name + STAGING_SUFFIX + version) for name in live_names}
+    try:
+        print(f'Uploading unmodified collection - {ocr_coll} - to the staging collection {shadows[ocr_coll].name}')
+        bulk_insert(shadows[ocr_coll], df)
+
+        fingerprints = group_fingerprints(df) # before aggregate_data modifies the Responses
+        ag_df = aggregate_ocr_collection(df, ocr_coll, content_hash)
+        print(f'Uploading aggregated collection - aggregated_{ocr_coll} - to the staging collection {shadows["aggregated_" + ocr_coll].name}')
+        bulk_insert(shadows['aggregated_' + ocr_coll], ag_df)
+
+        for name in live_names:
+            copy_indexes(conn.get_db_collection(DB_NAME, name), shadows[name])
+            ensure_indexes(shadows[name])
+    except Exception:
+        # Leave the live collections as they were
+        for shadow in shadows.values():
+            shadow.drop()
+        raise
+
+    for name in live_names:
+        shadows[name].rename(name, dropTarget=True)
+    save_load_state(conn, ocr_coll, fingerprints)
+    set_data_version(conn, version)
+    tag_snapshot('aggregated_' + ocr_coll, data_version=version)
+    print('The collections ' + ', '.join(live_names) + ' were swapped to data version ' + version + '.')
+    return version
+
+def incremental_update(conn, ocr_coll, df):
+    '''
+    Brings the ocr_coll and aggregated_ocr_coll collections in DB_NAME up to date with the conditioned OCR dataframe df,
+    touching only the (term, college, department) groups whose fingerprint changed since the last load. Only those
+    groups are re-aggregated; their raw documents are replaced and their aggregated documents are upserted, so the rest of
+    each collection keeps serving the API throughout.
+    :inputs:
+    conn: a mongo_driver connection
+    ocr_coll: name of the collection being updated
+    df: conditioned pandas dataframe of the full OCR collection
+    :returns:
+    changed_terms: sorted list of the term codes that had at least one changed group
+    '''
+    fingerprints = group_fingerprints(df)
+    state = conn.get_db_collection(DB_NAME, LOAD_STATE_COLLECTION)
+    stored = pd.DataFrame(list(state.find({'collection': ocr_coll}, {'_id': 0, 'collection': 0})))
+    if len(stored) == 0:
+        stored = fingerprints.iloc[0:0]
+
+    # Compare the current groups against the stored groups
+    merged = fingerprints.merge(stored, on=DEPT_KEYS, how='outer', suffixes=('', '_stored'), indicator=True)
+    changed = merged[(merged['_merge'] == 'left_only') | ((merged['_merge'] == 'both') & (merged['fingerprint'] != merged['fingerprint_stored']))]
+    removed = merged[merged['_merge'] == 'right_only']
+    changed_terms = sorted(set(changed['Term Code']).union(removed['Term Code']))
+    if len(changed_terms) == 0:
+        print('No changes were found in the scraped collection -' + ocr_coll + '-.')
+        return changed_terms
+    print('Re-aggregating ' + str(len(changed)) + ' changed and ' + str(len(removed)) + ' removed department groups in terms: ' + str(changed_terms))
+
+    # Select the rows of the changed groups, along with any other group sharing a course with them
+    group_index = pd.MultiIndex.from_frame(df[DEPT_KEYS])
+    affected = group_index.isin(pd.MultiIndex.from_frame(changed[DEPT_KEYS]))
+    course_index = pd.MultiIndex.from_frame(df[['Term Code', 'course_uuid']])
+    affected |= course_index.isin(course_index[affected])
+    affected |= group_index.isin(group_index[affected])
+    sub_df = df[affected]
+    ag_df = aggregate_data(sub_df.copy())
+
+    group_keys = pd.concat([df.loc[affected, DEPT_KEYS], removed[DEPT_KEYS]]).drop_duplicates()
+    group_filters = [dict(zip(DEPT_KEYS, keys)) for keys in group_keys.values.tolist()]
+
+    # Replace the raw documents of the affected groups
+    collection = conn.get_db_collection(DB_NAME, ocr_coll)
+    collection.bulk_write([DeleteMany(group_filter) for group_filter in group_filters], ordered=False)
+    bulk_insert(collection, sub_df)
+
+    # Upsert the aggregated documents of the affected groups and remove any that no longer exist
+    collection = conn.get_db_collection(DB_NAME, 'aggregated_' + ocr_coll)
+    ops = [ReplaceOne({key: record[key] for key in AGG_KEYS}, record, upsert=True) for record in ag_df.to_dict('records')]
+    new_keys = set(map(tuple, ag_df[AGG_KEYS].values.tolist()))
+    projection = {key: 1 for key in AGG_KEYS}
+    for existing in collection.find({'$or': group_filters}, projection):
+        if tuple(existing.get(key) for key in AGG_KEYS) not in new_keys:
+            ops.append(DeleteOne({'_id': existing['_id']}))
+    if len(ops) > 0:
+        collection.bulk_write(ops, ordered=False)
+
+    for name in [ocr_coll, 'aggregated_' + ocr_coll]:
+        ensure_indexes(conn.get_db_collection(DB_NAME, name))
+    save_load_state(conn, ocr_coll, fingerprints)
+    set_data_version(conn, new_data_version())
+    print('Updated ' + str(len(sub_df)) + ' raw and ' + str(len(ag_df)) + ' aggregated documents of -' + ocr_coll + '-.')
+    return changed_terms
 
 ### DEBUG - force_update is always true - off in prod
-def update_database(force_update=False):
+def update_database(force_update=False, incremental=False, staged=False, conn=None):
     '''
     Get's the data from the OCR scraped databases in the MongoDB named OCR_DB_NAME, and runs aggregations on this data. Ensures that
     each of these datasets (native, unmodified form and the aggregated form) exist within the DB_NAME Mongo database.
     :inputs:
     force_update: boolean denoting whether an update should be forced if the dataset and its aggregated form already exists in DB_NAME.
+    incremental: boolean denoting whether an existing dataset should be updated in place, re-aggregating only the groups whose
+        terms changed in OCR_DB_NAME (see incremental_update). Ignored for collections that don't exist yet.
+    staged: boolean denoting whether a (forced) reload should be written to shadow collections and swapped in once it is
+        complete (see staged_update), instead of clearing and refilling the live collections.
+    conn: optional mongo_driver connection to load with, e.g. one to a local mongod for the benchmarks. Defaults to the
+        production cluster.
     :returns:
     connection: a connection to the mongo db named DB_NAME.
     '''
 
     # Establish DB connection
-    conn = db_conn()
+    if conn is None:
+        conn = db_conn()
+    id_cache = load_id_cache()
 
     # Modify the ocr collections to achieve standard column naming form
     for ocr_coll in ocr_collections:
-        # Get the data out of the ocr_db
-        print('Converting the scraped collection -'+ocr_coll+ '- to pd dataframe.')
-        ocr_db = conn.get_db_collection(OCR_DB_NAME, ocr_coll)
-        df = pd.DataFrame(list(ocr_db.find()))
-
-        # Define new hash function
-        sha224_hash = lambda x: int(hashlib.sha224(x.encode('utf-8')).hexdigest()[:8], 16)
-
-        # Condition the df prior to aggregation
-        df = df.drop(['_id'],axis=1, errors = 'ignore').rename(columns ={'Individual Responses':'Responses'})
-        df['Instructor ID'] = (df['Instructor First Name']+df['Instructor Last Name']).apply(str).apply(sha224_hash).astype('int32').abs()
-        df['course_uuid'] = (df['Subject Code']+df['Course Number'].apply(str)+df['Section Title'].apply(lambda x: x[:-4])).apply(str).apply(sha224_hash).astype('int32').abs().apply(str) 
-        df['Question Number'] = df['Question Number'].astype(int)
-        df['Term Code'] = df['Term Code'].astype(int)
-        # Make sure the First and Last names are in camelcase; i.e. no CHUNG-HAO LEE
-        df['Instructor First Name'] = df['Instructor First Name'].apply(str.title)
-        df['Instructor Last Name'] = df['Instructor Last Name'].apply(str.title)
+        # Get the conditioned data, from the ocr_db or its local snapshot
+        ocr_collection = conn.get_db_collection(OCR_DB_NAME, ocr_coll)
+        content_hash = ocr_content_hash(ocr_collection)
+        source_version = ocr_source_version(ocr_collection, content_hash)
+        # Without a content hash an edit in place leaves the source version as it was, so forced and incremental loads
+        # (which are run to pick up such changes) read the collection again instead of its snapshot
+        reuse_snapshot = content_hash is not None or not (force_update or incremental)
+        df = condition_ocr_collection(conn, ocr_coll, id_cache, source_version, reuse_snapshot)
 
         print('Loading '+ocr_coll)
+        # A raw collection that is kept (or updated in place) may hold documents loaded before the offering keys were
+        # stored, which are backfilled once
+        if not force_update and conn.collection_existence_check(DB_NAME, ocr_coll):
+            migrate_offering_keys(conn, ocr_coll)
+        if incremental and conn.collection_existence_check(DB_NAME, ocr_coll) and conn.collection_existence_check(DB_NAME, 'aggregated_' + ocr_coll):
+            incremental_update(conn, ocr_coll, df)
+            continue
+        if staged and (force_update or not conn.collection_existence_check(DB_NAME, ocr_coll) or not conn.collection_existence_check(DB_NAME, 'aggregated_' + ocr_coll)):
+            staged_update(conn, ocr_coll, df, conditioned_hash(ocr_coll))
+            continue
+
         # If the collection doesnt exist or if the update is forced
 
         if conn.collection_existence_check(DB_NAME, ocr_coll)==False or force_update:
@@ -62,11 +519,8 @@ def update_database(force_update=False):
             collection.delete_many({})
             print(f'Uploading unmodified collection - {ocr_coll} - to {DB_NAME}')
 
-            for i in tqdm(range(n_splits)): # Splits df into n_splits parts
-                # load the db for the given data file into a json format
-                records = df[(i)*int(len(df)/n_splits):(i+1)*int(len(df)/n_splits)].to_dict('records')
-                # try to update the database with the given data file 
-                result = collection.insert_many(records)
+            bulk_insert(collection, df)
+            ensure_indexes(collection)
 
             # Update the user on what happened
             print('A collection called -' + ocr_coll + '- was added to the database '+ DB_NAME + '.')
@@ -79,22 +533,22 @@ def update_database(force_update=False):
             collection = conn.get_db_collection(DB_NAME, 'aggregated_' + ocr_coll)
 
             # Create the aggregated database 
-            print('Aggregating the -' + ocr_coll + '- collection. This typically takes 5-10 minutes.')
-            ag_df = aggregate_data(df)
-
-            # load the db for the given data file into a json format
-            ag_records = json.loads(ag_df.T.to_json()).values()
+            fingerprints = group_fingerprints(df) # before aggregate_data modifies the Responses
+            ag_df = aggregate_ocr_collection(df, ocr_coll, conditioned_hash(ocr_coll))
 
             # Delete all of the current contents from the collection
             collection.delete_many({})
 
             # Push the aggregated df to mongo
             print(f'Uploading aggregated collection - aggregated_{ocr_coll}- to {DB_NAME}')
-            for i in tqdm(range(n_splits)): # Splits ag_df into n_splits parts
-                # load the db for the given data file into a json format
-                records = ag_df[(i)*int(len(ag_df)/n_splits):(i+1)*int(len(ag_df)/n_splits)].to_dict('records')
-                # try to update the database with the given data file 
-                result = collection.insert_many(records)
+            bulk_insert(collection, ag_df)
+            ensure_indexes(collection)
+
+            # Record what was loaded so later incremental updates can find what changed
+            save_load_state(conn, ocr_coll, fingerprints)
+            version = new_data_version()
+            set_data_version(conn, version)
+            tag_snapshot('aggregated_' + ocr_coll, data_version=version)
 
             # Update the user on what happened
             print('A collection called aggregated_'+ ocr_coll + ' was added to the database '+ DB_NAME + '.')
@@ -102,9 +556,11 @@ def update_database(force_update=False):
         else:
             print('A collection called aggregated_'+ ocr_coll + ' already exists in the database '+ DB_NAME + ' and was unmodified.')
             
+    save_id_cache(id_cache)
+
     # Return the connection to the collection
     return conn
     
 if __name__ == '__main__':
     # Update the database
-    update_database(force_update=True)
\ No newline at end of file
+    update_database(force_update=True, staged=True)
\ No newline at end of file
@@ -0,0 +1,101 @@
+'''
+This script declares the mongo indexes needed by the queries in api_functions.py, and contains the functions used to create
+them (during data_loader.update_database) and to check them (at server startup).
+'''
+
+# global/pypi
+import pandas as pd
+from pymongo import ASCENDING, IndexModel, ReplaceOne
+
+# Indexes of the aggregated collections. Each one matches a filter shape issued by the figure APIs, with the equality field
+# first and the "Term Code" ($in CURRENT_SEMESTERS or equality) second
+AGG_INDEXES = [
+    [('course_uuid', ASCENDING), ('Term Code', ASCENDING)], # Course figures
+    [('Instructor ID', ASCENDING), ('Term Code', ASCENDING)], # Instructor figures and chip, instructors in CourseFig1Table
+    [('Subject Code', ASCENDING), ('Term Code', ASCENDING)], # Department comparisons in CourseFig2Chart and InstructorFig2Timeseries
+    [('Term Code', ASCENDING)], # SearchAutocomplete
+]
+
+# Field of the unmodified (raw) documents holding the key of their (course, instructor, term) offering, see offering_keys
+OFFERING_KEY = 'Offering Key'
+
+# Indexes of the unmodified (raw) collections
+RAW_INDEXES = [
+    [('Instructor ID', ASCENDING), ('Term Code', ASCENDING), ('Subject Code', ASCENDING), ('Course Number', ASCENDING)], # InstructorFig3TableBar
+    [(OFFERING_KEY, ASCENDING)], # CourseFig4TableBar
+]
+
+def offering_keys(df):
+    '''
+    Returns the offering keys (str series, e.g. '<course_uuid>|<Instructor ID>|<Term Code>') of the rows of a dataframe with
+    the 'course_uuid', 'Instructor ID' and 'Term Code' columns. data_loader.py stores them in the OFFERING_KEY field of the
+    raw documents, so the raw documents of a list of offerings can be fetched with a single indexed $in.
+    '''
+    return df['course_uuid'].astype(str) + '|' + df['Instructor ID'].astype(str) + '|' + df['Term Code'].astype(str)
+
+def backfill_offering_keys(collection, batch_size=1000):
+    '''
+    Adds the OFFERING_KEY field to the raw documents of the collection that don't have it, i.e. the documents loaded before
+    the keys were stored (CourseFig4TableBar looks the raw documents up by their key, and would find none of those). It scans
+    the whole collection, so data_loader.migrate_offering_keys runs it only once per collection.
+    Returns: the number of documents that were updated
+    '''
+    updated = 0
+    batch = []
+    for doc in collection.find({OFFERING_KEY: {'$exists': False}}):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            updated += replace_with_offering_keys(collection, batch)
+            batch = []
+    if len(batch) > 0:
+        updated += replace_with_offering_keys(collection, batch)
+    if updated > 0:
+        print('Added the offering keys to ' + str(updated) + ' documents of ' + collection.name + '.')
+    return updated
+
+def replace_with_offering_keys(collection, docs):
+    # Replaces the raw documents docs with copies holding their offering key, returns the number of documents replaced
+    keys = offering_keys(pd.DataFrame([{field: doc.get(field) for field in ['course_uuid', 'Instructor ID', 'Term Code']} for doc in docs]))
+    collection.bulk_write([ReplaceOne({'_id': doc['_id']}, dict(doc, **{OFFERING_KEY: key})) for doc, key in zip(docs, keys)], ordered=False)
+    return len(docs)
+
+def declared_indexes(coll_name):
+    '''
+    Returns the list of index key specifications declared for a collection (or a staging copy of it).
+    '''
+    if coll_name.startswith('aggregated_'):
+        return AGG_INDEXES
+    return RAW_INDEXES
+
+def missing_indexes(collection):
+    '''
+    Returns the declared index key specifications that the collection does not have.
+    '''
+    existing = [[(field, int(direction)) for field, direction in info['key']] for info in collection.index_information().values()]
+    return [keys for keys in declared_indexes(collection.name) if keys not in existing]
+
+def ensure_indexes(collection):
+    '''
+    Creates any of the declared indexes that the collection does not have yet.
+    '''
+    missing = missing_indexes(collection)
+    if len(missing) > 0:
+        collection.create_indexes([IndexModel(keys) for keys in missing])
+        print('Created ' + str(len(missing)) + ' indexes on ' + collection.name + '.')
+    return
+
+def check_indexes(db, db_name, collection_names):
+    '''
+    Checks that each of the collections in collection_names has its declared indexes, and prints a warning for any that
+    are missing (every request hitting those filters would scan the collection).
+    :Returns:
+    - missing: dict of collection name to its missing index key specifications
+    '''
+    missing = {}
+    for coll_name in collection_names:
+        coll_missing = missing_indexes(db.get_db_collection(db_name, coll_name))
+        for keys in coll_missing:
+            print('WARNING: The collection ' + coll_name + ' is missing the index ' + str(keys) + '. Run data_loader.update_database to create it.')
+        if len(coll_missing) > 0:
+            missing[coll_name] = coll_missing
+    return missing
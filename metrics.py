@@ -0,0 +1,209 @@
+'''
+This script contains the instrumentation of the api servers. Every request is timed, per endpoint, and the time spent in
+each stage of serving it is added up:
+    mongo - waiting on mongo queries (api_functions.query_df_from_mongo, pushdown.aggregate_df)
+    memory - in-memory queries of a ServingEngine (see serving_engine.py)
+    frame - building DataFrames from the fetched documents
+    pandas - the rest of the figure functions, i.e. their pandas reductions
+    encode - json encoding of the responses (see response_encoder.py)
+Stage times are exclusive: the time of a query made inside a figure function is counted in mongo, not pandas. Queries run
+concurrently (async_server.py) each add their own time.
+
+The documents and bytes fetched by the queries are counted per collection. Everything is rendered in the Prometheus text
+format by render (the /api/v0/metrics route), and with SERVER_TIMING=1 the stage times of each request are also sent back
+in its Server-Timing header.
+'''
+
+# global/pypi
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict
+
+# Upper bounds (seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# Add a Server-Timing header with the stage times of each request to its response if SERVER_TIMING=1
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+
+# Prefix of the metric names
+METRIC_PREFIX = 'stev_'
+
+# Help text and type of each metric
+METRIC_HELP = OrderedDict([
+    ('request_seconds', ('histogram', 'Time to serve a request, by endpoint')),
+    ('request_errors_total', ('counter', 'Requests that raised an exception or were answered with a 5xx status, by endpoint')),
+    ('stage_seconds', ('histogram', 'Time spent in each stage of serving a request, by endpoint and stage')),
+    ('queries_total', ('counter', 'Queries made, by collection')),
+    ('query_documents_total', ('counter', 'Documents fetched by the queries, by collection')),
+    ('query_bytes_total', ('counter', 'BSON bytes fetched by the mongo queries, by collection')),
+])
+
+class Histogram():
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+class Metrics():
+    # Registry of the counters and histograms, keyed by (metric name, label items)
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def render(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        with self.lock:
+            for name, (kind, help_text) in METRIC_HELP.items():
+                full_name = METRIC_PREFIX + name
+                lines.append('# HELP ' + full_name + ' ' + help_text)
+                lines.append('# TYPE ' + full_name + ' ' + kind)
+                if kind == 'counter':
+                    for (metric, labels), value in sorted(self.counters.items()):
+                        if metric == name:
+                            lines.append(full_name + format_labels(labels) + ' ' + repr(value))
+                    continue
+                for (metric, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(full_name + '_bucket' + format_labels(labels + (('le', repr(bound)),)) + ' ' + str(cumulative))
+                    lines.append(full_name + '_bucket' + format_labels(labels + (('le', '+Inf'),)) + ' ' + str(histogram.count))
+                    lines.append(full_name + '_sum' + format_labels(labels) + ' ' + repr(histogram.sum))
+                    lines.append(full_name + '_count' + format_labels(labels) + ' ' + str(histogram.count))
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    # Formats (name, value) label items as {name="value",...}
+    if len(labels) == 0:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels]
+    return '{' + ','.join(name + '="' + value + '"' for name, value in escaped) + '}'
+
+# The metrics of this process
+registry = Metrics()
+
+class RequestTimer():
+    # Stage times (seconds) of one request
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+        # Set when the response has a 5xx status
+        self.failed = False
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self):
+        # Returns the Server-Timing header value of the stage times, e.g. 'mongo;dur=12.1, pandas;dur=3.4'
+        with self.lock:
+            return ', '.join(stage + ';dur=' + '{:.1f}'.format(seconds*1000) for stage, seconds in self.stages.items())
+
+# The timer of the request being served, and the stage being timed (a dict with the time of the stages nested in it)
+current_request = contextvars.ContextVar('current_request', default=None)
+current_stage = contextvars.ContextVar('current_stage', default=None)
+
+def start_request(endpoint):
+    '''
+    Starts timing a request to endpoint (a label like '/api/v0/instructors/<instructor_id>/figure2').
+    '''
+    timer = RequestTimer(endpoint)
+    current_request.set(timer)
+    return timer
+
+def finish_request(failed=False):
+    '''
+    Records the latency and stage times of the current request in the registry, and counts it as an error if it failed
+    (failed, or its response was marked as failed).
+    Returns: the RequestTimer of the request, or None if no request was being timed
+    '''
+    timer = current_request.get()
+    if timer is None:
+        return None
+    current_request.set(None)
+    registry.observe('request_seconds', {'endpoint': timer.endpoint}, time.perf_counter() - timer.start)
+    if failed or timer.failed:
+        registry.inc('request_errors_total', {'endpoint': timer.endpoint})
+    for stage_name, seconds in timer.stages.items():
+        registry.observe('stage_seconds', {'endpoint': timer.endpoint, 'stage': stage_name}, seconds)
+    return timer
+
+@contextmanager
+def stage(name):
+    '''
+    Context manager adding the time spent in its block, minus that of the stages nested in it, to the stage name of the
+    current request. Does nothing outside of a request.
+    '''
+    timer = current_request.get()
+    if timer is None:
+        yield
+        return
+    parent = current_stage.get()
+    frame = {'nested': 0.0}
+    token = current_stage.set(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        current_stage.reset(token)
+        if parent is not None:
+            parent['nested'] += elapsed
+        timer.add(name, elapsed - frame['nested'])
+
+def count_query(coll_name, documents, nbytes=None):
+    # Counts a query of coll_name, the documents it fetched and their size in bytes (if known)
+    labels = {'collection': coll_name}
+    registry.inc('queries_total', labels)
+    registry.inc('query_documents_total', labels, documents)
+    if nbytes is not None:
+        registry.inc('query_bytes_total', labels, nbytes)
+
+def endpoint_label(rule, view_args, label_values={}):
+    '''
+    Returns the endpoint label of a request matched to the url rule (e.g. '/api/v0/instructors/<int:instructor_id>/<string:api_suffix>'):
+    the rule with the converters of its variables dropped, and the values of the variables in label_values (e.g.
+    {'api_suffix': {'figure1', 'figure2'}}) filled in when they are among the known values. Any other value is left as its
+    placeholder, so requests for arbitrary urls can't add labels without bound.
+    '''
+    if rule is None:
+        return 'unmatched'
+    label = rule
+    for name, value in (view_args or {}).items():
+        for converter in ['string', 'int', 'path', '']:
+            placeholder = '<' + (converter + ':' if converter else '') + name + '>'
+            if placeholder in label:
+                label = label.replace(placeholder, str(value) if value in label_values.get(name, ()) else '<' + name + '>')
+    return label
@@ -1,12 +1,17 @@
 import datetime 
 import pprint
+import os
 from pymongo import MongoClient
 
+# The cluster to connect to; MONGO_URI can point the servers at another one, e.g. a local mongod for load tests
+MONGO_URI = os.environ.get('MONGO_URI', "mongodb+srv://zach:G8GqPsUgP6b9VUvc"
+"@cluster0-svcn3.gcp.mongodb.net/test?retryWrites=true")
+
 class mongo_driver():
-    def __init__(self):
-        # create mongo client (just connecting to local db)
-        self.client = MongoClient("mongodb+srv://zach:G8GqPsUgP6b9VUvc"
-        "@cluster0-svcn3.gcp.mongodb.net/test?retryWrites=true")
+    def __init__(self, client=None):
+        # create mongo client (just connecting to local db), unless another client is given, e.g. a local mongod or
+        # mongomock for the benchmarks
+        self.client = client if client is not None else MongoClient(MONGO_URI)
 
     def get_client(self):
         return self.client
@@ -23,12 +28,28 @@ class mongo_driver():
     def collection_existence_check(self, db_name, check_collection):
         # Checks to see if a collection exists within a database
         db = self.get_db(db_name)
-        collections = db.collection_names()
+        collections = db.list_collection_names()
         if check_collection in collections:
             return True
         else:
             return False
 
+class async_mongo_driver():
+    # Non-blocking (motor) version of mongo_driver for async_server.py. Its collections return awaitables, e.g.
+    # await coll.find(coll_filter).to_list(None)
+    def __init__(self):
+        # motor is only needed by the async server, so it is imported here
+        from motor.motor_asyncio import AsyncIOMotorClient
+        self.client = AsyncIOMotorClient(MONGO_URI)
+
+    def get_client(self):
+        return self.client
+
+    def get_db(self, db_name):
+        return self.client[db_name]
+
+    def get_db_collection(self, db_name, collection_name):
+        return self.get_db(db_name)[collection_name]
 
 if __name__ == '__main__':
     # make a post and attempt to insert
@@ -0,0 +1,58 @@
+'''
+This script contains the pre-encoded response bodies of server.py for the large responses that only change with the data
+version, like the course and instructor lists of the autocomplete endpoints. The json body is serialized once, along with
+its gzip (and, if the brotli package is installed, brotli) compressed variants and an ETag of the body, so each request
+only picks the variant the client accepts, or answers 304 Not Modified when the client already has it.
+'''
+
+# global/pypi
+import gzip
+import hashlib
+from flask import Response
+
+# local
+import response_encoder
+
+# brotli is optional; without it the payloads only have the plain and gzip variants
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compression levels of the pre-encoded variants. They are only compressed once per data version, so use the best ones
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+def encode_payload(obj):
+    '''
+    Serializes obj to a json body and compresses it.
+    Returns:
+    payload - a dict with the 'body' bytes, the 'gzip' and 'br' variants of it (bytes, or None for 'br' without brotli), and
+    the 'etag' (str) of the body
+    '''
+    body = response_encoder.dumps(obj)
+    return {'body': body,
+            'gzip': gzip.compress(body, GZIP_LEVEL),
+            'br': brotli.compress(body, quality=BROTLI_QUALITY) if brotli is not None else None,
+            'etag': hashlib.sha256(body).hexdigest()[:32]}
+
+def payload_response(payload, request, response_class=Response):
+    '''
+    Returns the flask response serving a payload of encode_payload to request: 304 if its If-None-Match has the payload's
+    ETag, otherwise the smallest variant allowed by its Accept-Encoding. response_class is the class of the response (e.g.
+    quart's for async_server.py).
+    '''
+    # The ETag is weak since the same body is served with different content encodings
+    if request.if_none_match.contains_weak(payload['etag']):
+        response = response_class(b'', status=304)
+    else:
+        for encoding in ['br', 'gzip']:
+            if payload[encoding] is not None and request.accept_encodings[encoding] > 0:
+                response = response_class(payload[encoding], mimetype='application/json')
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = response_class(payload['body'], mimetype='application/json')
+    response.set_etag(payload['etag'], weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
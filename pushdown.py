@@ -0,0 +1,195 @@
+'''
+This script contains the pushdown backend of some of the figure apis in api_functions.py. Instead of downloading every
+matching document and reducing it in pandas, each figure runs its reductions in mongo as $match/$sort/$group aggregation
+pipelines, so only the grouped result (one document per course/term/instructor group) crosses the network; the python side
+only orders and formats those few rows. The responses are the same as those of the pandas versions. "First" documents
+(e.g. the one an instructor name is read from, or the order courses appear in) are the first in _id order, i.e. in the order
+the documents were inserted.
+
+The backend of each figure is selected with the FIGURE_BACKENDS environment variable, e.g.
+FIGURE_BACKENDS="InstructorChipAPI=pushdown,CourseFig3Timeseries=pushdown", or FIGURE_BACKENDS=pushdown for every figure
+that has a pushdown version (see figure_function). The pipelines need mongo: with another storage backend (STORAGE_BACKEND,
+see storage.py) the pandas version of every figure is used.
+'''
+
+# global/pypi
+import os
+import pprint
+import pandas as pd
+from datetime import datetime
+
+# local
+import api_functions as api
+import term_calendar
+import metrics
+import storage
+
+def aggregate_df(db, pipeline, collections=api.AGG_COLLECTION_NAMES):
+    """
+    Runs an aggregation pipeline on the collections, in order, like api_functions.query_df_from_mongo runs a filter.
+    Returns:
+    df - a pd DataFrame of the result documents of the first collection with any, with the fields of the group _id as columns
+    coll_name - the collection name (str) where the pipeline had results
+    """
+    for coll_name in collections:
+        with metrics.stage('mongo'):
+            docs = list(db.get_db_collection(api.DB_NAME, coll_name).aggregate(pipeline))
+        metrics.count_query(coll_name, len(docs))
+        if len(docs) > 0:
+            return pd.DataFrame([dict(doc.pop('_id'), **doc) for doc in docs]), coll_name
+
+    print('The below pipeline did not match any documents within the mongo collections.')
+    pprint.pprint(pipeline)
+    raise Exception('The filter was not found in the mongo collection.')
+
+def first_by_id(groups):
+    # Sorts grouped results by the _id of the first document of each group
+    return groups.sort_values('first_id', kind='mergesort').reset_index(drop=True)
+
+def CourseFig3Timeseries(db, valid_uuid):
+    """
+    Pushdown version of api_functions.CourseFig3Timeseries. The course documents are grouped by (course title, term, instructor)
+    in mongo, keeping the ratings of the first document of each group.
+    """
+    pipeline = [{'$match': api.course_filter(valid_uuid)},
+                {'$sort': {'_id': 1}},
+                {'$group': {'_id': {'title': '$Course Title', 'term': '$Term Code', 'instructor': '$Instructor ID'},
+                            'first_id': {'$min': '$_id'},
+                            'documents': {'$sum': 1},
+                            'course number': {'$first': '$Course Number'},
+                            'subject': {'$first': '$Subject Code'},
+                            'course rating': {'$first': '$Avg Course Rating'},
+                            'dept rating': {'$first': '$Avg Department Rating'},
+                            'first name': {'$first': '$Instructor First Name'},
+                            'last name': {'$first': '$Instructor Last Name'},
+                            'instructor rating': {'$first': '$Avg Instructor Rating In Section'}}}]
+    groups, _ = aggregate_df(db, pipeline)
+    groups = first_by_id(groups)
+
+    # Only keep the most popular title of the course (see api_functions.drop_duplicate_courses)
+    title = groups.groupby('title', sort=False)['documents'].sum().idxmax()
+    groups = groups[groups['title'] == title]
+
+    response = {'result':{'course over time':{}, 'dept over time':{}, 'instructors':[]}}
+    response['result']['course number'] = int(groups['course number'].iloc[0])
+    response['result']['course over time'] = {'ratings':[], 'course name':title}
+
+    # The semesters of the course in order of term (oldest first), with the ratings of the first document of each
+    term_codes = term_calendar.sort_terms(groups['term'], recent_first=False)
+    terms = term_calendar.term_label(term_codes).tolist()
+    term_df = groups.drop_duplicates('term').set_index('term').loc[term_codes]
+    response['result']['course over time']['semesters'] = terms
+    response['result']['course over time']['ratings'] = term_df['course rating'].tolist()
+    response['result']['dept over time'] = {'dept name': groups['subject'].iloc[0], 'ratings': term_df['dept rating'].tolist(), 'semesters': terms}
+
+    # The instructors in the order they appear, each with their semesters in the order they appear
+    for _, sub_df in groups.groupby('instructor', sort=False):
+        response['result']['instructors'].append({'name': sub_df['first name'].iloc[0] + ' ' + sub_df['last name'].iloc[0],
+                                                  'semesters': term_calendar.term_label(sub_df['term']).tolist(),
+                                                  'ratings': sub_df['instructor rating'].tolist()})
+    return response
+
+def InstructorFig1Table(db, instructor_id):
+    """
+    Pushdown version of api_functions.InstructorFig1Table. The instructor's documents are grouped by (course, term) in mongo,
+    then the documents of those courses are grouped by course, with the instructor's own ratings summed separately.
+    """
+    pipeline = [{'$match': api.instructor_filter(instructor_id)},
+                {'$sort': {'_id': 1}},
+                {'$group': {'_id': {'course': '$course_uuid', 'term': '$Term Code'},
+                            'first_id': {'$min': '$_id'},
+                            'first name': {'$first': '$Instructor First Name'},
+                            'last name': {'$first': '$Instructor Last Name'}}}]
+    taught, coll_name = aggregate_df(db, pipeline)
+
+    # The courses in the order of the most recent semester they were taught
+    taught['sorter'] = -term_calendar.term_ordinal(taught['term'])
+    taught = first_by_id(taught).sort_values('sorter', kind='mergesort')
+    course_list = taught['course'].unique().tolist()
+
+    rating = '$Avg Instructor Rating In Section'
+    is_instructor = {'$eq': ['$Instructor ID', instructor_id]}
+    pipeline = [{'$match': {'$and': [{'course_uuid': {'$in': course_list}}, {'Term Code': {'$in': api.CURRENT_SEMESTERS}}]}},
+                {'$sort': {'_id': 1}},
+                {'$group': {'_id': {'course': '$course_uuid'},
+                            'course name': {'$first': '$Course Title'},
+                            'course number': {'$first': '$Course Number'},
+                            'dept name': {'$first': '$Subject Code'},
+                            'avg_course_rating': {'$avg': rating},
+                            'instructor total': {'$sum': {'$cond': [is_instructor, rating, 0]}},
+                            'instructor documents': {'$sum': {'$cond': [is_instructor, 1, 0]}}}}]
+    courses, coll_name = aggregate_df(db, pipeline, collections=[coll_name])
+    courses = courses.set_index('course').loc[course_list]
+
+    ret_json = {"result": {"courses": []}}
+    for crs, row in zip(course_list, courses.to_dict('records')):
+        ret_json["result"]["courses"].append({
+            "course name": row['course name'],
+            'course number': int(row['course number']),
+            'dept name': row['dept name'],
+            "instr_rating_in_course": row['instructor total']/row['instructor documents'],
+            'avg_course_rating': row['avg_course_rating'],
+            "term": term_calendar.terms_string(taught.loc[taught['course'] == crs, 'term'])
+            })
+    ret_json['result']['instructor name'] = str(taught['first name'].iloc[0]) + ' ' + str(taught['last name'].iloc[0])
+    return ret_json
+
+def InstructorChipAPI(db, instructor_id):
+    """
+    Pushdown version of api_functions.InstructorChipAPI. The instructor's documents are grouped by (term, department) in mongo.
+    """
+    pipeline = [{'$match': {"Instructor ID": instructor_id}},
+                {'$sort': {'_id': 1}},
+                {'$group': {'_id': {'term': '$Term Code', 'subject': '$Subject Code'},
+                            'first_id': {'$min': '$_id'},
+                            'first name': {'$first': '$Instructor First Name'},
+                            'last name': {'$first': '$Instructor Last Name'}}}]
+    groups, _ = aggregate_df(db, pipeline)
+    groups = first_by_id(groups)
+
+    # Get the oldest term and the number of years teaching since then
+    oldest_term = term_calendar.term_label(term_calendar.sort_terms(groups['term'])[-1])
+    diff = datetime.today().year - int(oldest_term[-4:])
+
+    instr_name = groups['first name'].iloc[0] + ' ' + groups['last name'].iloc[0]
+    subject_list = list(groups['subject'].unique())
+    return {'result':{'name': instr_name, 'most_recent_semester': oldest_term, 'num_years':diff, 'depts_taught':subject_list}}
+
+# The figures that have a pushdown version
+PUSHDOWN_FIGURES = {'CourseFig3Timeseries': CourseFig3Timeseries, 'InstructorFig1Table': InstructorFig1Table,
+                    'InstructorChipAPI': InstructorChipAPI}
+
+def parse_backends(spec, storage_backend=storage.STORAGE_BACKEND):
+    '''
+    Parses a FIGURE_BACKENDS specification ('pushdown', 'pandas', or comma separated name=backend pairs) into a dict of
+    figure name -> backend for each of PUSHDOWN_FIGURES. Every figure falls back to 'pandas' if storage_backend (see
+    storage.STORAGE_BACKEND) has no aggregation pipelines, i.e. isn't mongo.
+    '''
+    backends = {name: 'pandas' for name in PUSHDOWN_FIGURES}
+    for item in [item.strip() for item in spec.split(',') if item.strip()]:
+        if '=' in item:
+            name, backend = [part.strip() for part in item.split('=', 1)]
+            names = [name]
+        else:
+            backend = item
+            names = list(PUSHDOWN_FIGURES)
+        if backend not in ['pandas', 'pushdown'] or any(name not in PUSHDOWN_FIGURES for name in names):
+            raise Exception('Invalid FIGURE_BACKENDS entry: ' + item)
+        for name in names:
+            backends[name] = backend
+    if storage_backend != 'mongo' and 'pushdown' in backends.values():
+        print('The ' + storage_backend + ' storage backend does not support the pushdown figures; the pandas figures are used instead.')
+        backends = {name: 'pandas' for name in PUSHDOWN_FIGURES}
+    return backends
+
+# Backend ('pandas' or 'pushdown') of each figure in PUSHDOWN_FIGURES
+FIGURE_BACKENDS = parse_backends(os.environ.get('FIGURE_BACKENDS', ''))
+
+def figure_function(func):
+    '''
+    Returns the function serving the figure api func (e.g. api_functions.InstructorChipAPI): its pushdown version if
+    FIGURE_BACKENDS selects it, otherwise func itself.
+    '''
+    if FIGURE_BACKENDS.get(func.__name__) == 'pushdown':
+        return PUSHDOWN_FIGURES[func.__name__]
+    return func
@@ -0,0 +1,68 @@
+'''
+This script contains the in-process cache for the serialized responses of the figure endpoints in server.py. Responses are
+keyed by (endpoint, id, data version); the whole cache is dropped when a new data version is loaded, and the least recently
+used responses are evicted to stay under a memory budget.
+'''
+
+# global/pypi
+import os
+import threading
+from collections import OrderedDict
+
+# Memory budget of the response cache, in MB of serialized responses
+RESPONSE_CACHE_MAX_MB = float(os.environ.get('RESPONSE_CACHE_MAX_MB', 64))
+
+class ResponseCache():
+    def __init__(self, max_bytes=int(RESPONSE_CACHE_MAX_MB*1e6)):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def set_version(self, version):
+        # Drops every cached response if the data version changed
+        with self.lock:
+            if version != self.version:
+                if len(self.entries) > 0:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+
+    def get(self, key):
+        # Returns the cached response for key, or None
+        with self.lock:
+            body = self.entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        # Caches a serialized response (str or bytes), evicting the least recently used responses to stay under max_bytes
+        with self.lock:
+            if len(body) > self.max_bytes:
+                return
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        # Returns a dict of the cache statistics
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'version': self.version, 'entries': len(self.entries), 'bytes': self.size, 'max bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'hit rate': self.hits/lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
@@ -0,0 +1,93 @@
+'''
+This script contains the json encoding of the api responses of server.py (and of the pre-encoded payloads, see payloads.py).
+The figure functions return numpy scalars and arrays and pandas objects mixed with python values; these are encoded as they
+are, with no conversion of their elements in python: numpy float arrays are rounded with np.round, and orjson (when
+installed) serializes numpy scalars and arrays natively in C. Without orjson the stdlib json encoder is used, with the numpy
+and pandas objects converted by tolist.
+
+Floats are rounded once here, to RESPONSE_FLOAT_DIGITS decimals, and NaNs are encoded as null.
+'''
+
+# global/pypi
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# orjson is optional; without it responses are encoded by the (slower) stdlib json encoder
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Number of decimals the floats of the responses are rounded to. An empty RESPONSE_FLOAT_DIGITS turns off the rounding
+RESPONSE_FLOAT_DIGITS = os.environ.get('RESPONSE_FLOAT_DIGITS', '4')
+RESPONSE_FLOAT_DIGITS = int(RESPONSE_FLOAT_DIGITS) if RESPONSE_FLOAT_DIGITS.strip() else None
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+
+# Types that are encoded as they are
+PLAIN_TYPES = {str, int, bool, type(None)}
+FLOAT_TYPE = {float}
+
+def prepare(obj, digits=RESPONSE_FLOAT_DIGITS):
+    '''
+    Returns obj with its floats rounded to digits decimals (unless digits is None) and NaNs replaced by None, and its pandas
+    objects replaced by numpy arrays (a DataFrame by a dict of its columns). Containers are copied, numpy arrays are only
+    copied when rounded.
+    '''
+    # The exact type is checked first, since most of a response is dicts and lists of python strs, ints and floats. Those
+    # are handled inline in the containers, as a call per value would cost more than the value itself
+    kind = type(obj)
+    if kind is dict:
+        return {key: value if type(value) in PLAIN_TYPES else
+                round(value, digits) if type(value) is float and value == value and digits is not None else
+                prepare(value, digits) for key, value in obj.items()}
+    if kind is list or kind is tuple:
+        # Lists of floats (e.g. the ratings of a timeseries) are rounded at once, as a numpy array
+        if digits is not None and len(obj) > 1 and set(map(type, obj)) == FLOAT_TYPE:
+            return np.round(np.array(obj, dtype=np.float64), digits)
+        return [value if type(value) in PLAIN_TYPES else
+                round(value, digits) if type(value) is float and value == value and digits is not None else
+                prepare(value, digits) for value in obj]
+    if kind in PLAIN_TYPES:
+        return obj
+    if isinstance(obj, (float, np.floating)):
+        if obj != obj:
+            return None
+        return round(float(obj), digits) if digits is not None else float(obj)
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind == 'f' and digits is not None:
+            return np.round(obj, digits)
+        if obj.dtype.kind == 'O':
+            return prepare(obj.tolist(), digits)
+        return obj
+    if isinstance(obj, (pd.Series, pd.Index)):
+        return prepare(obj.values, digits)
+    if isinstance(obj, pd.DataFrame):
+        return {str(column): prepare(obj[column].values, digits) for column in obj.columns}
+    if isinstance(obj, dict):
+        return prepare(dict(obj), digits)
+    if isinstance(obj, (list, tuple)):
+        return prepare(list(obj), digits)
+    return obj
+
+def encode_default(obj):
+    # Encodes the values the stdlib json encoder doesn't know: numpy scalars and arrays (with NaN as null)
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind == 'f':
+            return np.where(np.isnan(obj), None, obj).tolist()
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('Object of type ' + type(obj).__name__ + ' is not JSON serializable')
+
+def dumps(obj, digits=RESPONSE_FLOAT_DIGITS):
+    '''
+    Encodes an api response to the bytes of its json body (ending with a newline), see prepare.
+    '''
+    obj = prepare(obj, digits)
+    if orjson is not None:
+        return orjson.dumps(obj, default=encode_default, option=ORJSON_OPTIONS)
+    return (json.dumps(obj, default=encode_default, separators=(',', ':')) + '\n').encode('utf-8')
@@ -0,0 +1,203 @@
+'''
+This script contains the in-memory prefix index behind the search endpoints of server.py. It is built from the
+label/value entries of api_functions.SearchAutocomplete (course strings like 'AME2213: Statics', or instructor names), so
+clients can ask the server for the best few matches of what was typed instead of downloading every entry.
+
+Labels and queries are normalized the same way (lowercase, no accents or punctuation, and letters split from digits so that
+'ame2213' and 'AME 2213' are the same), and every label is indexed under each of its word suffixes: a course under its
+code, its number and each word of its title, an instructor under their first and last name.
+
+Typos (and names mangled by the title casing of the scraped data) are handled by a trigram index: the labels sharing the
+most trigrams with a query are scored by their edit distance to it, and those within MAX_EDITS_PER_CHARS are returned after
+the exact prefix matches (see search).
+'''
+
+# global/pypi
+import re
+import bisect
+import unicodedata
+import numpy as np
+
+# Number of results returned by a search when no limit is given, and the largest limit allowed
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 100
+
+# Fuzzy matches may have one edit for every MAX_EDITS_PER_CHARS characters of the query, up to MAX_EDITS
+MAX_EDITS_PER_CHARS = 4
+MAX_EDITS = 2
+# Number of labels sharing the most trigrams with a query that are scored by edit distance
+FUZZY_CANDIDATES = 200
+
+def normalize(text):
+    '''
+    Normalizes a label or query for matching, e.g. 'AME2213: Statics & Dynamics' -> 'ame 2213 statics dynamics'.
+    '''
+    text = unicodedata.normalize('NFKD', str(text))
+    text = ''.join(char for char in text if not unicodedata.combining(char)).lower()
+    text = re.sub(r'(?<=[a-z])(?=[0-9])|(?<=[0-9])(?=[a-z])', ' ', text)
+    return ' '.join(re.findall(r'[a-z0-9]+', text))
+
+class PrefixIndex():
+    '''
+    Sorted index of the normalized labels of a list of search entries ({'label': ..., 'value': ...} dicts). Matches on the
+    start of a label rank before matches on a later word, and each group is in alphabetical order.
+    '''
+    def __init__(self, entries):
+        self.entries = list(entries)
+        # (key, entry number) pairs of the whole labels, and of every later word suffix of the labels
+        label_keys = []
+        word_keys = []
+        for i, entry in enumerate(self.entries):
+            words = normalize(entry['label']).split(' ')
+            label_keys.append((' '.join(words), i))
+            word_keys.extend((' '.join(words[start:]), i) for start in range(1, len(words)))
+        label_keys.sort()
+        word_keys.sort()
+        self.levels = [([key for key, _ in keys], [i for _, i in keys]) for keys in [label_keys, word_keys]]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def matches(self, query, limit=DEFAULT_SEARCH_LIMIT):
+        '''
+        Returns the numbers of up to limit entries whose label (or one of its words) starts with the normalized query.
+        '''
+        query = normalize(query)
+        if query == '' or limit <= 0:
+            return []
+        found = []
+        for keys, numbers in self.levels:
+            # The keys starting with query are the ones from its insertion point on, until the first that doesn't
+            position = bisect.bisect_left(keys, query)
+            while position < len(keys) and keys[position].startswith(query) and len(found) < limit:
+                if numbers[position] not in found:
+                    found.append(numbers[position])
+                position += 1
+        return found
+
+    def search(self, query, limit=DEFAULT_SEARCH_LIMIT):
+        '''
+        Returns up to limit entries whose label (or one of its words) starts with the normalized query.
+        '''
+        return [self.entries[i] for i in self.matches(query, limit)]
+
+def trigrams(text, complete=True):
+    '''
+    Returns the set of trigrams of the words of a normalized text, each word starting with '$' (and ending with '$' if
+    complete; the last word of a query may still be being typed).
+    '''
+    words = text.split(' ')
+    grams = set()
+    for n, word in enumerate(words):
+        word = '$' + word + ('$' if complete or n < len(words) - 1 else '')
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+def prefix_distances(query, texts, bound):
+    '''
+    Returns the smallest edit distance between query and a prefix of each of texts. Only the first len(query) + bound
+    characters of each text are looked at, since a longer prefix can't be within bound edits. Uses the bit-parallel
+    computation of the edit distance (Myers 1999, Hyyro 2001): bit i of the vertical/horizontal delta words tells whether the
+    distance grows (P) or shrinks (N) from row i to i + 1 of a column, so each character of text is a few integer operations.
+    '''
+    if len(query) == 0:
+        return [0 for _ in texts]
+    full = (1 << len(query)) - 1
+    last = 1 << (len(query) - 1)
+    # Bitmask of the positions of each character in query
+    peq = {}
+    for i, char in enumerate(query):
+        peq[char] = peq.get(char, 0) | (1 << i)
+    distances = []
+    for text in texts:
+        vp, vn = full, 0
+        score = best = len(query)
+        for char in text[:len(query) + bound]:
+            eq = peq.get(char, 0)
+            xv = eq | vn
+            xh = (((eq & vp) + vp) ^ vp) | eq
+            hp = vn | (~(xh | vp) & full)
+            hn = vp & xh
+            if hp & last:
+                score += 1
+            elif hn & last:
+                score -= 1
+            # The first row is the distance to the empty query, which grows by one with every character of text
+            hp = ((hp << 1) | 1) & full
+            hn = (hn << 1) & full
+            vp = hn | (~(xv | hp) & full)
+            vn = hp & xv
+            if score < best:
+                best = score
+        distances.append(best)
+    return distances
+
+class TrigramIndex():
+    '''
+    Inverted index of the trigrams of the normalized labels of a list of search entries, for typo tolerant search.
+    '''
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.labels = [normalize(entry['label']) for entry in self.entries]
+        # The word suffixes of each label (see PrefixIndex), which are the strings a query is compared to
+        self.suffixes = []
+        postings = {}
+        for i, label in enumerate(self.labels):
+            words = label.split(' ')
+            self.suffixes.append([' '.join(words[start:]) for start in range(len(words))])
+            for gram in trigrams(label):
+                postings.setdefault(gram, []).append(i)
+        self.postings = {gram: np.array(numbers, dtype=np.int64) for gram, numbers in postings.items()}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def matches(self, query, limit=DEFAULT_SEARCH_LIMIT, exclude=()):
+        '''
+        Returns the numbers of up to limit entries (not in exclude) with a label within the allowed number of edits of the
+        normalized query, ordered by edit distance, then matches on the start of the label first, then label.
+        '''
+        query = normalize(query)
+        bound = min(len(query)//MAX_EDITS_PER_CHARS, MAX_EDITS)
+        if bound == 0 or limit <= 0 or len(self.entries) == 0:
+            return []
+
+        # Count the trigrams each label shares with the query, and keep the labels sharing the most of them. Every edit
+        # removes at most 3 of the query's trigrams from a label, so labels sharing fewer can't be within bound
+        grams = [gram for gram in trigrams(query, complete=False) if gram in self.postings]
+        if len(grams) == 0:
+            return []
+        shared = np.bincount(np.concatenate([self.postings[gram] for gram in grams]), minlength=len(self.entries))
+        candidates = np.flatnonzero(shared >= max(len(trigrams(query, complete=False)) - 3*bound, 1))
+        if len(candidates) > FUZZY_CANDIDATES:
+            candidates = candidates[np.argpartition(-shared[candidates], FUZZY_CANDIDATES)[:FUZZY_CANDIDATES]]
+
+        # Score the candidates by the edit distance of the query to the start of their label, or of one of its words. Only
+        # the first len(query) + bound characters matter, and many labels share those, so each distinct start is scored once
+        candidates = [i for i in candidates.tolist() if i not in exclude]
+        starts = sorted(set(suffix[:len(query) + bound] for i in candidates for suffix in self.suffixes[i]))
+        start_distances = dict(zip(starts, prefix_distances(query, starts, bound)))
+        scored = []
+        for i in candidates:
+            distances = [start_distances[suffix[:len(query) + bound]] for suffix in self.suffixes[i]]
+            distance = min(distances)
+            if distance <= bound:
+                scored.append((distance, distances.index(distance) > 0, self.labels[i], i))
+        scored.sort()
+        return [i for _, _, _, i in scored[:limit]]
+
+    def search(self, query, limit=DEFAULT_SEARCH_LIMIT):
+        '''
+        Returns up to limit entries with a label within the allowed number of edits of the normalized query.
+        '''
+        return [self.entries[i] for i in self.matches(query, limit)]
+
+def search(prefix_index, trigram_index, query, limit=DEFAULT_SEARCH_LIMIT, fuzzy=True):
+    '''
+    Returns up to limit entries matching query: first the prefix matches (see PrefixIndex), then, if fuzzy and there are
+    fewer than limit of them, the closest typo tolerant matches (see TrigramIndex). Both indexes are of the same entries.
+    '''
+    found = prefix_index.matches(query, limit)
+    if fuzzy and len(found) < limit:
+        found += trigram_index.matches(query, limit - len(found), exclude=set(found))
+    return [prefix_index.entries[i] for i in found]
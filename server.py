@@ -1,11 +1,21 @@
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 from data_loader import update_database
-from mongo import mongo_driver
+from storage import storage_driver
 from bson.json_util import dumps
 import pandas as pd
 import json
+import os
+import threading
 import api_functions as api
+from index_manager import check_indexes
+from response_cache import ResponseCache
+from serving_engine import ServingEngine
+from pushdown import figure_function
+from search_index import PrefixIndex, TrigramIndex, search, DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT
+from payloads import encode_payload, payload_response
+import response_encoder
+import metrics
 
 # Establish a database connection
 DB_NAME = "reviews-db"
@@ -14,15 +24,93 @@ COLLECTION_NAME = "reviews-collection"
 # base route for this api version
 base_api_route = '/api/v0/'
 
-db = mongo_driver()
+# Serve the aggregated collections from memory (see serving_engine.py) if SERVING_ENGINE=memory, otherwise query the
+# storage backend: mongo, or a local SQLite file with STORAGE_BACKEND=sqlite (see storage.py)
+if os.environ.get('SERVING_ENGINE', 'mongo') == 'memory':
+    db = ServingEngine(storage_driver())
+else:
+    db = storage_driver()
 
-# PreCompute the instructor and course lists
-instructor_list = api.SearchAutocomplete(db, 'instructor')
-course_list = api.SearchAutocomplete(db, 'course')
+# Warn about any missing indexes, which would make the figure queries scan their collections
+check_indexes(db, api.DB_NAME, api.COLLECTION_NAMES + api.AGG_COLLECTION_NAMES)
+
+def build_search_state(version):
+    """
+    PreComputes the instructor and course lists, from the local snapshot of the aggregated data when it is current, their
+    pre-encoded /all responses (see payloads.py), and the prefix and trigram search indexes of each list.
+    """
+    ag_df = api.load_aggregated_frame(db)
+    lists = {'instructors': api.SearchAutocomplete(db, 'instructor', ag_df), 'courses': api.SearchAutocomplete(db, 'course', ag_df)}
+    return {'version': version, 'lists': lists,
+            'payloads': {search_type: encode_payload({'result': entries}) for search_type, entries in lists.items()},
+            'indexes': {search_type: (PrefixIndex(entries), TrigramIndex(entries)) for search_type, entries in lists.items()}}
+
+# The search lists and indexes, along with the data version they were built from
+search_state = build_search_state(api.get_data_version(db))
+search_lock = threading.Lock()
+
+def current_search_state():
+    """
+    Returns the search lists and indexes, rebuilding them first if the data version changed.
+    """
+    global search_state
+    version = api.current_data_version(db)
+    if version != search_state['version']:
+        with search_lock:
+            if version != search_state['version']:
+                search_state = build_search_state(version)
+    return search_state
 
 app = Flask(__name__)
 CORS(app)
 
+# Serialized figure responses, keyed by (endpoint, id, data version)
+response_cache = ResponseCache()
+
+def cached_json_response(endpoint, key, func):
+    """
+    Returns the json response of func(db, key), served from the response cache when this endpoint and key were already
+    computed for the current data version.
+    """
+    version = api.current_data_version(db)
+    response_cache.set_version(version)
+    cache_key = (endpoint, key, version)
+    body = response_cache.get(cache_key)
+    if body is None:
+        body = serialize_response(figure_response(func, key))
+        response_cache.put(cache_key, body)
+    return app.response_class(body, mimetype='application/json')
+
+def figure_response(func, key):
+    # Returns func(db, key), timed as the pandas stage of the request (the queries it makes are timed separately)
+    with metrics.stage('pandas'):
+        return func(db, key)
+
+def serialize_response(response):
+    # Serializes a figure response to the body (bytes) of its json response, with numpy/pandas values encoded natively and
+    # floats rounded to RESPONSE_FLOAT_DIGITS (see response_encoder.py)
+    with metrics.stage('encode'):
+        return response_encoder.dumps(response)
+
+# Time every request (see metrics.py)
+@app.before_request
+def start_request_timer():
+    metrics.start_request(metrics.endpoint_label(request.url_rule.rule if request.url_rule else None, request.view_args, METRIC_LABEL_VALUES))
+
+@app.after_request
+def add_server_timing(response):
+    timer = metrics.current_request.get()
+    if timer is not None:
+        timer.failed = response.status_code >= 500
+        if metrics.SERVER_TIMING:
+            response.headers['Server-Timing'] = timer.server_timing()
+    return response
+
+# The request is recorded on teardown, which also runs when after_request is skipped because a view raised
+@app.teardown_request
+def finish_request_timer(exception=None):
+    metrics.finish_request(failed=exception is not None)
+
 # useful for testing
 # curl -i http://localhost:5050/api/v0/
 
@@ -34,35 +122,59 @@ def hello_world():
 def root_api():
     return jsonify({'message': 'You have reached api root endpoint. Please see the Github page for information on the endings to hit: https://github.com/stev-ou/stev-api'})
 
-# Search for all entries for autocomplete
+# Search for all entries for autocomplete. The body is pre-encoded, so clients can revalidate it with its ETag and get it compressed
 @app.route(base_api_route+'<string:search_type>/all')
 def course_autocomplete_api(search_type):
-    if search_type == 'instructors':
-        return jsonify({'result':instructor_list})
-    elif search_type =='courses':
-        return jsonify({'result':course_list})
+    payloads = current_search_state()['payloads']
+    if search_type in payloads:
+        return payload_response(payloads[search_type], request)
     else:
         return jsonify({})
 
+# Search for the best matches of a query, e.g. /api/v0/courses/search?q=ame 22&limit=5. Prefix matches come first, then
+# typo tolerant matches unless fuzzy=0
+@app.route(base_api_route+'<string:search_type>/search')
+def search_api(search_type):
+    indexes = current_search_state()['indexes']
+    if search_type not in indexes:
+        return jsonify({})
+    limit = min(max(request.args.get('limit', DEFAULT_SEARCH_LIMIT, type=int), 0), MAX_SEARCH_LIMIT)
+    prefix_index, trigram_index = indexes[search_type]
+    fuzzy = request.args.get('fuzzy', '1') != '0'
+    return jsonify({'result':search(prefix_index, trigram_index, request.args.get('q', ''), limit, fuzzy)})
+
 ### APIs for Course search
+# figure_function picks the pandas or mongo pipeline (pushdown.py) version of each figure, see FIGURE_BACKENDS
 course_suffix_function_map = {'figure1':api.CourseFig1Table, 'figure2':api.CourseFig2Chart, 
-'figure3':api.CourseFig3Timeseries, 'figure4':api.CourseFig4TableBar}
+'figure3':figure_function(api.CourseFig3Timeseries), 'figure4':api.CourseFig4TableBar, 'all':api.CourseAllFigures}
 
 @app.route(base_api_route+'courses/<string:course_uuid>/<string:api_suffix>', methods=['GET'])
 def course_figure_apis(course_uuid, api_suffix):
     func = course_suffix_function_map[api_suffix]
-    response = func(db, course_uuid)
-    return jsonify(response)
+    return cached_json_response('courses/'+api_suffix, course_uuid, func)
 
 ## APIs for Instructor Search
-instr_suffix_function_map = {'figure1':api.InstructorFig1Table, 'figure2':api.InstructorFig2Timeseries, 
-'figure3':api.InstructorFig3TableBar, 'chip':api.InstructorChipAPI}
+instr_suffix_function_map = {'figure1':figure_function(api.InstructorFig1Table), 'figure2':api.InstructorFig2Timeseries, 
+'figure3':api.InstructorFig3TableBar, 'chip':figure_function(api.InstructorChipAPI), 'all':api.InstructorAllFigures}
 
 @app.route(base_api_route+'instructors/<int:instructor_id>/<string:api_suffix>', methods=['GET'])
 def instructor_figure_apis(instructor_id, api_suffix):
     func = instr_suffix_function_map[api_suffix]
-    response = func(db, instructor_id)
-    return jsonify(response)
+    return cached_json_response('instructors/'+api_suffix, instructor_id, func)
+
+# The values of the url variables that are kept in the endpoint labels of the metrics, any other is left as a placeholder
+METRIC_LABEL_VALUES = {'api_suffix': set(course_suffix_function_map) | set(instr_suffix_function_map),
+                       'search_type': {'courses', 'instructors'}}
+
+# Request latencies, stage times and query counters, in the Prometheus text format
+@app.route(base_api_route+'metrics', methods=['GET'])
+def metrics_api():
+    return app.response_class(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Statistics of the figure response cache
+@app.route(base_api_route+'cache/stats', methods=['GET'])
+def cache_stats_api():
+    return jsonify({'result': response_cache.stats()})
 
 if __name__ == '__main__':
     print("Updating database...")
@@ -0,0 +1,186 @@
+'''
+This script contains the optional in-memory serving engine of the api. The aggregated collections are small enough to be
+held in RAM, so the engine loads them (from their local snapshot when it is current, see api_functions.load_collection_frame)
+into typed numpy columns with sorted indexes on the fields the figure queries filter on. api_functions.query_df_from_mongo
+evaluates the queries on these collections locally when it is passed a ServingEngine instead of a mongo_driver; every other
+query (e.g. on the unmodified collections) and every other driver method goes to mongo as before.
+
+The engine reloads its collections when the active data version changes (see api_functions.current_data_version).
+'''
+
+# global/pypi
+import pprint
+import threading
+import numpy as np
+import pandas as pd
+
+# local
+import api_functions as api
+
+# Fields of the aggregated collections that get a sorted index (see the filters in api_functions.py)
+INDEXED_FIELDS = ['course_uuid', 'Instructor ID', 'Subject Code', 'Term Code']
+
+def typed_column(series):
+    '''
+    Converts a dataframe column into a numpy array typed the way a dataframe built from the mongo documents would be:
+    int64 or float64 for numeric columns, object otherwise.
+    '''
+    if pd.api.types.is_bool_dtype(series):
+        return series.values.astype(bool)
+    if pd.api.types.is_integer_dtype(series):
+        return series.values.astype(np.int64)
+    if pd.api.types.is_float_dtype(series):
+        return series.values.astype(np.float64)
+    return series.values.astype(object)
+
+class SortedIndex():
+    '''
+    Sorted index of one column: the rows of each distinct value are one contiguous slice of the row order.
+    '''
+    def __init__(self, values):
+        codes, uniques = pd.factorize(values, sort=True)
+        self.code_of = {value: code for code, value in enumerate(uniques.tolist())}
+        self.order = np.argsort(codes, kind='mergesort')
+        self.sorted_codes = codes[self.order]
+
+    def bounds(self, value):
+        # Returns the (start, stop) slice of self.order holding the rows equal to value
+        code = self.code_of.get(value)
+        if code is None:
+            return 0, 0
+        return np.searchsorted(self.sorted_codes, code, 'left'), np.searchsorted(self.sorted_codes, code, 'right')
+
+    def count(self, values):
+        # Returns the number of rows equal to any of values
+        return sum(stop - start for start, stop in (self.bounds(value) for value in values))
+
+    def rows(self, values):
+        # Returns the sorted row numbers equal to any of values
+        slices = [self.order[start:stop] for start, stop in (self.bounds(value) for value in values)]
+        if len(slices) == 0:
+            return np.array([], dtype=np.int64)
+        return np.sort(np.concatenate(slices))
+
+class Table():
+    '''
+    One collection held in memory as a dict of field -> typed numpy column, with a SortedIndex on each of INDEXED_FIELDS.
+    '''
+    def __init__(self, df):
+        self.size = len(df)
+        self.columns = {col: typed_column(df[col]) for col in df.columns}
+        self.indexes = {field: SortedIndex(self.columns[field]) for field in INDEXED_FIELDS if field in self.columns}
+
+    def field_values(self, condition):
+        # Returns the list of values matched by the condition of a field, e.g. 201710 or {'$in': [201710, 201720]}
+        if isinstance(condition, dict):
+            if list(condition.keys()) != ['$in']:
+                raise Exception('The serving engine does not support the condition ' + str(condition))
+            return list(condition['$in'])
+        return [condition]
+
+    def clauses(self, coll_filter):
+        # Splits a filter into a list of single key filters that must all match
+        clauses = []
+        for key, condition in coll_filter.items():
+            if key == '$and':
+                for sub_filter in condition:
+                    clauses.extend(self.clauses(sub_filter))
+            else:
+                clauses.append((key, condition))
+        return clauses
+
+    def estimate(self, clause):
+        # Estimated number of rows matched by a clause, used to apply the most selective clause first
+        key, condition = clause
+        if key in self.indexes:
+            return self.indexes[key].count(self.field_values(condition))
+        return self.size
+
+    def select(self, coll_filter, rows=None):
+        '''
+        Returns the sorted row numbers that match a mongo filter (equality, $in, $and and $or), out of rows (all rows if None).
+        The most selective clause is looked up in its index, and the others only check its rows.
+        '''
+        for key, condition in sorted(self.clauses(coll_filter), key=self.estimate):
+            if key == '$or':
+                matches = [self.select(sub_filter, rows) for sub_filter in condition]
+                rows = np.unique(np.concatenate(matches)) if len(matches) > 0 else np.array([], dtype=np.int64)
+                continue
+            values = self.field_values(condition)
+            if key not in self.columns:
+                rows = np.array([], dtype=np.int64)
+            elif rows is None and key in self.indexes:
+                rows = self.indexes[key].rows(values)
+            elif rows is None:
+                rows = np.flatnonzero(np.isin(self.columns[key], values))
+            else:
+                rows = rows[np.isin(self.columns[key][rows], values)]
+            if len(rows) == 0:
+                break
+        if rows is None:
+            rows = np.arange(self.size)
+        return rows
+
+    def frame(self, rows, projection=None):
+        # Returns the dataframe of the given rows, with the projection fields as its columns (all fields if None)
+        fields = list(self.columns.keys()) if projection is None else projection
+        data = {}
+        for field in fields:
+            if field in self.columns:
+                data[field] = self.columns[field][rows]
+            else:
+                data[field] = np.full(len(rows), np.nan, dtype=object)
+        return pd.DataFrame(data, columns=fields)
+
+class ServingEngine():
+    '''
+    Drop-in replacement of a mongo_driver for the api functions, serving the aggregated collections from memory.
+    '''
+    def __init__(self, db, collections=api.AGG_COLLECTION_NAMES):
+        self.db = db
+        self.collections = list(collections)
+        self.tables = None
+        self.version = None
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def __getattr__(self, name):
+        # Every other driver method (get_db_collection, collection_existence_check, ...) goes to mongo
+        if name == 'db':
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
+    def refresh(self):
+        '''
+        (Re)loads the collections if the active data version changed since they were loaded.
+        '''
+        version = api.current_data_version(self.db)
+        if self.tables is not None and version == self.version:
+            return
+        with self.lock:
+            if self.tables is not None and version == self.version:
+                return
+            tables = {coll_name: Table(api.load_collection_frame(self.db, coll_name)) for coll_name in self.collections}
+            # Swap the new tables in at once, so running queries keep their consistent view
+            self.tables, self.version = tables, version
+            print('The serving engine loaded ' + ', '.join(str(table.size) + ' ' + coll_name for coll_name, table in tables.items()) +
+                  ' documents of data version ' + str(version) + '.')
+
+    def holds(self, collections):
+        # Whether every one of collections is served from memory
+        return all(coll_name in self.collections for coll_name in collections)
+
+    def query_df(self, coll_filter, collections, projection=None):
+        '''
+        Same as api_functions.query_df_from_mongo, evaluated on the in-memory collections.
+        '''
+        self.refresh()
+        tables = self.tables
+        for coll_name in collections:
+            rows = tables[coll_name].select(coll_filter)
+            if len(rows) > 0:
+                return tables[coll_name].frame(rows, projection), coll_name
+
+        print('The below filter was not found within any of the mongo collection.')
+        pprint.pprint(coll_filter)
+        raise Exception('The filter was not found in the mongo collection.')
@@ -0,0 +1,139 @@
+'''
+This script contains functions to store dataframes (the conditioned OCR data and its aggregated form) as local columnar
+snapshots, so that the loader and the server can start from disk instead of re-downloading everything from mongo.
+
+Each snapshot is a directory holding one memory-mappable .npy file per column and a manifest.json. String (object) columns
+are stored as integer codes into a list of labels. The manifest records the columns, a content hash of the data, and the
+versions (e.g. the OCR source version or the data version in mongo) that the snapshot was built from; a snapshot is only
+loaded when the requested versions match.
+'''
+
+# global/pypi
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Directory that holds the snapshots
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'snapshots'))
+
+def snapshot_path(name, snapshot_dir=None):
+    '''
+    Returns the directory of the snapshot called name, in snapshot_dir (SNAPSHOT_DIR by default, read when called).
+    '''
+    return os.path.join(snapshot_dir or SNAPSHOT_DIR, name)
+
+def read_manifest(name, snapshot_dir=None):
+    '''
+    Returns the manifest (dict) of the snapshot called name, or None if there is no such snapshot.
+    '''
+    manifest_file = os.path.join(snapshot_path(name, snapshot_dir), 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def save_snapshot(df, name, snapshot_dir=None, **versions):
+    '''
+    Writes a dataframe to the snapshot called name, replacing any existing snapshot of that name.
+    :Inputs:
+    - df: pandas dataframe to store
+    - name: name of the snapshot, e.g. 'reviews'
+    - versions: keyword arguments of version strings the data was built from, e.g. source_version='...'
+    :Returns:
+    - manifest: the manifest of the new snapshot, including its content_hash
+    '''
+    path = snapshot_path(name, snapshot_dir)
+    # Each writer gets a directory of its own, since several processes (e.g. the gunicorn workers of the server) may save
+    # the same snapshot at once
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path), prefix=name + '.tmp-')
+
+    content_hash = hashlib.sha256()
+    columns = []
+    for i, col in enumerate(df.columns):
+        if pd.api.types.is_numeric_dtype(df[col]):
+            values = np.ascontiguousarray(df[col].values)
+            labels = None
+        else:
+            values, uniques = pd.factorize(df[col])
+            values = values.astype(np.int32)
+            labels = [None if pd.isnull(label) else label for label in np.asarray(uniques, dtype=object).tolist()]
+        np.save(os.path.join(tmp_path, str(i) + '.npy'), values)
+        content_hash.update(str(col).encode('utf-8'))
+        content_hash.update(values.tobytes())
+        if labels is not None:
+            content_hash.update(json.dumps(labels).encode('utf-8'))
+        columns.append({'name': col, 'dtype': str(values.dtype), 'labels': labels})
+
+    manifest = {'name': name, 'rows': len(df), 'columns': columns, 'content_hash': content_hash.hexdigest(), 'versions': versions}
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    # Swap the finished snapshot in place of the old one: the old one is moved aside (into an empty directory, which
+    # os.replace overwrites) and the new one renamed into its place. If another writer's snapshot got there first, it is
+    # kept and this one dropped
+    old_path = tempfile.mkdtemp(dir=os.path.dirname(path), prefix=name + '.old-')
+    try:
+        os.replace(path, old_path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return manifest
+
+def tag_snapshot(name, snapshot_dir=None, **versions):
+    '''
+    Adds version strings to the manifest of an existing snapshot, e.g. the data version an aggregated snapshot was uploaded as.
+    '''
+    manifest = read_manifest(name, snapshot_dir)
+    if manifest is None:
+        return
+    manifest['versions'].update(versions)
+    manifest_file = os.path.join(snapshot_path(name, snapshot_dir), 'manifest.json')
+    # Written next to the manifest, then renamed over it, so readers never see a partly written manifest
+    with open(manifest_file + '.' + str(os.getpid()), 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_file + '.' + str(os.getpid()), manifest_file)
+    return
+
+def load_snapshot(name, snapshot_dir=None, mmap=True, **versions):
+    '''
+    Loads the snapshot called name into a dataframe, if it exists and was built from the given versions.
+    :Inputs:
+    - name: name of the snapshot
+    - mmap (optional): memory-map the numeric columns instead of reading them
+    - versions: keyword arguments of version strings the snapshot must match, e.g. data_version='...'. A version of None never matches.
+    :Returns:
+    - df: the stored pandas dataframe, or None if there is no matching snapshot
+    '''
+    try:
+        manifest = read_manifest(name, snapshot_dir)
+    except (OSError, ValueError):
+        # The snapshot was swapped out by another process while its manifest was read
+        return None
+    if manifest is None:
+        return None
+    for key, version in versions.items():
+        if version is None or manifest['versions'].get(key) != version:
+            return None
+
+    path = snapshot_path(name, snapshot_dir)
+    data = {}
+    try:
+        for i, column in enumerate(manifest['columns']):
+            values = np.load(os.path.join(path, str(i) + '.npy'), mmap_mode='r' if mmap else None)
+            if column['labels'] is not None:
+                # Missing values have the code -1, which picks up the trailing None
+                values = np.array(column['labels'] + [None], dtype=object)[values]
+            data[column['name']] = values
+    except (OSError, ValueError):
+        # The snapshot was swapped out by another process while it was read
+        return None
+    return pd.DataFrame(data, columns=[column['name'] for column in manifest['columns']])
@@ -0,0 +1,469 @@
+'''
+This script contains the storage backends of the api. mongo.mongo_driver (the Atlas cluster) is the default; with
+STORAGE_BACKEND=sqlite the api and the loader instead use sqlite_driver, which stores the collections in a local SQLite file
+(SQLITE_PATH) and serves the reads without a network round trip. The data is read-only between loads, so a copy of the
+database on the server's disk is enough, e.g. made with `python storage.py` (see copy_database).
+
+sqlite_driver has the methods of mongo_driver, and its collections the subset of the pymongo Collection api used by
+api_functions.py, data_loader.py and index_manager.py. Each collection is a table of (_id, doc) rows, doc being the document
+as json. The mongo filters (equalities, $in, $nin, $ne, $gt(e), $lt(e), $exists, $and, $or) are translated to SQL on the
+json_extract of the fields, and the indexes (see index_manager.py) are SQLite indexes on those same expressions, so the
+figure queries are indexed lookups. Aggregation pipelines are not supported, so with this backend pushdown.parse_backends
+selects the pandas version of every figure, whatever FIGURE_BACKENDS says.
+'''
+
+# global/pypi
+import os
+import json
+import uuid
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from datetime import datetime
+from bson import ObjectId
+from pymongo.operations import InsertOne, DeleteOne, DeleteMany, ReplaceOne
+from pymongo.results import InsertOneResult, InsertManyResult, DeleteResult, UpdateResult, BulkWriteResult
+
+# local
+from mongo import mongo_driver
+
+# Backend of the api and the loader: mongo or sqlite
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+
+# File of the sqlite backend
+SQLITE_PATH = os.environ.get('SQLITE_PATH', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'stev.sqlite'))
+
+# Table holding the indexes of the collections, by table name and (mongo) index name
+INDEX_TABLE = '_storage_indexes'
+
+# Number of rows fetched from the SQLite cursor at a time
+FETCH_SIZE = 5000
+
+def storage_driver(backend=STORAGE_BACKEND):
+    '''
+    Returns the driver of the storage backend: a mongo_driver, or a sqlite_driver of SQLITE_PATH.
+    '''
+    if backend == 'mongo':
+        return mongo_driver()
+    if backend == 'sqlite':
+        return sqlite_driver(SQLITE_PATH)
+    raise Exception('Invalid STORAGE_BACKEND: ' + backend + ', should be mongo or sqlite.')
+
+def quote_name(name):
+    # Quotes a table or index name
+    return '"' + name.replace('"', '""') + '"'
+
+def field_expression(field):
+    '''
+    Returns the SQL expression of a (possibly dotted) document field. Indexes are built on the same expressions, so the
+    text must not change between the two.
+    '''
+    if field == '_id':
+        return '_id'
+    path = '$' + ''.join('."' + part.replace("'", "''") + '"' for part in field.split('.'))
+    return "json_extract(doc, '" + path + "')"
+
+def sql_value(value):
+    # Converts a document or filter value into one SQLite can bind, the same way encode_value stores it
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (str, int, float, bytes)):
+        return value
+    return encode_value(value)
+
+def encode_value(value):
+    # Encodes the values json doesn't know: numpy scalars, datetimes (as iso strings), ObjectIds (as strs)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def encode_document(doc):
+    '''
+    Returns the (_id, doc json) row of a document. Documents without an _id get the str of a new ObjectId, like mongo
+    assigns one, and NaNs are stored as null.
+    '''
+    body = {key: None if type(value) is float and value != value else value for key, value in doc.items() if key != '_id'}
+    doc_id = sql_value(doc['_id']) if '_id' in doc else str(ObjectId())
+    return doc_id, json.dumps(body, default=encode_value)
+
+def combine(operator, clauses):
+    # Joins SQL clauses with AND or OR, nesting them as a balanced tree so long $or lists stay under SQLite's depth limit
+    if len(clauses) == 0:
+        return '1' if operator == 'AND' else '0'
+    if len(clauses) == 1:
+        return clauses[0]
+    middle = len(clauses)//2
+    return '(' + combine(operator, clauses[:middle]) + ' ' + operator + ' ' + combine(operator, clauses[middle:]) + ')'
+
+def translate_condition(expression, condition, params):
+    # Returns the SQL clause of the condition on one field (a value, or a dict of operators), adding its values to params
+    if not (isinstance(condition, dict) and len(condition) > 0 and all(key.startswith('$') for key in condition)):
+        if condition is None:
+            return expression + ' IS NULL'
+        params.append(sql_value(condition))
+        return expression + ' = ?'
+    clauses = []
+    for operator, value in condition.items():
+        if operator == '$eq':
+            clauses.append(translate_condition(expression, value, params))
+        elif operator == '$ne':
+            if value is None:
+                clauses.append(expression + ' IS NOT NULL')
+            else:
+                params.append(sql_value(value))
+                clauses.append('(' + expression + ' IS NULL OR ' + expression + ' != ?)')
+        elif operator in ['$gt', '$gte', '$lt', '$lte']:
+            params.append(sql_value(value))
+            clauses.append(expression + ' ' + {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}[operator] + ' ?')
+        elif operator in ['$in', '$nin']:
+            values = [sql_value(v) for v in value if v is not None]
+            params.extend(values)
+            clause = expression + (' IN (' if operator == '$in' else ' NOT IN (') + ', '.join('?'*len(values)) + ')'
+            if operator == '$in':
+                clause = combine('OR', ([clause] if values else []) + ([expression + ' IS NULL'] if None in value else []))
+            else:
+                clause = '(' + expression + ' IS NOT NULL AND ' + clause + ')' if None in value else '(' + expression + ' IS NULL OR ' + clause + ')'
+            clauses.append(clause)
+        elif operator == '$exists':
+            clauses.append(expression + (' IS NOT NULL' if value else ' IS NULL'))
+        else:
+            raise Exception('The filter operator ' + operator + ' is not supported by the sqlite storage backend.')
+    return combine('AND', clauses)
+
+def translate_filter(coll_filter, params):
+    '''
+    Translates a mongo filter to a SQL WHERE clause.
+    Inputs:
+    coll_filter - the mongo filter (dict), e.g. {'course_uuid': uuid, 'Term Code': {'$in': CURRENT_SEMESTERS}}
+    params - list the values of the clause are appended to, in the order of its ? placeholders
+    Returns:
+    clause - the SQL clause (str)
+    '''
+    clauses = []
+    for key, value in (coll_filter or {}).items():
+        if key in ['$and', '$or']:
+            clauses.append(combine(key[1:].upper(), [translate_filter(sub_filter, params) for sub_filter in value]))
+        elif key.startswith('$'):
+            raise Exception('The filter operator ' + key + ' is not supported by the sqlite storage backend.')
+        else:
+            clauses.append(translate_condition(field_expression(key), value, params))
+    return combine('AND', clauses)
+
+def parse_projection(projection):
+    '''
+    Returns the fields to select (None for whole documents), whether _id is included, and the fields excluded from the
+    whole documents, of a mongo projection (a dict or a list of fields).
+    '''
+    if projection is None:
+        return None, True, []
+    if not isinstance(projection, dict):
+        projection = {field: 1 for field in projection}
+    include_id = bool(projection.get('_id', 1))
+    fields = [field for field, include in projection.items() if include and field != '_id']
+    if len(fields) > 0:
+        return fields, include_id, []
+    return None, include_id, [field for field, include in projection.items() if not include and field != '_id']
+
+def order_clause(sort):
+    # Returns the ORDER BY clause of a mongo sort specification, e.g. [('_id', -1)]. Without one the documents come in the
+    # order they were inserted, as from mongo's natural order, rather than in the order of the index that was used
+    if not sort:
+        return ' ORDER BY rowid'
+    return ' ORDER BY ' + ', '.join(field_expression(field) + (' DESC' if direction == -1 else ' ASC') for field, direction in sort)
+
+def index_name(keys):
+    # Returns the default (mongo) name of an index, e.g. 'course_uuid_1_Term Code_1'
+    return '_'.join(field + '_' + str(direction) for field, direction in keys)
+
+class sqlite_driver():
+    def __init__(self, path=SQLITE_PATH):
+        # Each thread gets its own connection to the file (the bulk uploads write from several threads, the servers read
+        # from several threads); WAL lets the reads go on during a write
+        self.path = path
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS ' + INDEX_TABLE + ' (collection TEXT, name TEXT, sql_name TEXT, keys TEXT, '
+                         'is_unique INTEGER, PRIMARY KEY (collection, name))')
+
+    def connection(self):
+        # Returns the connection of the current thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def get_client(self):
+        return self
+
+    def get_db(self, db_name):
+        return sqlite_database(self, db_name)
+
+    def get_db_collection(self, db_name, collection_name):
+        return sqlite_collection(self, db_name, collection_name)
+
+    def collection_existence_check(self, db_name, check_collection):
+        # Checks to see if a collection exists within a database
+        return check_collection in self.get_db(db_name).list_collection_names()
+
+    def drop_database(self, db_name):
+        for coll_name in self.get_db(db_name).list_collection_names():
+            self.get_db_collection(db_name, coll_name).drop()
+
+class sqlite_database():
+    # The collections of one database, i.e. the tables named '<db_name>.<collection name>'
+    def __init__(self, driver, name):
+        self.driver = driver
+        self.name = name
+
+    def __getitem__(self, collection_name):
+        return sqlite_collection(self.driver, self.name, collection_name)
+
+    def list_collection_names(self):
+        prefix = self.name + '.'
+        rows = self.driver.connection().execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        return [name[len(prefix):] for name, in rows if name.startswith(prefix)]
+
+    def drop_collection(self, collection_name):
+        self[collection_name].drop()
+
+class sqlite_collection():
+    def __init__(self, driver, db_name, name):
+        self.driver = driver
+        self.db_name = db_name
+        self.name = name
+        self.table_name = db_name + '.' + name
+        self.table = quote_name(self.table_name)
+
+    def ensure_table(self, conn):
+        # Collections are created on their first write, like in mongo
+        conn.execute('CREATE TABLE IF NOT EXISTS ' + self.table + ' (_id UNIQUE, doc TEXT NOT NULL)')
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, **kwargs):
+        '''
+        Returns an iterator over the documents matching the mongo filter, with the fields of the projection. Other pymongo
+        find options (e.g. batch_size) are ignored.
+        '''
+        fields, include_id, excluded = parse_projection(projection)
+        params = []
+        sql = ('SELECT _id, ' + (', '.join(field_expression(field) for field in fields) if fields is not None else 'doc') +
+               ' FROM ' + self.table + ' WHERE ' + translate_filter(filter, params) + order_clause(sort) +
+               (' LIMIT ' + str(int(limit)) if limit else ''))
+        try:
+            cursor = self.driver.connection().execute(sql, params)
+        except sqlite3.OperationalError as e:
+            # A collection that doesn't exist has no documents
+            if 'no such table' in str(e):
+                return iter([])
+            raise
+        return self.iter_documents(cursor, fields, include_id, excluded)
+
+    def iter_documents(self, cursor, fields, include_id, excluded):
+        # Yields the documents of the (_id, fields...) or (_id, doc) rows of cursor
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if len(rows) == 0:
+                return
+            for row in rows:
+                if fields is not None:
+                    doc = dict(zip(fields, row[1:]))
+                else:
+                    doc = json.loads(row[1])
+                    for field in excluded:
+                        doc.pop(field, None)
+                if include_id:
+                    doc = dict({'_id': row[0]}, **doc)
+                yield doc
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        return next(self.find(filter, projection, sort=sort, limit=1), None)
+
+    def count_documents(self, filter):
+        params = []
+        try:
+            return self.driver.connection().execute('SELECT COUNT(*) FROM ' + self.table + ' WHERE ' + translate_filter(filter, params), params).fetchone()[0]
+        except sqlite3.OperationalError as e:
+            if 'no such table' in str(e):
+                return 0
+            raise
+
+    def estimated_document_count(self):
+        return self.count_documents({})
+
+    def content_hash(self):
+        # Returns a sha1 of the _ids and documents of the collection, which changes with any edit (see data_loader.ocr_content_hash)
+        digest = hashlib.sha1()
+        if self.name not in sqlite_database(self.driver, self.db_name).list_collection_names():
+            return digest.hexdigest()
+        for doc_id, doc in self.driver.connection().execute('SELECT _id, doc FROM ' + self.table + ' ORDER BY rowid'):
+            digest.update(str(doc_id).encode('utf-8'))
+            digest.update(doc.encode('utf-8'))
+        return digest.hexdigest()
+
+    def insert_rows(self, conn, documents):
+        # Inserts documents in the transaction of conn, returns their _ids
+        rows = [encode_document(doc) for doc in documents]
+        self.ensure_table(conn)
+        conn.executemany('INSERT INTO ' + self.table + ' (_id, doc) VALUES (?, ?)', rows)
+        return [doc_id for doc_id, _ in rows]
+
+    def delete_rows(self, conn, filter, limit=None):
+        # Deletes the documents matching filter (at most limit of them) in the transaction of conn, returns their number
+        params = []
+        where = translate_filter(filter, params)
+        if limit is not None:
+            where = 'rowid IN (SELECT rowid FROM ' + self.table + ' WHERE ' + where + ' LIMIT ' + str(int(limit)) + ')'
+        self.ensure_table(conn)
+        return conn.execute('DELETE FROM ' + self.table + ' WHERE ' + where, params).rowcount
+
+    def replace_row(self, conn, filter, replacement, upsert=False):
+        # Replaces the first document matching filter in the transaction of conn. Returns (matched, upserted _id)
+        params = []
+        self.ensure_table(conn)
+        row = conn.execute('SELECT rowid, _id FROM ' + self.table + ' WHERE ' + translate_filter(filter, params) + ' LIMIT 1', params).fetchone()
+        if row is None:
+            if not upsert:
+                return 0, None
+            if '_id' not in replacement and isinstance(filter.get('_id'), (str, int)):
+                replacement = dict(replacement, _id=filter['_id'])
+            return 0, self.insert_rows(conn, [replacement])[0]
+        doc_id, body = encode_document(dict(replacement, _id=replacement.get('_id', row[1])))
+        conn.execute('UPDATE ' + self.table + ' SET _id = ?, doc = ? WHERE rowid = ?', (doc_id, body, row[0]))
+        return 1, None
+
+    def insert_one(self, document):
+        with self.driver.connection() as conn:
+            return InsertOneResult(self.insert_rows(conn, [document])[0], True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        with self.driver.connection() as conn:
+            return InsertManyResult(self.insert_rows(conn, documents), True)
+
+    def delete_one(self, filter):
+        with self.driver.connection() as conn:
+            return DeleteResult({'n': self.delete_rows(conn, filter, limit=1)}, True)
+
+    def delete_many(self, filter):
+        with self.driver.connection() as conn:
+            return DeleteResult({'n': self.delete_rows(conn, filter)}, True)
+
+    def replace_one(self, filter, replacement, upsert=False):
+        with self.driver.connection() as conn:
+            matched, upserted_id = self.replace_row(conn, filter, replacement, upsert)
+        return UpdateResult({'n': matched or int(upserted_id is not None), 'nModified': matched, 'upserted': upserted_id}, True)
+
+    def bulk_write(self, requests, ordered=True):
+        '''
+        Runs the InsertOne, DeleteOne, DeleteMany and ReplaceOne requests in a single transaction.
+        '''
+        counts = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        with self.driver.connection() as conn:
+            for request in requests:
+                if isinstance(request, InsertOne):
+                    self.insert_rows(conn, [request._doc])
+                    counts['nInserted'] += 1
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    counts['nRemoved'] += self.delete_rows(conn, request._filter, limit=1 if isinstance(request, DeleteOne) else None)
+                elif isinstance(request, ReplaceOne):
+                    matched, upserted_id = self.replace_row(conn, request._filter, request._doc, request._upsert)
+                    counts['nMatched'] += matched
+                    counts['nModified'] += matched
+                    if upserted_id is not None:
+                        counts['upserted'].append({'index': counts['nUpserted'], '_id': upserted_id})
+                        counts['nUpserted'] += 1
+                else:
+                    raise Exception('The bulk write request ' + type(request).__name__ + ' is not supported by the sqlite storage backend.')
+        return BulkWriteResult(counts, True)
+
+    def create_index(self, keys, name=None, unique=False, **kwargs):
+        '''
+        Creates a SQLite index on the expressions of the fields of keys (a field name, or a list of (field, direction)),
+        unless the collection already has an index of that name. Returns the name of the index.
+        '''
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        keys = [(field, int(direction)) for field, direction in keys]
+        name = name or index_name(keys)
+        with self.driver.connection() as conn:
+            self.ensure_table(conn)
+            if conn.execute('SELECT 1 FROM ' + INDEX_TABLE + ' WHERE collection = ? AND name = ?', (self.table_name, name)).fetchone():
+                return name
+            # The SQLite name is unique across the file, as an index keeps its name when its table is renamed
+            sql_name = 'ix_' + uuid.uuid4().hex
+            columns = ', '.join(field_expression(field) + (' DESC' if direction == -1 else '') for field, direction in keys)
+            conn.execute('CREATE ' + ('UNIQUE ' if unique else '') + 'INDEX ' + quote_name(sql_name) + ' ON ' + self.table + ' (' + columns + ')')
+            conn.execute('INSERT INTO ' + INDEX_TABLE + ' VALUES (?, ?, ?, ?, ?)', (self.table_name, name, sql_name, json.dumps(keys), int(unique)))
+        return name
+
+    def create_indexes(self, indexes):
+        # Creates the indexes of a list of pymongo IndexModels
+        return [self.create_index(list(model.document['key'].items()), name=model.document['name'],
+                                  unique=model.document.get('unique', False)) for model in indexes]
+
+    def index_information(self):
+        info = {'_id_': {'key': [('_id', 1)]}}
+        rows = self.driver.connection().execute('SELECT name, keys, is_unique FROM ' + INDEX_TABLE + ' WHERE collection = ?', (self.table_name,))
+        for name, keys, is_unique in rows.fetchall():
+            info[name] = dict({'key': [tuple(key) for key in json.loads(keys)]}, **({'unique': True} if is_unique else {}))
+        return info
+
+    def drop(self):
+        conn = self.driver.connection()
+        with conn:
+            conn.execute('BEGIN')
+            conn.execute('DROP TABLE IF EXISTS ' + self.table)
+            conn.execute('DELETE FROM ' + INDEX_TABLE + ' WHERE collection = ?', (self.table_name,))
+
+    def rename(self, new_name, dropTarget=False):
+        '''
+        Renames the collection (with its indexes) to new_name in the same database, replacing an existing new_name
+        collection if dropTarget. The swap is atomic.
+        '''
+        target = sqlite_collection(self.driver, self.db_name, new_name)
+        conn = self.driver.connection()
+        with conn:
+            conn.execute('BEGIN')
+            if dropTarget:
+                conn.execute('DROP TABLE IF EXISTS ' + target.table)
+                conn.execute('DELETE FROM ' + INDEX_TABLE + ' WHERE collection = ?', (target.table_name,))
+            conn.execute('ALTER TABLE ' + self.table + ' RENAME TO ' + target.table)
+            conn.execute('UPDATE ' + INDEX_TABLE + ' SET collection = ? WHERE collection = ?', (target.table_name, self.table_name))
+        return target
+
+    def aggregate(self, pipeline, **kwargs):
+        raise Exception('Aggregation pipelines are not supported by the sqlite storage backend; set FIGURE_BACKENDS to pandas.')
+
+def copy_database(source, target, db_name, batch_size=FETCH_SIZE):
+    '''
+    Copies every collection of the database db_name, with its documents and indexes, from the source driver to the target
+    driver (replacing the collections already there), e.g. from the mongo cluster to a local SQLite file.
+    '''
+    for coll_name in source.get_db(db_name).list_collection_names():
+        source_coll = source.get_db_collection(db_name, coll_name)
+        target_coll = target.get_db_collection(db_name, coll_name)
+        target_coll.drop()
+        batch = []
+        n_copied = 0
+        for doc in source_coll.find({}):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                target_coll.insert_many(batch)
+                n_copied += len(batch)
+                batch = []
+        if batch:
+            target_coll.insert_many(batch)
+            n_copied += len(batch)
+        for name, info in source_coll.index_information().items():
+            if name != '_id_':
+                target_coll.create_index(info['key'], name=name, unique=info.get('unique', False))
+        print('Copied ' + str(n_copied) + ' documents of ' + db_name + '.' + coll_name + '.')
+    return
+
+if __name__ == '__main__':
+    # Copy the served database from the mongo cluster to SQLITE_PATH
+    import api_functions as api
+    copy_database(mongo_driver(), sqlite_driver(SQLITE_PATH), api.DB_NAME)
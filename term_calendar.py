@@ -0,0 +1,91 @@
+'''
+This script contains the term calendar used by the api to order and label term codes. Term codes are integers where the
+first 4 digits correspond to the year and the last 2 digits to the semester (10: fall, 20: spring, 30: summer), e.g. 201710
+is Fall 2017. The calendar is loaded once from mappings.yaml and extended to the years past its last entry, and gives every
+term code a dense ordinal (consecutive terms have consecutive ordinals) so whole columns of term codes can be sorted and
+labeled with array operations.
+'''
+
+# global/pypi
+import os
+import yaml
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+# Read the term code labels from mappings.yaml
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+with open(__location__ + '/mappings.yaml') as f:
+    # use safe_load instead load
+    TERM_CODE_DICT = yaml.safe_load(f)['Term_code_dict']
+
+# The semester of each term code ending, and the position of each ending within the year of its term code, in the order
+# the semesters occur: e.g. 201720 (Spring 2017), 201730 (Summer 2017), then 201710 (Fall 2017)
+SEMESTER_NAMES = {10: 'Fall', 20: 'Spring', 30: 'Summer'}
+SEMESTER_POSITIONS = {20: 0, 30: 1, 10: 2}
+TERMS_PER_YEAR = len(SEMESTER_POSITIONS)
+
+# Lookup array of ending -> position, -1 for invalid endings
+ENDING_POSITIONS = np.full(100, -1, dtype=np.int64)
+for ending, position in SEMESTER_POSITIONS.items():
+    ENDING_POSITIONS[ending] = position
+
+# The calendar covers the years of mappings.yaml, and is derived up to next year if mappings.yaml stops earlier
+FIRST_YEAR = min(int(code[:4]) for code in TERM_CODE_DICT)
+LAST_YEAR = max(max(int(code[:4]) for code in TERM_CODE_DICT), datetime.today().year + 1)
+
+def derive_term_label(code):
+    '''
+    Builds the label of a term code from its year and ending, e.g. 202410 -> 'Fall 2024'.
+    '''
+    code = int(code)
+    if code % 100 not in SEMESTER_NAMES:
+        raise Exception('Invalid term code: ' + str(code))
+    return SEMESTER_NAMES[code % 100] + ' ' + str(code // 100)
+
+# Every term code of the calendar in chronological order, its label, and the str term code -> label dict
+TERM_CODES = np.array([year*100 + ending for year in range(FIRST_YEAR, LAST_YEAR + 1)
+                       for ending in sorted(SEMESTER_POSITIONS, key=SEMESTER_POSITIONS.get)], dtype=np.int64)
+TERM_LABELS = np.array([TERM_CODE_DICT.get(str(code), derive_term_label(code)) for code in TERM_CODES], dtype=object)
+SEMESTER_MAPPINGS = dict(zip([str(code) for code in TERM_CODES], TERM_LABELS))
+
+def term_ordinal(codes):
+    '''
+    Returns the dense ordinal of each term code (scalar or array-like), counted from the first term of FIRST_YEAR. Sorting
+    by ordinal sorts chronologically. Raises an Exception for invalid term codes.
+    '''
+    codes = np.asarray(codes, dtype=np.int64)
+    positions = ENDING_POSITIONS[codes % 100]
+    if np.any(positions < 0):
+        raise Exception('Invalid term codes: ' + str(np.unique(codes[positions < 0]).tolist()))
+    return (codes // 100 - FIRST_YEAR)*TERMS_PER_YEAR + positions
+
+def term_label(codes):
+    '''
+    Returns the label of a term code, e.g. 201710 -> 'Fall 2017'. For an array-like of term codes, returns a numpy array of
+    their labels.
+    '''
+    if np.ndim(codes) == 0:
+        return SEMESTER_MAPPINGS.get(str(int(codes))) or derive_term_label(codes)
+    ordinals = term_ordinal(codes)
+    if np.all((ordinals >= 0) & (ordinals < len(TERM_LABELS))):
+        return TERM_LABELS[ordinals]
+    return np.array([term_label(code) for code in np.asarray(codes)], dtype=object)
+
+def sort_terms(codes, recent_first=True):
+    '''
+    Returns the unique term codes of codes (any iterable of term codes) as a list of ints, sorted by term with the most
+    recent term first (or last, if recent_first is False).
+    '''
+    codes = pd.unique(np.asarray(list(codes), dtype=np.int64))
+    order = np.argsort(term_ordinal(codes), kind='mergesort')
+    if recent_first:
+        order = order[::-1]
+    return codes[order].tolist()
+
+def terms_string(codes):
+    '''
+    Returns the labels of the unique term codes in codes, most recent first, joined into one string, e.g.
+    'Spring 2018, Fall 2017, Summer 2016'.
+    '''
+    return ', '.join(term_label(sort_terms(codes)))
@@ -11,6 +11,80 @@ from api_functions import *
 DB_NAME = "reviews-db-v1"
 COLLECTION_NAME = "aggregated_reviews"
 
+def make_ocr_frame(n_sections=40, seed=0, terms=[201710, 201720, 201810, 201820]):
+    '''
+    Generates a small frame of scraped OCR documents (the fields of the ocr_db_v1.reviews documents), two questions per
+    section, for the tests of the loader on the sqlite storage backend.
+    '''
+    rng = np.random.RandomState(seed)
+    sections = pd.DataFrame({'Term Code': rng.choice(terms, n_sections),
+                             'College Code': 'GCoE',
+                             'Subject Code': rng.choice(['AME', 'ENGR'], n_sections),
+                             'Course Number': rng.choice([2213, 3212], n_sections),
+                             'Section Number': np.arange(n_sections) % 3 + 1,
+                             'Section Title': rng.choice(['Statics LEC', 'Dynamics LEC'], n_sections),
+                             'Instructor First Name': rng.choice(['JANET', 'CHUNG-HAO', 'SAM'], n_sections),
+                             'Instructor Last Name': rng.choice(['ALLEN', 'LEE'], n_sections)})
+    df = sections.loc[sections.index.repeat(2)].reset_index(drop=True)
+    df['Question Number'] = np.tile([1, 2], n_sections)
+    df['Question'] = np.where(df['Question Number'] == 1, 'The instructor was well prepared.', 'The course was well organized.')
+    df['Individual Responses'] = rng.randint(5, 40, len(df))
+    df['Mean'] = np.round(rng.uniform(2, 5, len(df)), 2)
+    df['Standard Deviation'] = np.round(rng.uniform(0.3, 1.5, len(df)), 2)
+    return df
+
+def sqlite_test_driver():
+    '''
+    Returns a sqlite storage driver (see storage.py) of a new temporary file. The snapshots and id cache of the loads go to
+    the same temporary directory.
+    '''
+    import tempfile
+    import storage
+    import snapshots
+    import data_loader
+    tmp_dir = tempfile.mkdtemp()
+    snapshots.SNAPSHOT_DIR = os.path.join(tmp_dir, 'snapshots')
+    data_loader.ID_CACHE_FILE = os.path.join(tmp_dir, 'id_cache.json')
+    return storage.sqlite_driver(os.path.join(tmp_dir, 'test.sqlite'))
+
+def load_ocr_frame(driver, df, **kwargs):
+    '''
+    Inserts the OCR documents of df into the OCR collection of driver, then loads them with update_database(**kwargs).
+    '''
+    import data_loader
+    from bulk_upload import bulk_insert
+    bulk_insert(driver.get_db_collection(data_loader.OCR_DB_NAME, data_loader.ocr_collections[0]), df)
+    return data_loader.update_database(conn=driver, **kwargs)
+
+def collection_frame(collection):
+    '''
+    Returns the documents of a collection (without their _ids) as a dataframe with sorted columns and rows, to compare
+    collections regardless of the order they were written in.
+    '''
+    df = pd.DataFrame(list(collection.find({}, {'_id': 0})))
+    df = df[sorted(df.columns)]
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+def sqlite_test_server(driver):
+    '''
+    Returns server.py, serving the data of a sqlite storage driver. server.py connects when it is first imported, so the
+    storage backend is pointed at driver for the import.
+    '''
+    import sys
+    import storage
+    if 'server' not in sys.modules:
+        storage_driver = storage.storage_driver
+        storage.storage_driver = lambda: driver
+        try:
+            import server
+        finally:
+            storage.storage_driver = storage_driver
+    import server
+    server.db = driver
+    data_version_state['checked'] = None
+    server.search_state = server.build_search_state(get_data_version(driver))
+    return server
+
 class basictest(unittest.TestCase):
     """ Basic tests """
     # Test for mongo.py
@@ -51,6 +125,716 @@ class basictest(unittest.TestCase):
         # * Note that my formula uses n instead of n-1 for combining SDs, so expect some small differences in the final result
         return self.assertEqual(True, status)
 
+    # Test that the vectorized aggregation engine reproduces the original implementation
+    def test_vectorized_aggregation(self):
+        '''
+        This unit test will aggregate a small, randomly generated review dataframe with both aggregation engines and make
+        sure aggregate_data(validate=True) finds them in agreement.
+        '''
+        rng = np.random.RandomState(0)
+        n = 400
+        df = pd.DataFrame({'Term Code': rng.choice([201710, 201720, 201810], n),
+                           'College Code': 'GCoE',
+                           'Subject Code': rng.choice(['AME', 'ENGR'], n),
+                           'course_uuid': rng.choice(['1', '2', '3', '4'], n),
+                           'Instructor ID': rng.choice([11, 12, 13], n),
+                           'Section Title': 'Statics',
+                           'Question': 'Q1',
+                           'Question Number': 1,
+                           'Responses': rng.randint(0, 30, n),
+                           'Mean': rng.uniform(1, 5, n),
+                           'Standard Deviation': rng.uniform(0, 2, n)})
+        try:
+            data_aggregation.aggregate_data(df, validate=True)
+            status = True
+        except Exception:
+            status = False
+        return self.assertEqual(True, status)
+
+    def test_term_calendar(self):
+        '''
+        This unit test checks the term calendar ordering (most recent first) and the labels derived past mappings.yaml.
+        '''
+        import term_calendar
+        self.assertEqual(sort_by_term_code([201710, 201820, 201620, 201410, 201710, 201630, 201610]),
+                         [201820, 201710, 201610, 201630, 201620, 201410])
+        self.assertEqual(list(term_calendar.term_label([201710, 201920, 202530])), ['Fall 2017', 'Spring 2019', 'Summer 2025'])
+        return self.assertEqual(term_calendar.term_label(203010), 'Fall 2030')
+
+    def test_serving_engine_filters(self):
+        '''
+        This unit test evaluates the filter shapes of the figure apis on an in-memory table of the serving engine.
+        '''
+        from serving_engine import Table
+        table = Table(pd.DataFrame({'course_uuid': ['a', 'b', 'a', 'c', 'a'],
+                                    'Instructor ID': [1, 2, 2, 1, 1],
+                                    'Subject Code': ['AME', 'AME', 'ENGR', 'AME', 'AME'],
+                                    'Term Code': [201710, 201720, 201810, 201110, 201720]}))
+        self.assertEqual(table.select(course_filter('a')).tolist(), [0, 2, 4])
+        self.assertEqual(table.select({'$or': [{'Instructor ID': 2}, {'course_uuid': 'c'}]}).tolist(), [1, 2, 3])
+        df = table.frame(table.select({'$and': [{'Subject Code': 'AME'}, {'Term Code': 201720}]}), ['Instructor ID', 'Missing'])
+        return self.assertEqual(df['Instructor ID'].tolist(), [2, 1])
+
+    def test_search_index(self):
+        '''
+        This unit test searches a small prefix index by course code, title word and instructor name.
+        '''
+        from search_index import PrefixIndex
+        index = PrefixIndex([{'label': 'AME2213: Statics', 'value': '1'}, {'label': 'ENGR1411: Intro To Statistics', 'value': '2'},
+                             {'label': 'AME3212: Dynamics', 'value': '3'}, {'label': 'José Statham', 'value': '4'}])
+        self.assertEqual([entry['value'] for entry in index.search('ame22')], ['1'])
+        self.assertEqual([entry['value'] for entry in index.search('STAT', limit=3)], ['4', '1', '2'])
+        self.assertEqual([entry['value'] for entry in index.search('jose s')], ['4'])
+        self.assertEqual(index.search(' '), [])
+
+        # Typo tolerant search falls back on the trigram index
+        from search_index import TrigramIndex, search, prefix_distances
+        self.assertEqual(prefix_distances('statcs', ['statics', 'dynamics'], 2), [1, 5])
+        trigram_index = TrigramIndex(index.entries)
+        self.assertEqual([entry['value'] for entry in search(index, trigram_index, 'dynamcs')], ['3'])
+        return self.assertEqual(search(index, trigram_index, 'dynamcs', fuzzy=False), [])
+
+    def test_autocomplete_payload(self):
+        '''
+        This unit test serves a pre-encoded payload compressed, then revalidates it with its ETag.
+        '''
+        import gzip
+        from flask import Flask, request
+        from payloads import encode_payload, payload_response
+        payload = encode_payload({'result': [{'label': 'AME2213: Statics', 'value': '1'}]})
+        app = Flask(__name__)
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            response = payload_response(payload, request)
+            self.assertEqual(json.loads(gzip.decompress(response.get_data()))['result'][0]['value'], '1')
+        with app.test_request_context(headers={'If-None-Match': response.headers['ETag']}):
+            return self.assertEqual(payload_response(payload, request).status_code, 304)
+
+    def test_response_encoder(self):
+        '''
+        This unit test encodes a response mixing numpy, pandas and python values, with the floats rounded once.
+        '''
+        import response_encoder
+        body = response_encoder.dumps({'ratings': np.array([1.23456, np.nan]), 'count': np.int64(2), 'mean': np.float64(2.5049),
+                                       'series': pd.Series([0.125, 4.0]), 'names': ['a', 'b']}, digits=2)
+        return self.assertEqual(json.loads(body), {'ratings': [1.23, None], 'count': 2, 'mean': 2.5, 'series': [0.12, 4.0], 'names': ['a', 'b']})
+
+    def test_metrics(self):
+        '''
+        This unit test times the nested stages of a request and renders the metrics in the Prometheus format.
+        '''
+        import time
+        import metrics
+        timer = metrics.start_request('/api/v0/test')
+        with metrics.stage('pandas'):
+            with metrics.stage('mongo'):
+                time.sleep(0.01)
+        metrics.count_query('test_collection', 5, 100)
+        metrics.finish_request()
+        self.assertLess(timer.stages['pandas'], timer.stages['mongo'])
+        text = metrics.registry.render()
+        self.assertIn('stev_query_documents_total{collection="test_collection"} 5', text)
+        return self.assertIn('stev_request_seconds_count{endpoint="/api/v0/test"} 1', text)
+
+    def test_request_metrics(self):
+        '''
+        This unit test makes requests to server.py, one of which raises in its view, and makes sure both are recorded under
+        endpoint labels that only keep the known api suffixes.
+        '''
+        import metrics
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(), force_update=True)
+        server = sqlite_test_server(driver)
+        metrics.registry = metrics.Metrics()
+        client = server.app.test_client()
+        course = client.get('/api/v0/courses/all').get_json()['result'][0]['value']
+        self.assertEqual(client.get('/api/v0/courses/' + course + '/figure1').status_code, 200)
+        self.assertEqual(client.get('/api/v0/courses/' + course + '/no-such-figure').status_code, 500)
+        text = metrics.registry.render()
+        self.assertIn('stev_request_seconds_count{endpoint="/api/v0/courses/<course_uuid>/figure1"} 1', text)
+        self.assertIn('stev_request_seconds_count{endpoint="/api/v0/courses/<course_uuid>/<api_suffix>"} 1', text)
+        self.assertIn('stev_request_errors_total{endpoint="/api/v0/courses/<course_uuid>/<api_suffix>"} 1', text)
+        return self.assertNotIn('no-such-figure', text)
+
+    def test_incremental_update(self):
+        '''
+        This unit test adds documents to a loaded OCR collection (in a term that was loaded, and in a new term), then edits
+        one in place, and makes sure each incremental load leaves the same raw and aggregated collections as a full load of
+        the same documents.
+        '''
+        import data_loader
+        df = make_ocr_frame(n_sections=60, terms=[201710, 201720, 201810])
+        loaded = df[df['Term Code'] != 201810].iloc[:-10]
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, loaded, force_update=True)
+        ocr = driver.get_db_collection(data_loader.OCR_DB_NAME, data_loader.ocr_collections[0])
+
+        def assert_same_as_full_load():
+            full_driver = sqlite_test_driver()
+            load_ocr_frame(full_driver, data_loader.read_ocr_collection(ocr), force_update=True)
+            for name in [data_loader.ocr_collections[0], 'aggregated_' + data_loader.ocr_collections[0]]:
+                pd.testing.assert_frame_equal(collection_frame(driver.get_db_collection(data_loader.DB_NAME, name)),
+                                              collection_frame(full_driver.get_db_collection(data_loader.DB_NAME, name)))
+
+        load_ocr_frame(driver, df.drop(loaded.index), incremental=True)
+        assert_same_as_full_load()
+        edited = ocr.find_one({'Term Code': 201720})
+        ocr.replace_one({'_id': edited['_id']}, dict(edited, Mean=1.5))
+        data_loader.update_database(incremental=True, conn=driver)
+        assert_same_as_full_load()
+        return
+
+    def test_staged_update(self):
+        '''
+        This unit test reloads a loaded collection through staging collections, and makes sure the swapped in collections
+        have the new documents, the declared indexes and the indexes added to the live collections, and that a failed staged
+        load leaves the live collections as they were.
+        '''
+        import data_loader
+        from index_manager import missing_indexes
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(seed=0), force_update=True)
+        names = [data_loader.ocr_collections[0], 'aggregated_' + data_loader.ocr_collections[0]]
+        raw = driver.get_db_collection(data_loader.DB_NAME, names[0])
+        raw.create_index([('Question Number', 1)])
+        version = get_data_version(driver)
+
+        ocr = driver.get_db_collection(data_loader.OCR_DB_NAME, data_loader.ocr_collections[0])
+        ocr.delete_many({})
+        load_ocr_frame(driver, make_ocr_frame(seed=1), force_update=True, staged=True)
+        self.assertNotEqual(get_data_version(driver), version)
+        self.assertEqual(sorted(driver.get_db(data_loader.DB_NAME).list_collection_names()), sorted(names + [data_loader.LOAD_STATE_COLLECTION, data_loader.DATA_VERSION_COLLECTION]))
+        self.assertIn('Question Number_1', raw.index_information())
+        full_driver = sqlite_test_driver()
+        load_ocr_frame(full_driver, make_ocr_frame(seed=1), force_update=True)
+        for name in names:
+            collection = driver.get_db_collection(data_loader.DB_NAME, name)
+            self.assertEqual(missing_indexes(collection), [])
+            pd.testing.assert_frame_equal(collection_frame(collection), collection_frame(full_driver.get_db_collection(data_loader.DB_NAME, name)))
+
+        # The aggregation of a frame without its Means fails after the raw documents were staged
+        expected = [collection_frame(driver.get_db_collection(data_loader.DB_NAME, name)) for name in names]
+        with self.assertRaises(Exception):
+            data_loader.staged_update(driver, names[0], make_ocr_frame(seed=2).drop(columns=['Mean']))
+        self.assertEqual(sorted(driver.get_db(data_loader.DB_NAME).list_collection_names()), sorted(names + [data_loader.LOAD_STATE_COLLECTION, data_loader.DATA_VERSION_COLLECTION]))
+        for name, frame in zip(names, expected):
+            pd.testing.assert_frame_equal(collection_frame(driver.get_db_collection(data_loader.DB_NAME, name)), frame)
+        return
+
+    def test_staged_update_window(self):
+        '''
+        This unit test looks at the collections between the two renames of a staged load, and makes sure that the raw
+        collection is already the new one there while the aggregated one and the active data version are still the old ones,
+        and that both are the new ones once the data version changes.
+        '''
+        import storage
+        import data_loader
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(seed=0), force_update=True)
+        names = [data_loader.ocr_collections[0], 'aggregated_' + data_loader.ocr_collections[0]]
+        old = [collection_frame(driver.get_db_collection(data_loader.DB_NAME, name)) for name in names]
+        version = get_data_version(driver)
+
+        windows = []
+        rename = storage.sqlite_collection.rename
+        def recording_rename(collection, new_name, **kwargs):
+            target = rename(collection, new_name, **kwargs)
+            windows.append((new_name, get_data_version(driver), [collection_frame(driver.get_db_collection(data_loader.DB_NAME, name)) for name in names]))
+            return target
+        driver.get_db_collection(data_loader.OCR_DB_NAME, data_loader.ocr_collections[0]).delete_many({})
+        storage.sqlite_collection.rename = recording_rename
+        try:
+            load_ocr_frame(driver, make_ocr_frame(seed=1), force_update=True, staged=True)
+        finally:
+            storage.sqlite_collection.rename = rename
+        new = [collection_frame(driver.get_db_collection(data_loader.DB_NAME, name)) for name in names]
+
+        self.assertEqual([window[0] for window in windows], names)
+        window_version, frames = windows[0][1:]
+        self.assertEqual(window_version, version)
+        pd.testing.assert_frame_equal(frames[0], new[0])
+        pd.testing.assert_frame_equal(frames[1], old[1])
+        self.assertFalse(new[1].equals(old[1]))
+        self.assertNotEqual(get_data_version(driver), version)
+        return
+
+    def test_check_indexes(self):
+        '''
+        This unit test makes sure check_indexes reports the declared indexes a collection is missing, and that
+        ensure_indexes creates them.
+        '''
+        from index_manager import check_indexes, ensure_indexes, AGG_INDEXES
+        driver = sqlite_test_driver()
+        collection = driver.get_db_collection(DB_NAME, 'aggregated_test')
+        collection.insert_many([{'course_uuid': '1', 'Instructor ID': 2, 'Subject Code': 'AME', 'Term Code': 201710}])
+        collection.create_index(AGG_INDEXES[0])
+        self.assertEqual(check_indexes(driver, DB_NAME, ['aggregated_test']), {'aggregated_test': AGG_INDEXES[1:]})
+        ensure_indexes(collection)
+        return self.assertEqual(check_indexes(driver, DB_NAME, ['aggregated_test']), {})
+
+    def test_query_projection(self):
+        '''
+        This unit test queries a loaded collection with a projection, and makes sure the result has exactly the projected
+        columns (missing fields as NaN), comes from a single query of the collection holding the filter, and that a filter
+        found in no collection raises.
+        '''
+        import metrics
+        import data_loader
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(), force_update=True)
+        collection = driver.get_db_collection(data_loader.DB_NAME, AGG_COLLECTION_NAMES[0])
+        course = collection.find_one({})['course_uuid']
+        fields = ['Term Code', 'Avg Course Rating', 'No Such Field']
+        metrics.registry = metrics.Metrics()
+        df, coll_name = query_df_from_mongo(driver, course_filter(course), collections=['no_such_collection'] + AGG_COLLECTION_NAMES, projection=fields)
+        self.assertEqual(coll_name, AGG_COLLECTION_NAMES[0])
+        self.assertEqual(list(df.columns), fields)
+        self.assertEqual(len(df), collection.count_documents(course_filter(course)))
+        self.assertTrue(df['No Such Field'].isnull().all())
+        self.assertEqual(sorted(df['Term Code']), sorted(doc['Term Code'] for doc in collection.find(course_filter(course))))
+        self.assertIn('stev_queries_total{collection="' + AGG_COLLECTION_NAMES[0] + '"} 1', metrics.registry.render())
+        with self.assertRaises(Exception):
+            query_df_from_mongo(driver, course_filter('no such course'), projection=fields)
+        return
+
+    def test_response_cache(self):
+        '''
+        This unit test requests a figure of server.py twice (the second response comes from the response cache), then loads
+        a change to the data, and makes sure the cache is dropped for the new data version. The cache evicts its least
+        recently used responses to stay under its memory budget.
+        '''
+        import data_loader
+        import response_encoder
+        from response_cache import ResponseCache
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(), force_update=True)
+        server = sqlite_test_server(driver)
+        server.response_cache = ResponseCache()
+        client = server.app.test_client()
+        course = client.get('/api/v0/courses/all').get_json()['result'][0]['value']
+        first = client.get('/api/v0/courses/' + course + '/figure1').get_json()
+        self.assertEqual(client.get('/api/v0/courses/' + course + '/figure1').get_json(), first)
+        self.assertEqual(server.response_cache.stats()['hits'], 1)
+
+        # Change every Mean of the course
+        ocr = driver.get_db_collection(data_loader.OCR_DB_NAME, data_loader.ocr_collections[0])
+        raw = driver.get_db_collection(data_loader.DB_NAME, data_loader.ocr_collections[0])
+        course_doc = raw.find_one({'course_uuid': course}, {'_id': 0, 'Subject Code': 1, 'Course Number': 1, 'Section Title': 1})
+        for doc in ocr.find(course_doc):
+            ocr.replace_one({'_id': doc['_id']}, dict(doc, Mean=1.0))
+        data_loader.update_database(incremental=True, conn=driver)
+        data_version_state['checked'] = None
+        second = client.get('/api/v0/courses/' + course + '/figure1').get_json()
+        self.assertNotEqual(second, first)
+        self.assertEqual(second, json.loads(response_encoder.dumps(CourseFig1Table(driver, course))))
+        self.assertEqual(server.response_cache.stats()['invalidations'], 1)
+
+        cache = ResponseCache(max_bytes=10)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        cache.get('a')
+        cache.put('c', b'1234')
+        return self.assertEqual(list(cache.entries), ['a', 'c'])
+
+    def test_all_figures(self):
+        '''
+        This unit test makes sure the composite CourseAllFigures and InstructorAllFigures responses hold the same figures as
+        the individual figure apis.
+        '''
+        import response_encoder
+        encode = lambda response: json.loads(response_encoder.dumps(response, None))
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(n_sections=80), force_update=True)
+        for entry in SearchAutocomplete(driver, 'course')[:5]:
+            figures = {'figure1': CourseFig1Table, 'figure2': CourseFig2Chart, 'figure3': CourseFig3Timeseries, 'figure4': CourseFig4TableBar}
+            self.assertEqual(encode(CourseAllFigures(driver, entry['value'])),
+                             encode({'result': {name: func(driver, entry['value'])['result'] for name, func in figures.items()}}))
+        for entry in SearchAutocomplete(driver, 'instructor')[:5]:
+            figures = {'chip': InstructorChipAPI, 'figure1': InstructorFig1Table, 'figure2': InstructorFig2Timeseries, 'figure3': InstructorFig3TableBar}
+            self.assertEqual(encode(InstructorAllFigures(driver, entry['value'])),
+                             encode({'result': {name: func(driver, entry['value'])['result'] for name, func in figures.items()}}))
+        return
+
+    def test_instructor_timeseries(self):
+        '''
+        This unit test checks InstructorFig2Timeseries against a row by row computation of its semesters, courses and
+        department ratings.
+        '''
+        import term_calendar
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(n_sections=80), force_update=True)
+        for entry in SearchAutocomplete(driver, 'instructor'):
+            df, coll_name = query_df_from_mongo(driver, instructor_filter(entry['value']), projection=INSTRUCTOR_FIG2_FIELDS)
+            # Oldest semester first, sorted like InstructorFig2Timeseries (its first course gives the department)
+            df['sorter'] = -term_calendar.term_ordinal(df['Term Code'])
+            df.sort_values(by=['sorter'], ascending=False, inplace=True)
+            semester_ratings = {}
+            courses = {}
+            for index, row in df.iterrows():
+                semester = term_calendar.term_label(row['Term Code'])
+                semester_ratings.setdefault(semester, []).append(row['Avg Instructor Rating In Section'])
+                course = courses.setdefault(row['Course Title'], {'name': row['Course Title'], 'semesters': [], 'ratings': []})
+                course['semesters'].append(semester)
+                course['ratings'].append(row['Avg Instructor Rating In Section'])
+            dept_df, coll_name = query_df_from_mongo(driver, {'Subject Code': df['Subject Code'].iloc[0]}, projection=INSTRUCTOR_FIG2_DEPT_FIELDS)
+            dept_ratings = [dept_df.loc[term_calendar.term_label(dept_df['Term Code']) == semester, 'Avg Instructor Rating In Section'].mean()
+                            for semester in semester_ratings]
+
+            result = InstructorFig2Timeseries(driver, entry['value'])['result']
+            self.assertEqual(result['instructor name'], entry['label'])
+            self.assertEqual(result['instructor over time']['semesters'], list(semester_ratings))
+            np.testing.assert_allclose(result['instructor over time']['ratings'], [np.mean(ratings) for ratings in semester_ratings.values()])
+            self.assertEqual(result['dept over time']['semesters'], list(semester_ratings))
+            np.testing.assert_allclose(result['dept over time']['ratings'], dept_ratings)
+            self.assertEqual(sorted(course['name'] for course in result['courses']), sorted(courses))
+            for course in result['courses']:
+                self.assertEqual(sorted(zip(course['semesters'], course['ratings'])), sorted(zip(courses[course['name']]['semesters'], courses[course['name']]['ratings'])))
+        return
+
+    def test_pushdown_figures(self):
+        '''
+        This unit test loads a collection in mongomock (the sqlite storage backend has no aggregation pipelines), and makes
+        sure the pushdown figures give the same responses as the pandas ones. The pandas InstructorFig1Table doesn't order the
+        courses last taught in the same semester, so its courses are compared in the order of their most recent semester only.
+        '''
+        import mongo
+        import mongomock
+        import pushdown
+        import response_encoder
+        encode = lambda response: json.loads(response_encoder.dumps(response))
+        sqlite_test_driver()
+        driver = mongo.mongo_driver(mongomock.MongoClient())
+        load_ocr_frame(driver, make_ocr_frame(n_sections=80), force_update=True)
+        for entry in SearchAutocomplete(driver, 'course')[:5]:
+            self.assertEqual(encode(pushdown.CourseFig3Timeseries(driver, entry['value'])), encode(CourseFig3Timeseries(driver, entry['value'])))
+        for entry in SearchAutocomplete(driver, 'instructor')[:5]:
+            self.assertEqual(encode(pushdown.InstructorChipAPI(driver, entry['value'])), encode(InstructorChipAPI(driver, entry['value'])))
+            result, expected = encode(pushdown.InstructorFig1Table(driver, entry['value']))['result'], encode(InstructorFig1Table(driver, entry['value']))['result']
+            self.assertEqual(result['instructor name'], expected['instructor name'])
+            self.assertEqual([course['term'].split(', ')[0] for course in result['courses']], [course['term'].split(', ')[0] for course in expected['courses']])
+            self.assertEqual(sorted(result['courses'], key=json.dumps), sorted(expected['courses'], key=json.dumps))
+
+        # The pushdown figures are only selected with the mongo storage backend
+        self.assertEqual(set(pushdown.parse_backends('pushdown', storage_backend='mongo').values()), {'pushdown'})
+        self.assertEqual(set(pushdown.parse_backends('pushdown', storage_backend='sqlite').values()), {'pandas'})
+        self.assertEqual(set(pushdown.parse_backends('InstructorChipAPI=pushdown', storage_backend='sqlite').values()), {'pandas'})
+        return
+
+    def test_async_figures(self):
+        '''
+        This unit test runs the figure generators with gather_figures and with the event loop of async_server.py, and makes
+        sure they give the same responses as the figure apis, with the async queries answered by the sqlite storage backend.
+        '''
+        import asyncio
+        import response_encoder
+        encode = lambda response: json.loads(response_encoder.dumps(response))
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(n_sections=80), force_update=True)
+        sqlite_test_server(driver)
+        import async_server
+
+        course = SearchAutocomplete(driver, 'course')[0]['value']
+        instructor = SearchAutocomplete(driver, 'instructor')[0]['value']
+        course_figures = [CourseFig1Table, CourseFig2Chart, CourseFig3Timeseries, CourseFig4TableBar, CourseAllFigures]
+        instructor_figures = [InstructorChipAPI, InstructorFig1Table, InstructorFig2Timeseries, InstructorFig3TableBar, InstructorAllFigures]
+        # The first queries of the figures are yielded together
+        figures = course_figures[:4]
+        self.assertEqual(len(next(gather_figures([func.build(driver, course) for func in figures]))), len(figures))
+        self.assertEqual(encode(run_figure(driver, gather_figures([func.build(driver, course) for func in figures]))),
+                         encode([func(driver, course) for func in figures]))
+
+        # The server's startup leaves motor unopened, since the storage backend is sqlite, so the queries go to the driver
+        asyncio.run(async_server.connect())
+        self.assertIsNone(async_server.async_db)
+        for func, key in [(func, course) for func in course_figures] + [(func, instructor) for func in instructor_figures]:
+            self.assertEqual(encode(asyncio.run(async_server.run_figure_async(func.build(driver, key)))), encode(func(driver, key)))
+
+        # And through the app, whose startup runs connect()
+        async def get_figure(url):
+            async with async_server.app.test_app() as test_app:
+                response = await test_app.test_client().get(url)
+                return response.status_code, await response.get_json()
+        status, body = asyncio.run(get_figure(async_server.base_api_route + 'courses/' + course + '/figure2'))
+        self.assertEqual(status, 200)
+        self.assertEqual(body, encode(CourseFig2Chart(driver, course)))
+        return
+
+    def test_load_test(self):
+        '''
+        This unit test runs a short load test of server.py in-process, with a request mix drawn from its autocomplete lists,
+        and makes sure every request succeeds and the latency percentiles are reported overall and by kind.
+        '''
+        import sys
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+        import load_test
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(), force_update=True)
+        server = sqlite_test_server(driver)
+        client = server.app.test_client()
+        mix = load_test.fetch_mix(lambda path: client.get(path).get_json(), seed=1)
+        draws = [mix.draw(random.Random(2)) for _ in range(2)]
+        self.assertEqual(draws[0], draws[1])
+        self.assertIn(draws[0][0], load_test.REQUEST_MIX)
+
+        result = load_test.run_load(lambda: load_test.InProcessClient(server.app), mix, concurrency=2, duration=0.5, warmup=0.1, seed=1)
+        self.assertGreater(result['requests'], 0)
+        self.assertEqual(result['errors'], 0)
+        self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+        self.assertLessEqual(result['p95_ms'], result['p99_ms'])
+        self.assertEqual(list(result['kinds']), list(load_test.REQUEST_MIX))
+        return self.assertEqual(sum(kind['requests'] for kind in result['kinds'].values()), result['requests'])
+
+    def test_concurrent_snapshots(self):
+        '''
+        This unit test saves and loads the same snapshot from several threads at once (as the workers of the server do when
+        they start), and makes sure none of them fails and a complete snapshot is left.
+        '''
+        import tempfile
+        import threading
+        import snapshots
+        snapshot_dir = tempfile.mkdtemp()
+        df = make_ocr_frame()
+        errors = []
+        def save_and_load():
+            try:
+                for _ in range(5):
+                    snapshots.save_snapshot(df, 'aggregated_test', snapshot_dir, data_version='1')
+                    loaded = snapshots.load_snapshot('aggregated_test', snapshot_dir, data_version='1')
+                    if loaded is not None and not loaded.equals(df):
+                        errors.append('A partly written snapshot was loaded')
+            except Exception as e:
+                errors.append(repr(e))
+        threads = [threading.Thread(target=save_and_load) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(snapshot_dir), ['aggregated_test'])
+        return self.assertTrue(snapshots.load_snapshot('aggregated_test', snapshot_dir, data_version='1').equals(df))
+
+    def test_served_snapshot(self):
+        '''
+        This unit test starts the server's aggregated frame for a data version the loader's snapshot wasn't tagged with, and
+        makes sure the server saves its own snapshot, leaving the loader's one reusable by the next load.
+        '''
+        import snapshots
+        import data_loader
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(), force_update=True)
+        name = 'aggregated_' + data_loader.ocr_collections[0]
+        manifest = snapshots.read_manifest(name)
+        data_loader.set_data_version(driver, 'not-tagged')
+        df = load_aggregated_frame(driver)
+        self.assertEqual(snapshots.read_manifest(name), manifest)
+        self.assertIsNotNone(snapshots.load_snapshot(name, conditioned_hash=data_loader.conditioned_hash(data_loader.ocr_collections[0])))
+        self.assertEqual(snapshots.read_manifest(name + SERVED_SNAPSHOT_SUFFIX)['versions'], {'data_version': 'not-tagged'})
+        return self.assertTrue(load_aggregated_frame(driver).equals(df))
+
+    def test_snapshot_in_place_edit(self):
+        '''
+        This unit test edits an OCR document in place (its collection keeps its count and newest _id), and makes sure both a
+        forced and an incremental load pick the edit up instead of reusing the local snapshots.
+        '''
+        import data_loader
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(), force_update=True)
+        ocr = driver.get_db_collection(data_loader.OCR_DB_NAME, data_loader.ocr_collections[0])
+        raw = driver.get_db_collection(data_loader.DB_NAME, data_loader.ocr_collections[0])
+        edited = ocr.find_one({'Question Number': 1})
+        ocr.replace_one({'_id': edited['_id']}, dict(edited, Mean=1.11))
+        data_loader.update_database(force_update=True, conn=driver)
+        self.assertIn(1.11, [doc['Mean'] for doc in raw.find({}, ['Mean'])])
+
+        edited = ocr.find_one({'Question Number': 2})
+        ocr.replace_one({'_id': edited['_id']}, dict(edited, Mean=1.22))
+        data_loader.update_database(incremental=True, conn=driver)
+        return self.assertIn(1.22, [doc['Mean'] for doc in raw.find({}, ['Mean'])])
+
+    def test_id_cache(self):
+        '''
+        This unit test derives the instructor and course IDs with the hash cache, checks them against the original per-row
+        hashing, and makes sure an unwritable cache file doesn't stop a load.
+        '''
+        import hashlib
+        import tempfile
+        import data_loader
+        df = make_ocr_frame()
+        sha224_hash = lambda x: int(hashlib.sha224(x.encode('utf-8')).hexdigest()[:8], 16)
+        instructor_ids = (df['Instructor First Name']+df['Instructor Last Name']).apply(str).apply(sha224_hash).astype('int32').abs()
+        course_uuids = (df['Subject Code']+df['Course Number'].apply(str)+df['Section Title'].apply(lambda x: x[:-4])).apply(str).apply(sha224_hash).astype('int32').abs().apply(str)
+        cache = {}
+        data_loader.derive_ids(df, cache)
+        self.assertEqual(df['Instructor ID'].tolist(), instructor_ids.tolist())
+        self.assertEqual(df['course_uuid'].tolist(), course_uuids.tolist())
+        # Cached hashes give the same IDs
+        self.assertEqual(data_loader.hash_ids(df['Instructor First Name']+df['Instructor Last Name'], cache).tolist(), instructor_ids.tolist())
+
+        # A path that can't be written (its directory is a file) is reported instead of raising
+        path = os.path.join(tempfile.mkdtemp(), 'id_cache.json')
+        open(path, 'w').close()
+        data_loader.save_id_cache(cache, os.path.join(path, 'id_cache.json'))
+        data_loader.save_id_cache(cache, path)
+        return self.assertEqual(data_loader.load_id_cache(path), cache)
+
+    def test_offering_key_backfill(self):
+        '''
+        This unit test removes the offering keys from the raw documents (as loaded before they were stored), and makes sure
+        a later load backfills them so that CourseFig4TableBar returns the same figure, and that the backfill only runs once.
+        '''
+        import data_loader
+        from index_manager import OFFERING_KEY, ensure_indexes
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(), force_update=True)
+        course = SearchAutocomplete(driver, 'course')[0]['value']
+        expected = CourseFig4TableBar(driver, course)
+        raw = driver.get_db_collection(data_loader.DB_NAME, data_loader.ocr_collections[0])
+        def remove_keys():
+            for doc in raw.find({}):
+                del doc[OFFERING_KEY]
+                raw.replace_one({'_id': doc['_id']}, doc)
+            self.assertEqual(raw.count_documents({OFFERING_KEY: {'$exists': True}}), 0)
+        remove_keys()
+        ensure_indexes(raw)
+        self.assertEqual(raw.count_documents({OFFERING_KEY: {'$exists': True}}), 0)
+        data_loader.update_database(conn=driver)
+        self.assertEqual(raw.count_documents({OFFERING_KEY: {'$exists': False}}), 0)
+        self.assertEqual(CourseFig4TableBar(driver, course), expected)
+
+        # The migration is recorded, so the next loads don't scan the collection again
+        remove_keys()
+        self.assertIsNone(data_loader.migrate_offering_keys(driver, data_loader.ocr_collections[0]))
+        data_loader.update_database(conn=driver)
+        return self.assertEqual(raw.count_documents({OFFERING_KEY: {'$exists': True}}), 0)
+
+    def test_benchmark_data(self):
+        '''
+        This unit test generates the synthetic OCR data of the benchmarks (it must be the same for the same seed), loads it
+        on the sqlite storage backend and times every figure api on it, which must not fail.
+        '''
+        import sys
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+        import run_benchmarks
+        from synthetic_ocr import generate_ocr_frame
+        df = generate_ocr_frame(500, seed=3)
+        self.assertTrue(df.equals(generate_ocr_frame(500, seed=3)))
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, df, force_update=True)
+        course_ids = [entry['value'] for entry in SearchAutocomplete(driver, 'course')[:5]]
+        instructor_ids = [entry['value'] for entry in SearchAutocomplete(driver, 'instructor')[:5]]
+        figures = run_benchmarks.time_figures(driver, run_benchmarks.COURSE_FIGURES, course_ids)
+        figures.update(run_benchmarks.time_figures(driver, run_benchmarks.INSTRUCTOR_FIGURES, instructor_ids))
+        return self.assertEqual({name: figure['errors'] for name, figure in figures.items() if figure['errors'] > 0}, {})
+
+    def test_response_rounding(self):
+        '''
+        This unit test encodes every figure of a small load with and without the rounding of the response floats, and makes
+        sure the rounding only changes the floats, by less than half of the last decimal kept.
+        '''
+        import response_encoder
+        digits = 4
+        def compare(rounded, exact):
+            if isinstance(exact, float) and isinstance(rounded, (int, float)):
+                return self.assertAlmostEqual(rounded, exact, delta=0.5*10**-digits + 1e-12)
+            self.assertEqual(type(rounded), type(exact))
+            if isinstance(exact, dict):
+                self.assertEqual(list(rounded.keys()), list(exact.keys()))
+                for key in exact:
+                    compare(rounded[key], exact[key])
+            elif isinstance(exact, list):
+                self.assertEqual(len(rounded), len(exact))
+                for rounded_value, exact_value in zip(rounded, exact):
+                    compare(rounded_value, exact_value)
+            else:
+                self.assertEqual(rounded, exact)
+
+        driver = sqlite_test_driver()
+        load_ocr_frame(driver, make_ocr_frame(), force_update=True)
+        figures = [(func, entry['value']) for entry in SearchAutocomplete(driver, 'course')[:3]
+                   for func in [CourseFig1Table, CourseFig2Chart, CourseFig3Timeseries, CourseFig4TableBar]]
+        figures += [(func, entry['value']) for entry in SearchAutocomplete(driver, 'instructor')[:3]
+                    for func in [InstructorChipAPI, InstructorFig1Table, InstructorFig2Timeseries, InstructorFig3TableBar]]
+        for func, figure_id in figures:
+            response = func(driver, figure_id)
+            compare(json.loads(response_encoder.dumps(response, digits)), json.loads(response_encoder.dumps(response, None)))
+        return
+
+    def test_read_ocr_collection(self):
+        '''
+        This unit test reads an OCR collection of the sqlite storage backend in small batches, under a memory limit tight
+        enough to shrink the batches, and makes sure a limit it can't fit under raises an OCRMemoryLimitError.
+        '''
+        import data_loader
+        from bulk_upload import bulk_insert
+        df = make_ocr_frame(n_sections=500)
+        collection = sqlite_test_driver().get_db_collection(data_loader.OCR_DB_NAME, data_loader.ocr_collections[0])
+        bulk_insert(collection, df)
+        read = data_loader.read_ocr_collection(collection, batch_size=300)
+        self.assertTrue(read.equals(df[data_loader.OCR_COLUMNS]))
+        self.assertTrue(data_loader.read_ocr_collection(collection, batch_size=200, memory_limit_mb=0.4).equals(read))
+        with self.assertRaises(data_loader.OCRMemoryLimitError):
+            data_loader.read_ocr_collection(collection, memory_limit_mb=0.1)
+        return
+
+    def test_bulk_insert(self):
+        '''
+        This unit test batches documents by count and by size (with a remainder batch), uploads a frame to the sqlite
+        storage backend, and makes sure a batch retried after a dropped connection ignores the duplicates of the documents it
+        had already written.
+        '''
+        import bson
+        import mongomock
+        from pymongo.errors import AutoReconnect
+        import bulk_upload
+        records = [{'i': i, 'name': 'x'*10} for i in range(25)]
+        self.assertEqual([len(batch) for batch in bulk_upload.batch_records(records, max_batch_docs=10)], [10, 10, 5])
+        size = len(bson.BSON.encode(records[0]))
+        self.assertEqual([len(batch) for batch in bulk_upload.batch_records(records, max_batch_bytes=7*size)], [7, 7, 7, 4])
+
+        df = make_ocr_frame()
+        collection = sqlite_test_driver().get_db_collection(DB_NAME, COLLECTION_NAME)
+        self.assertEqual(bulk_upload.bulk_insert(collection, df, max_batch_bytes=5000, workers=3), len(df))
+        self.assertEqual(sorted(doc['Mean'] for doc in collection.find({}, ['Mean'])), sorted(df['Mean']))
+
+        class flaky_collection:
+            # Writes the first half of the first batch it gets, then drops the connection
+            def __init__(self, collection):
+                self.collection = collection
+                self.dropped = False
+            def insert_many(self, batch, ordered=True):
+                if not self.dropped:
+                    self.dropped = True
+                    self.collection.insert_many(batch[:len(batch)//2], ordered=ordered)
+                    raise AutoReconnect('connection dropped')
+                return self.collection.insert_many(batch, ordered=ordered)
+        collection = mongomock.MongoClient().get_database(DB_NAME).get_collection(COLLECTION_NAME)
+        self.assertEqual(bulk_upload.insert_batch(flaky_collection(collection), records, retry_backoff=0), len(records))
+        return self.assertEqual(sorted(doc['i'] for doc in collection.find()), list(range(25)))
+
+    def test_sqlite_storage(self):
+        '''
+        This unit test runs the filter shapes of the figure apis on a collection of the sqlite storage backend, and makes
+        sure they are answered from its indexes.
+        '''
+        import os
+        import tempfile
+        import storage
+        from index_manager import ensure_indexes
+        driver = storage.sqlite_driver(os.path.join(tempfile.mkdtemp(), 'test.sqlite'))
+        coll = driver.get_db_collection(DB_NAME, COLLECTION_NAME)
+        coll.insert_many([{'course_uuid': uuid, 'Instructor ID': instructor, 'Subject Code': subject, 'Term Code': term, 'Mean': mean}
+                          for uuid, instructor, subject, term, mean in [('a', 1, 'AME', 201710, 4.5), ('b', 2, 'AME', 201720, np.nan),
+                                                                        ('a', 2, 'ENGR', 201810, 3.0), ('c', 1, 'AME', 201110, 4.0)]])
+        ensure_indexes(coll)
+        self.assertTrue(driver.collection_existence_check(DB_NAME, COLLECTION_NAME))
+        self.assertEqual([doc['Term Code'] for doc in coll.find(course_filter('a'), {'_id': 0, 'Term Code': 1})], [201710, 201810])
+        self.assertEqual([doc['course_uuid'] for doc in coll.find({'$or': [{'Instructor ID': 2}, {'course_uuid': 'c'}]}, ['course_uuid'])], ['b', 'a', 'c'])
+        self.assertEqual(coll.find_one({'$and': [{'Subject Code': 'AME'}, {'Term Code': 201720}]}, {'_id': 0}), {'course_uuid': 'b', 'Instructor ID': 2, 'Subject Code': 'AME', 'Term Code': 201720, 'Mean': None})
+        params = []
+        plan = driver.connection().execute('EXPLAIN QUERY PLAN SELECT doc FROM ' + coll.table + ' WHERE ' + storage.translate_filter(course_filter('a'), params), params).fetchall()
+        self.assertIn('USING INDEX', str(plan))
+        coll.delete_many({'Instructor ID': 1})
+        return self.assertEqual(coll.count_documents({}), 2)
+
     # Test the current course apis to make sure that they are at least returning a valid json
     def test_course_api_endings(self):
         '''